@@ -0,0 +1,177 @@
+import argparse
+import asyncio
+import json
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, 'client'))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from async_client import TCRP_Connection, Chat_Session, handshake, open_endpoint
+from load_bench import start_server, stop_server, free_port, scrape, percentile, REGISTER_BATCH, SETTLE_SECONDS
+
+# --sessions client sessions in this one process, on one event loop, with
+# client/async_client.py against a real server/server.py.
+#
+#   setup: rooms of --members sessions, each room's host creating it, all
+#   handshakes pipelined over --connections TCRP connections, then one
+#   REGISTER per session (REGISTER_BATCH per 10ms, as load_bench does).
+#   traffic: the hosts send at --rate messages per second for --duration;
+#   every other session counts what it receives (on_message) and the
+#   delivery latency, stamped with time.monotonic_ns() before send().
+#   leave: every session sends __LEAVE__; the server should hold nothing after.
+#
+# Run once with a socket per session ("own") and once with all sessions on
+# one shared endpoint ("shared"). Reported: handshakes and registrations per
+# second, sessions the server holds, loss and latency, the worst event loop
+# stall during traffic, and this process's threads, file descriptors, CPU
+# time and RSS once every session is registered.
+
+def rss_mb():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return round(int(line.split()[1]) / 1024, 1)
+
+async def loop_lag(stop, interval=0.01):
+    # The worst lateness of a timer that should fire every interval
+    worst = 0.0
+    while not stop.is_set():
+        began = time.perf_counter()
+        await asyncio.sleep(interval)
+        worst = max(worst, time.perf_counter() - began - interval)
+    return worst
+
+async def run(args, mode, tcp_port, udp_port, metrics_port):
+    result = {"phase": "sessions", "mode": mode, "sessions": args.sessions, "members": args.members,
+              "rate": args.rate, "duration": args.duration}
+    rooms = [f"room{i}" for i in range(args.sessions // args.members)]
+    latencies = []
+
+    def on_message(sender, message):
+        latencies.append(time.monotonic_ns() - int(message.split(" ", 1)[0]))
+
+    # Setup. One handshake first, so the room dictionary is fetched once
+    # rather than by every request already in flight.
+    started = time.perf_counter()
+    connections = [await TCRP_Connection.open("127.0.0.1", tcp_port) for _ in range(args.connections)]
+    for connection in connections[1:]:
+        connection.dictionaries = connections[0].dictionaries
+    tickets = [await handshake("127.0.0.1", tcp_port, udp_port, rooms[0], "host", True, connection=connections[0])]
+
+    def jobs(create):
+        for i, room_name in enumerate(rooms if create else rooms * (args.members - 1)):
+            if create and i == 0:
+                continue
+            username = "host" if create else f"user{i // len(rooms)}"
+            yield handshake("127.0.0.1", tcp_port, udp_port, room_name, username, create,
+                            connection=connections[i % len(connections)])
+
+    for create in (True, False):
+        tickets.extend(await asyncio.gather(*jobs(create)))
+    for connection in connections:
+        await connection.close()
+    failed = tickets.count(None)
+    tickets = [ticket for ticket in tickets if ticket is not None]
+    result["handshake_failures"] = failed
+    result["handshakes_per_sec"] = round(len(tickets) / (time.perf_counter() - started))
+
+    started = time.perf_counter()
+    endpoint = await open_endpoint(on_message=on_message) if mode == "shared" else None
+    sessions = []
+    for start in range(0, len(tickets), REGISTER_BATCH):
+        batch = [Chat_Session(ticket, on_message=on_message) for ticket in tickets[start:start + REGISTER_BATCH]]
+        await asyncio.gather(*(session.register(endpoint) for session in batch))
+        sessions.extend(batch)
+        await asyncio.sleep(0.01)
+    result["registers_per_sec"] = round(len(sessions) / (time.perf_counter() - started))
+    await asyncio.sleep(0.5)
+    result["server_sessions"] = int((await asyncio.to_thread(scrape, metrics_port)).get("chat_tokens", 0))
+    result["threads"] = threading.active_count()
+    result["open_fds"] = len(os.listdir("/proc/self/fd"))
+    result["client_rss_mb"] = rss_mb()
+
+    # Traffic
+    hosts = [session for session in sessions if session.username == "host"]
+    stop = asyncio.Event()
+    lag = asyncio.ensure_future(loop_lag(stop))
+    total = int(args.rate * args.duration)
+    padding = "x" * 40
+    cpu_started = time.process_time()
+    began = time.perf_counter()
+    for sent in range(total):
+        due = began + sent / args.rate
+        delay = due - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await hosts[sent % len(hosts)].send(f"{time.monotonic_ns()} {padding}")
+    received = -1
+    while received != len(latencies):
+        received = len(latencies)
+        await asyncio.sleep(SETTLE_SECONDS)
+    stop.set()
+    expected = total * (args.members - 1)
+    latencies.sort()
+    result.update({"sent": total, "expected_deliveries": expected, "delivered": len(latencies),
+                   "loss_pct": round(100.0 * (1 - len(latencies) / expected), 3) if expected else 0.0,
+                   "latency_p50_ms": round(percentile(latencies, 0.5) / 1e6, 3) if latencies else None,
+                   "latency_p99_ms": round(percentile(latencies, 0.99) / 1e6, 3) if latencies else None,
+                   "loop_lag_max_ms": round(await lag * 1e3, 2),
+                   "client_cpu_us_per_delivery": round((time.process_time() - cpu_started) * 1e6 / len(latencies), 2)
+                   if latencies else None})
+
+    # Leave, members first so no room closes under them
+    started = time.perf_counter()
+    members = [session for session in sessions if session.username != "host"]
+    for group in (members, hosts):
+        for start in range(0, len(group), REGISTER_BATCH):
+            await asyncio.gather(*(session.leave() for session in group[start:start + REGISTER_BATCH]))
+            await asyncio.sleep(0.01)
+    result["leaves_per_sec"] = round(len(sessions) / (time.perf_counter() - started))
+    if endpoint is not None:
+        endpoint.close()
+    await asyncio.sleep(0.5)
+    result["server_sessions_after_leave"] = int((await asyncio.to_thread(scrape, metrics_port)).get("chat_tokens", 0))
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Thousands of client sessions in one process on one event loop")
+    parser.add_argument("--sessions", type=int, default=10000)
+    parser.add_argument("--members", type=int, default=10, help="sessions per room")
+    parser.add_argument("--connections", type=int, default=8, help="TCRP connections the handshakes share")
+    parser.add_argument("--rate", type=int, default=1000, help="messages/s sent across all rooms")
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--modes", nargs="+", default=["own", "shared"], choices=["own", "shared"])
+    parser.add_argument("--tcp-engine", default="asyncio")
+    parser.add_argument("--udp-engine", default="threaded")
+    parser.add_argument("--output", help="append JSON lines to this file as well")
+    args = parser.parse_args()
+
+    # A socket per session
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    lines = []
+    for mode in args.modes:
+        with tempfile.TemporaryDirectory() as workdir:
+            metrics_port = free_port()
+            proc, tcp_port, udp_port = start_server(workdir, args.tcp_engine, args.udp_engine, 1, 0,
+                                                    metrics_port=metrics_port)
+            try:
+                line = asyncio.run(run(args, mode, tcp_port, udp_port, metrics_port))
+            finally:
+                stop_server(proc)
+        print(json.dumps(line), flush=True)
+        lines.append(line)
+    if args.output:
+        with open(args.output, 'a') as f:
+            for line in lines:
+                f.write(json.dumps(line) + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import secrets
+import socket
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, 'client'))
+sys.path.append(os.path.join(ROOT, 'server'))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from protocol.ucrp import build_udp_payload, build_session_payload, iter_udp_messages
+from tcp_client import TCP_Create_Join_Client
+from cluster import Hash_Ring, CLUSTER_FILE
+from load_bench import start_server, stop_server, free_port, scrape, metric_total, percentile
+
+# Cluster mode as several local server.py processes on loopback ports.
+#
+#   1. Starts --nodes nodes, each listing the others as seeds, and waits
+#      until every node sees all of them on its ring.
+#   2. Creates --rooms rooms, every request sent to the first node, and
+#      follows the redirects like client.py does. Checks each room landed
+#      on the node the ring places it on, and that a member who joins
+#      through another node can chat with the host over the owner's UDP port.
+#   3. Starts one more node that only knows the first node as its seed.
+#      Reports how many rooms the ring moved (ideally 1/(N+1), and all of
+#      them to the new node), checks the moved rooms still take joins on
+#      their old node, and that new rooms go to the ring owner.
+#   4. Stops a node, then kills another, and reports how long the others
+#      take to drop each from their ring.
+
+CONVERGE_TIMEOUT = 15.0
+
+class Node:
+    def __init__(self, node_id, workdir):
+        self.node_id = node_id
+        self.tcp_port = free_port()
+        self.udp_port = free_port(socket.SOCK_DGRAM)
+        self.gossip_port = free_port(socket.SOCK_DGRAM)
+        self.metrics_port = free_port()
+        self.workdir = os.path.join(workdir, node_id)
+        self.proc = None
+
+    def start(self, args, seeds):
+        os.mkdir(self.workdir)
+        config = {"node_id": self.node_id, "advertise_host": "127.0.0.1", "gossip_port": self.gossip_port,
+                  "seeds": [f"127.0.0.1:{seed.gossip_port}" for seed in seeds if seed is not self],
+                  "secret": args.secret}
+        with open(os.path.join(self.workdir, CLUSTER_FILE), 'w') as f:
+            json.dump(config, f)
+        self.proc, _, _ = start_server(self.workdir, args.tcp_engine, args.udp_engine, args.workers, 0,
+                                       metrics_port=self.metrics_port, ports=(self.tcp_port, self.udp_port))
+
+    def sample(self, name):
+        return metric_total(scrape(self.metrics_port), name)
+
+    def stop(self):
+        if self.proc is not None:
+            stop_server(self.proc)
+            self.proc = None
+
+def wait_for(nodes, count):
+    # Seconds until every node has `count` nodes on its ring
+    started = time.monotonic()
+    while time.monotonic() - started < CONVERGE_TIMEOUT:
+        if all(node.sample("chat_cluster_nodes") == count for node in nodes):
+            return round(time.monotonic() - started, 2)
+        time.sleep(0.1)
+    raise RuntimeError(f"Cluster did not converge on {count} nodes")
+
+def request(entry, op, room_name, username):
+    # (token, session id, node port that answered, redirects followed, seconds)
+    client = TCP_Create_Join_Client("127.0.0.1", entry.tcp_port, compression=False)
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()) as out:
+        if not client.connect():
+            raise RuntimeError("Cannot connect")
+        ok = client.create_room(room_name, username) if op == "create" else client.join_room(room_name, username)
+        client.disconnect()
+    elapsed = time.perf_counter() - started
+    return (client.get_token() if ok else None, client.get_session_id(), client.port,
+            out.getvalue().count("reconnecting"), elapsed)
+
+def chat_check(host_node, room_name, host_token, member_token, member_session_id):
+    # The member sends one message over the owner's UDP port; the host must get it
+    server = ("127.0.0.1", host_node.udp_port)
+    host_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    member_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    host_sock.settimeout(2)
+    try:
+        host_sock.sendto(build_udp_payload(room_name, host_token, "__REGISTER__"), server)
+        member_sock.sendto(build_udp_payload(room_name, member_token, "__REGISTER__"), server)
+        time.sleep(0.05)
+        member_sock.sendto(build_session_payload(member_session_id, "hello across the cluster"), server)
+        while True:
+            data, _ = host_sock.recvfrom(65536)
+            if any(message == "hello across the cluster" for _, message in iter_udp_messages(data)):
+                return True
+    except socket.timeout:
+        return False
+    finally:
+        host_sock.close()
+        member_sock.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Cluster placement, redirects and rebalancing on loopback")
+    parser.add_argument("--nodes", type=int, default=3, help="nodes before one more is added")
+    parser.add_argument("--rooms", type=int, default=300)
+    parser.add_argument("--chat-checks", type=int, default=20, help="rooms where a member joins through another node and chats")
+    parser.add_argument("--tcp-engine", default="asyncio")
+    parser.add_argument("--udp-engine", default="threaded")
+    parser.add_argument("--workers", type=int, default=1, help="UDP worker processes per node (> 1 = sharded)")
+    parser.add_argument("--output", help="append JSON lines to this file as well")
+    parser.add_argument("--secret", default=secrets.token_hex(16), help="gossip secret; with '' the added node is no seed of the others and cannot join")
+    args = parser.parse_args()
+
+    lines = []
+    def report(line):
+        print(json.dumps(line), flush=True)
+        lines.append(line)
+
+    nodes = []
+    with tempfile.TemporaryDirectory() as workdir:
+        try:
+            # Static peer list: every node knows every other one
+            ids = [chr(ord("a") + i) for i in range(args.nodes)]
+            nodes = [Node(node_id, workdir) for node_id in ids]
+            for node in nodes:
+                node.start(args, nodes)
+            by_port = {node.tcp_port: node for node in nodes}
+            converge = wait_for(nodes, len(nodes))
+
+            entry = nodes[0]
+            ring = Hash_Ring(ids)
+            rooms = {}
+            redirects = 0
+            latencies = []
+            misplaced = 0
+            for i in range(args.rooms):
+                room_name = f"room{i}"
+                token, session_id, port, hops, elapsed = request(entry, "create", room_name, "host")
+                if token is None:
+                    raise RuntimeError(f"Could not create {room_name}")
+                rooms[room_name] = (by_port[port], token)
+                redirects += hops
+                latencies.append(elapsed)
+                misplaced += by_port[port].node_id != ring.owner(room_name)
+            latencies.sort()
+            per_node = {node.node_id: int(node.sample("chat_rooms")) for node in nodes}
+
+            chats = 0
+            for i in range(min(args.chat_checks, args.rooms)):
+                room_name = f"room{i}"
+                owner, host_token = rooms[room_name]
+                # Join through a node that is not the owner
+                via = nodes[(nodes.index(owner) + 1) % len(nodes)]
+                token, session_id, port, hops, _ = request(via, "join", room_name, f"member{i}")
+                if token is not None and hops == 1 and port == owner.tcp_port:
+                    chats += chat_check(owner, room_name, host_token, token, session_id)
+            report({"phase": "placement", "nodes": len(nodes), "converge_seconds": converge, "rooms": args.rooms,
+                    "rooms_per_node": per_node, "misplaced": misplaced, "redirects": redirects,
+                    "create_p50_ms": round(percentile(latencies, 0.5) * 1e3, 2),
+                    "create_p99_ms": round(percentile(latencies, 0.99) * 1e3, 2),
+                    "chat_checks": min(args.chat_checks, args.rooms), "chat_ok": chats})
+
+            # A new node that only knows the first one
+            added_id = chr(ord("a") + args.nodes)
+            added = Node(added_id, workdir)
+            nodes.append(added)
+            added.start(args, [entry])
+            by_port[added.tcp_port] = added
+            converge = wait_for(nodes, len(nodes))
+            bigger = Hash_Ring(ids + [added_id])
+            moved = [room for room in rooms if bigger.owner(room) != ring.owner(room)]
+            # Each node reports the rooms it holds off-ring every gossip round
+            time.sleep(1.5)
+            strays = sum(int(node.sample("chat_cluster_stray_rooms")) for node in nodes)
+            stayed = 0
+            for room_name in moved:
+                token, _, port, _, _ = request(added, "join", room_name, "late")
+                stayed += token is not None and port == rooms[room_name][0].tcp_port
+            fresh = 0
+            fresh_on_added = 0
+            for i in range(args.rooms):
+                room_name = f"fresh{i}"
+                token, _, port, _, _ = request(entry, "create", room_name, "host")
+                fresh += token is not None and by_port[port].node_id == bigger.owner(room_name)
+                fresh_on_added += by_port[port] is added
+            report({"phase": "add_node", "nodes": len(nodes), "converge_seconds": converge,
+                    "moved": len(moved), "moved_fraction": round(len(moved) / args.rooms, 3),
+                    "ideal_fraction": round(1 / len(nodes), 3),
+                    "moved_only_to_new_node": all(bigger.owner(room) == added_id for room in moved),
+                    "stray_rooms_reported": strays, "moved_rooms_still_joinable": stayed,
+                    "new_rooms": args.rooms, "new_rooms_placed_on_owner": fresh, "new_rooms_on_new_node": fresh_on_added})
+
+            # A clean stop: the others take the node off their ring at once
+            leaving = nodes.pop(1)
+            started = time.monotonic()
+            leaving.stop()
+            converge = wait_for(nodes, len(nodes))
+            report({"phase": "remove_node", "nodes": len(nodes), "converge_seconds": round(time.monotonic() - started, 2)})
+
+            # A crash: the others drop the node once its heartbeat stops
+            if len(nodes) > 2:
+                crashed = nodes.pop(1)
+                started = time.monotonic()
+                crashed.proc.kill()
+                crashed.proc.wait()
+                crashed.proc = None
+                wait_for(nodes, len(nodes))
+                report({"phase": "crash_node", "nodes": len(nodes),
+                        "converge_seconds": round(time.monotonic() - started, 2)})
+        finally:
+            for node in nodes:
+                node.stop()
+    if args.output:
+        with open(args.output, 'a') as f:
+            for line in lines:
+                f.write(json.dumps(line) + "\n")
+
+if __name__ == "__main__":
+    main()
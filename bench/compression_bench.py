@@ -0,0 +1,271 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, 'client'))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from protocol.ucrp import build_session_payload, build_udp_message, iter_udp_messages, SESSION_ID_SIZE
+from protocol.compress import Message_Codec, PRESET_DICTIONARY, train_dictionary, COMPRESSED_HEADER_SIZE
+from tcp_client import TCP_Create_Join_Client
+from udp_client import UDP_Chat_Client
+from load_bench import start_server, stop_server, percentile
+
+# Bandwidth saved by per-message compression on chat traffic.
+#
+# The corpus is synthetic but shaped like a team chat: short replies and
+# greetings, questions, status updates with numbers and durations, links,
+# pasted error lines, and a share of messages with ids, hashes or other
+# text that does not compress. It is seeded, so runs are comparable.
+#
+# Each message is costed as the client would send it (the smaller of the
+# compact session packet and the compressed one) and as relayed to one
+# receiver, with no dictionary, the built-in preset, and a dictionary
+# trained on the first half of the corpus and measured on the second.
+#
+# --e2e also runs the corpus through a real server/server.py between two
+# client/udp_client.UDP_Chat_Client instances that negotiate compression
+# over TCRP, and checks every message arrives intact. The "mixed" room has
+# a receiver that did not negotiate it, which the server sends plain frames.
+#
+# --write-dictionary PATH saves the trained dictionary; put it at
+# dictionaries/default.zdict (or <room>.zdict) where the server runs.
+
+NAMES = ["alice", "bob", "carol", "dave", "erin", "frank", "grace", "heidi", "ivan", "judy"]
+SERVICES = ["api", "auth", "billing", "search", "frontend", "worker", "gateway", "db", "cache", "scheduler"]
+THINGS = ["the build", "the deploy", "the tests", "the migration", "the release", "staging", "the PR", "the docs",
+          "the dashboard", "the alerts", "the backup", "the review", "the demo", "lunch", "the meeting"]
+FEELINGS = ["great", "weird", "broken", "fine", "slow", "flaky", "done", "green", "red", "stuck"]
+
+SHORT = ["ok", "okay", "yes", "no", "thanks!", "thank you", "lol", "haha", "nice", "+1", "sure", "np", "brb",
+         "on my way", "sounds good", "good morning!", "good night", "see you later", "agreed", "same here",
+         "I don't know", "not sure", "makes sense", "let me check", "one sec", "done", "ty", "yep", "nope", "omg"]
+
+TEMPLATES = [
+    "hey {name}, did you see {thing}?",
+    "{thing} is {feeling} again",
+    "can you take a look at {thing} when you have a minute?",
+    "I think {thing} is {feeling}, let me know if you have any questions",
+    "deploy of {service} finished in {n}s",
+    "{service} p99 latency is {n}ms since {time}",
+    "anyone else having this problem with {service}? it works for me locally",
+    "I'll be there in {n} minutes",
+    "meeting moved to {time} on {day}",
+    "what do you think about moving {thing} to {day}?",
+    "thanks {name}, that's a good idea",
+    "sorry about that, {thing} should be fixed now",
+    "{name} is out {day}, so {thing} waits until {day}",
+    "https://github.com/example/{service}/pull/{n}",
+    "can you send me the link to {thing}?",
+    "Error: connection refused while connecting to {service} on port {port}",
+    "Traceback (most recent call last): File \"{service}/main.py\", line {n}, in handle",
+    "does it work now? I restarted {service} at {time}",
+    "good morning {name}! how are you doing?",
+    "{thing} looks {feeling} to me, great job",
+]
+
+DAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "tomorrow", "today"]
+
+def noise(rng, length):
+    return "".join(rng.choice("0123456789abcdefghijklmnopqrstuvwxyz") for _ in range(length))
+
+def chat_corpus(count, seed):
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(count):
+        roll = rng.random()
+        if roll < 0.30:
+            text = rng.choice(SHORT)
+        elif roll < 0.90:
+            text = rng.choice(TEMPLATES).format(
+                name=rng.choice(NAMES), thing=rng.choice(THINGS), feeling=rng.choice(FEELINGS),
+                service=rng.choice(SERVICES), n=rng.randint(1, 9999), time=f"{rng.randint(1, 12)}:{rng.randint(0, 59):02d}",
+                day=rng.choice(DAYS), port=rng.choice([80, 443, 5432, 6379, 8080]))
+        elif roll < 0.97:
+            # ids, hashes, tokens: little to compress
+            text = f"{rng.choice(['commit', 'ticket', 'trace id', 'see'])} {noise(rng, rng.randint(8, 40))}"
+        else:
+            # the odd long paste
+            text = " ".join(rng.choice(TEMPLATES).format(
+                name=rng.choice(NAMES), thing=rng.choice(THINGS), feeling=rng.choice(FEELINGS),
+                service=rng.choice(SERVICES), n=rng.randint(1, 9999), time="9:00", day=rng.choice(DAYS), port=443)
+                for _ in range(rng.randint(4, 12)))
+        corpus.append(text)
+    return corpus
+
+def measure(messages, codec, session_id, sender):
+    # Wire bytes client -> server and server -> one receiver, per message
+    sent = relayed = compressed = 0
+    timings = []
+    sender_bytes = sender.encode('utf-8')
+    for message in messages:
+        plain = build_session_payload(session_id, message)
+        body = None
+        if codec is not None:
+            started = time.perf_counter()
+            body = codec.compress(message.encode('utf-8'))
+            timings.append(time.perf_counter() - started)
+        if body is not None and COMPRESSED_HEADER_SIZE + len(body) < len(plain):
+            compressed += 1
+            sent += COMPRESSED_HEADER_SIZE + len(body)
+            relayed += 3 + len(sender_bytes) + len(body)
+        else:
+            sent += len(plain)
+            relayed += len(build_udp_message(sender, message))
+    result = {"messages": len(messages), "compressed_fraction": round(compressed / len(messages), 3),
+              "sent_bytes": sent, "relayed_bytes": relayed}
+    if timings:
+        timings.sort()
+        result["compress_us_p50"] = round(percentile(timings, 0.50) * 1e6, 1)
+        result["compress_us_p99"] = round(percentile(timings, 0.99) * 1e6, 1)
+    return result
+
+def report(name, result, baseline, extra=None):
+    line = {"dictionary": name, **result, **(extra or {})}
+    if baseline is not None:
+        line["sent_saved"] = round(1 - result["sent_bytes"] / baseline["sent_bytes"], 3)
+        line["relayed_saved"] = round(1 - result["relayed_bytes"] / baseline["relayed_bytes"], 3)
+    print(json.dumps(line), flush=True)
+    return line
+
+class Counting_Client(UDP_Chat_Client):
+    # Records deliveries and received bytes instead of printing
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.received = []
+        self.datagrams = 0
+        self.bytes = 0
+
+    def deliver(self, data):
+        self.datagrams += 1
+        self.bytes += len(data)
+        for _, message in iter_udp_messages(data, self.codec.parse_message if self.codec else None):
+            self.received.append(message)
+
+def join(tcp_port, room_name, username, create, compression):
+    client = TCP_Create_Join_Client("127.0.0.1", tcp_port, compression=compression)
+    if not client.connect():
+        raise RuntimeError("Cannot connect to the server")
+    try:
+        ok = client.create_room(room_name, username) if create else client.join_room(room_name, username)
+        if not ok:
+            raise RuntimeError(f"Cannot join {room_name}")
+        return client.get_token(), client.get_session_id(), client.get_dictionary()
+    finally:
+        client.disconnect()
+
+def receive(client, count, timeout=5.0):
+    client.sock.settimeout(0.2)
+    deadline = time.monotonic() + timeout
+    while len(client.received) < count and time.monotonic() < deadline:
+        try:
+            data, _ = client.sock.recvfrom(65536)
+        except socket.timeout:
+            continue
+        client.deliver(data)
+
+# (name, whether the sender compresses, whether each receiver does)
+E2E_CASES = [("plain", False, (False,)), ("compressed", True, (True,)), ("mixed", True, (True, False))]
+
+def run_e2e(messages, dictionary, args):
+    # Sends the messages through a real server and checks they arrive intact
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        if dictionary is not None:
+            os.mkdir(os.path.join(workdir, "dictionaries"))
+            with open(os.path.join(workdir, "dictionaries", "default.zdict"), 'wb') as f:
+                f.write(dictionary)
+        proc, tcp_port, udp_port = start_server(workdir, args.tcp_engine, args.udp_engine, args.workers, args.coalesce_ms)
+        try:
+            for name, compression, receiving in E2E_CASES:
+                room = f"e2e_{name}"
+                with contextlib.redirect_stdout(io.StringIO()):
+                    host = join(tcp_port, room, "host", True, compression)
+                    sender = UDP_Chat_Client("host", "127.0.0.1", udp_port, room, host[0], host[1], dictionary=host[2])
+                    sender.register()
+                    receivers = []
+                    for i, receiver_compression in enumerate(receiving):
+                        member = join(tcp_port, room, f"member{i}", False, receiver_compression)
+                        receiver = Counting_Client(f"member{i}", "127.0.0.1", udp_port, room, member[0], member[1],
+                                                   dictionary=member[2])
+                        receiver.register()
+                        receivers.append(receiver)
+                readers = [threading.Thread(target=receive, args=(receiver, len(messages)), daemon=True)
+                           for receiver in receivers]
+                for reader in readers:
+                    reader.start()
+                for i, message in enumerate(messages):
+                    sender.send_message(message)
+                    if i % 20 == 19:
+                        time.sleep(0.002)
+                for reader in readers:
+                    reader.join()
+                results[name] = [{"compression": receiver_compression, "delivered": len(receiver.received),
+                                  "intact": receiver.received == messages, "datagrams": receiver.datagrams,
+                                  "received_bytes": receiver.bytes}
+                                 for receiver, receiver_compression in zip(receivers, receiving)]
+                sender.sock.close()
+                for receiver in receivers:
+                    receiver.sock.close()
+        finally:
+            stop_server(proc)
+    plain, compressed = results["plain"][0], results["compressed"][0]
+    results["received_saved"] = round(1 - compressed["received_bytes"] / plain["received_bytes"], 3)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Bandwidth saved by per-message compression on a chat corpus")
+    parser.add_argument("--messages", type=int, default=20000, help="corpus size; half trains, half is measured")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--dictionary-size", type=int, default=4096)
+    parser.add_argument("--write-dictionary", metavar="PATH", help="save the trained dictionary here")
+    parser.add_argument("--e2e", action="store_true", help="also relay the measured half through a real server")
+    parser.add_argument("--e2e-messages", type=int, default=2000)
+    parser.add_argument("--tcp-engine", default="asyncio")
+    parser.add_argument("--udp-engine", default="threaded")
+    parser.add_argument("--workers", type=int, default=1, help="UDP worker processes (> 1 = sharded)")
+    parser.add_argument("--coalesce-ms", type=float, default=0, help="server outbound coalescing window; 0 = off")
+    parser.add_argument("--output", help="append JSON lines to this file as well")
+    args = parser.parse_args()
+
+    corpus = chat_corpus(args.messages, args.seed)
+    training, measured = corpus[:len(corpus) // 2], corpus[len(corpus) // 2:]
+    session_id = bytes(SESSION_ID_SIZE)
+
+    started = time.perf_counter()
+    trained = train_dictionary(training, args.dictionary_size)
+    train_seconds = time.perf_counter() - started
+    if args.write_dictionary:
+        with open(args.write_dictionary, 'wb') as f:
+            f.write(trained)
+
+    lines = []
+    baseline = measure(measured, None, session_id, "alice")
+    lines.append(report("none", baseline, None))
+    lines.append(report("preset", measure(measured, Message_Codec(PRESET_DICTIONARY), session_id, "alice"), baseline,
+                        {"dictionary_bytes": len(PRESET_DICTIONARY)}))
+    lines.append(report("trained", measure(measured, Message_Codec(trained), session_id, "alice"), baseline,
+                        {"dictionary_bytes": len(trained), "train_seconds": round(train_seconds, 3)}))
+    if args.e2e:
+        e2e = run_e2e(measured[:args.e2e_messages], trained, args)
+        line = {"e2e": e2e, "tcp_engine": args.tcp_engine, "udp_engine": args.udp_engine,
+                "workers": args.workers, "coalesce_ms": args.coalesce_ms}
+        print(json.dumps(line), flush=True)
+        lines.append(line)
+    if args.output:
+        with open(args.output, 'a') as f:
+            for line in lines:
+                f.write(json.dumps(line) + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import selectors
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, 'client'))
+sys.path.append(os.path.join(ROOT, 'server'))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from protocol.ucrp import build_udp_payload, iter_udp_messages
+import logger
+from room_manager import RoomManager, Room, Session
+from snapshot import encode_snapshot, load_snapshot
+from load_bench import (start_server, stop_server, free_port, scrape, percentile, setup_rooms, handshake,
+                        run_senders, REGISTER_BATCH, SETTLE_SECONDS)
+
+# Zero-downtime restart (server/handoff.py).
+#
+#   1. snapshot: RoomManager state of --sessions sessions as the binary
+#      handoff snapshot and as room_manager.json, size and time to write
+#      and load each.
+#   2. restart: a server.py with --rooms rooms of --members members. The
+#      hosts chat at --rate messages per second while a joiner keeps
+#      creating sessions through the TCP handshake; halfway through, a
+#      second server.py is started in the same directory and takes over.
+#      Reported: messages lost across the restart, the worst delivery
+#      latency, failed handshakes, how long the old process took to hand
+#      over and exit, and whether the new one holds every session (and,
+#      restarted cold afterwards, restores them all from the journal).
+
+def snapshot_sizes(sessions, members_per_room=10):
+    room_manager = RoomManager()
+    for i in range(sessions // members_per_room):
+        room_name = f"room{i}"
+        room_manager.create_room(room_name, "host", None)
+        for j in range(1, members_per_room):
+            room_manager.join_room(room_name, f"user{j}", None)
+    for i, token in enumerate(list(room_manager.tokens)):
+        room_manager.register_address(token, ("10.%d.%d.%d" % (i >> 16 & 255, i >> 8 & 255, i & 255), 40000))
+
+    started = time.perf_counter()
+    with room_manager.lock:
+        binary = encode_snapshot(room_manager)
+    binary_write = time.perf_counter() - started
+    started = time.perf_counter()
+    load_snapshot(RoomManager(), binary)
+    binary_load = time.perf_counter() - started
+
+    started = time.perf_counter()
+    text = json.dumps({"rooms": room_manager.export_rooms(), "tokens": room_manager.export_tokens()}).encode('utf-8')
+    json_write = time.perf_counter() - started
+    started = time.perf_counter()
+    data = json.loads(text)
+    target = RoomManager()
+    target.load_state({name: Room.from_dict(room) for name, room in data["rooms"].items()},
+                      {token: Session.from_dict(info) for token, info in data["tokens"].items()})
+    json_load = time.perf_counter() - started
+    return {"phase": "snapshot", "sessions": len(room_manager.tokens), "rooms": len(room_manager.rooms),
+            "binary_bytes": len(binary), "json_bytes": len(text), "size_ratio": round(len(text) / len(binary), 2),
+            "binary_write_ms": round(binary_write * 1e3, 1), "binary_load_ms": round(binary_load * 1e3, 1),
+            "json_write_ms": round(json_write * 1e3, 1), "json_load_ms": round(json_load * 1e3, 1)}
+
+def run_joiner(tcp_port, server, stop, stats):
+    # New sessions all through the restart: each one a fresh handshake and REGISTER
+    joined = failed = 0
+    latencies = []
+    socks = []
+    while not stop.is_set():
+        began = time.perf_counter()
+        member = handshake(tcp_port, f"late{joined % 20}", f"late{joined + failed}", create=joined < 20)
+        if member is None:
+            failed += 1
+            continue
+        latencies.append(time.perf_counter() - began)
+        member.register(server)
+        socks.append(member.sock)
+        joined += 1
+        stop.wait(0.005)
+    latencies.sort()
+    stats.update({"late_joins": joined, "late_join_failures": failed,
+                  "late_join_p50_ms": round(percentile(latencies, 0.5) * 1e3, 2) if latencies else None,
+                  "late_join_max_ms": round(latencies[-1] * 1e3, 2) if latencies else None})
+    for sock in socks:
+        sock.close()
+
+def restart(args, workdir):
+    tcp_port, udp_port, metrics_port = free_port(), free_port(socket.SOCK_DGRAM), free_port()
+
+    def launch():
+        return start_server(workdir, args.tcp_engine, args.udp_engine, 1, 0, metrics_port=metrics_port,
+                            ports=(tcp_port, udp_port), state_backend=args.state_backend)[0]
+
+    proc = launch()
+    server = ("127.0.0.1", udp_port)
+    successor = None
+    successors = []
+    try:
+        room_members, _ = setup_rooms(tcp_port, args.rooms, args.members, 0)
+        everyone = [member for members in room_members.values() for member in members]
+        for repeat in range(2):
+            for start in range(0, len(everyone), REGISTER_BATCH):
+                for member in everyone[start:start + REGISTER_BATCH]:
+                    if repeat:
+                        member.sock.sendto(build_udp_payload(member.room_name, member.token, "__REGISTER__"), server)
+                    else:
+                        member.register(server)
+                time.sleep(0.01)
+        time.sleep(0.5)
+        sessions_before = scrape(metrics_port).get("chat_tokens", 0)
+
+        hosts = [members[0] for members in room_members.values()]
+        selector = selectors.DefaultSelector()
+        for members in room_members.values():
+            for member in members[1:]:
+                member.sock.setblocking(False)
+                selector.register(member.sock, selectors.EVENT_READ)
+        parent_conn, child_conn = multiprocessing.Pipe()
+        sender = multiprocessing.Process(target=run_senders, args=(
+            hosts, server, args.rate, args.duration, 64, False, child_conn))
+        sender.start()
+        stop = threading.Event()
+        join_stats = {}
+        joiner = threading.Thread(target=run_joiner, args=(tcp_port, server, stop, join_stats))
+        joiner.start()
+
+        restart_at = time.monotonic() + args.duration / 2
+        handoff_seconds = None
+        latencies = []
+        sender_result = None
+        quiet_since = None
+        while True:
+            events = selector.select(0.02)
+            now = time.monotonic_ns()
+            for key, _ in events:
+                while True:
+                    try:
+                        data = key.fileobj.recv(65536)
+                    except BlockingIOError:
+                        break
+                    try:
+                        for _, message in iter_udp_messages(data):
+                            latencies.append(now - int(message.split(" ", 1)[0]))
+                    except ValueError:
+                        pass
+            if successor is None and time.monotonic() >= restart_at:
+                launched = time.monotonic()
+                successor = threading.Thread(target=lambda: successors.append(launch()))
+                successor.start()
+            if handoff_seconds is None and successor is not None and proc.poll() is not None:
+                handoff_seconds = round(time.monotonic() - launched, 2)
+            if sender_result is None and parent_conn.poll():
+                sender_result = parent_conn.recv()
+                stop.set()
+            if sender_result is not None and handoff_seconds is not None:
+                if events:
+                    quiet_since = None
+                elif quiet_since is None:
+                    quiet_since = time.monotonic()
+                elif time.monotonic() - quiet_since >= SETTLE_SECONDS:
+                    break
+        sender.join()
+        joiner.join()
+        successor.join()
+        new_proc = successors[0]
+        selector.close()
+
+        sent_per_room, _ = sender_result
+        expected = sum(count * (len(room_members[host.room_name]) - 1) for count, host in zip(sent_per_room, hosts))
+        latencies.sort()
+        sessions_after = scrape(metrics_port).get("chat_tokens", 0)
+        stop_server(new_proc)
+        # A cold start from the state both processes wrote
+        cold = launch()
+        sessions_cold = scrape(metrics_port).get("chat_tokens", 0)
+        stop_server(cold)
+        for member in everyone:
+            member.sock.close()
+        return {"phase": "restart", "tcp_engine": args.tcp_engine, "udp_engine": args.udp_engine,
+                "state_backend": args.state_backend,
+                "rooms": args.rooms, "members": args.members, "rate": args.rate, "duration": args.duration,
+                "sent": sum(sent_per_room), "expected_deliveries": expected, "delivered": len(latencies),
+                "loss_pct": round(100.0 * (1 - len(latencies) / expected), 3) if expected else 0.0,
+                "latency_p50_ms": round(percentile(latencies, 0.5) / 1e6, 3) if latencies else None,
+                "latency_max_ms": round(latencies[-1] / 1e6, 3) if latencies else None,
+                "old_process_exit_seconds": handoff_seconds, **join_stats,
+                "sessions_before": int(sessions_before), "sessions_expected": int(sessions_before) + join_stats["late_joins"],
+                "sessions_after": int(sessions_after), "sessions_after_cold_start": int(sessions_cold)}
+    finally:
+        if proc.poll() is None:
+            stop_server(proc)
+
+def main():
+    parser = argparse.ArgumentParser(description="Zero-downtime restart: snapshot size and a live handoff")
+    parser.add_argument("--sessions", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--rooms", type=int, default=50)
+    parser.add_argument("--members", type=int, default=10)
+    parser.add_argument("--rate", type=int, default=2000, help="messages/s sent across all rooms")
+    parser.add_argument("--duration", type=float, default=4.0)
+    parser.add_argument("--tcp-engine", default="asyncio")
+    parser.add_argument("--udp-engine", default="threaded")
+    parser.add_argument("--state-backend", default="journal")
+    parser.add_argument("--output", help="append JSON lines to this file as well")
+    args = parser.parse_args()
+
+    logger.configure("error")
+    lines = [snapshot_sizes(sessions) for sessions in args.sessions]
+    for line in lines:
+        print(json.dumps(line), flush=True)
+    with tempfile.TemporaryDirectory() as workdir:
+        # TCP_Create_Join_Client reports progress with print()
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            line = restart(args, workdir)
+    print(json.dumps(line), flush=True)
+    lines.append(line)
+    if args.output:
+        with open(args.output, 'a') as f:
+            for line in lines:
+                f.write(json.dumps(line) + "\n")
+
+if __name__ == "__main__":
+    main()
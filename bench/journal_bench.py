@@ -0,0 +1,72 @@
+import argparse
+import contextlib
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(os.path.join(ROOT, 'server'))
+
+from journal import Journal
+from room_manager import RoomManager
+
+# Cost of persisting one join as total state grows: save_to_json on every
+# event against the journal listener. Also checks that a restore from
+# snapshot + journal reproduces the live state.
+
+def populate(room_manager, tokens):
+    per_room = 50
+    for i in range(tokens // per_room):
+        room_manager.create_room(f"room{i}", "host", ("127.0.0.1", 20000))
+        for j in range(per_room - 1):
+            room_manager.join_room(f"room{i}", f"user{j}", ("127.0.0.1", 20001 + j))
+
+def measure(tokens, events, workdir):
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        room_manager = RoomManager()
+        populate(room_manager, tokens)
+        room_manager.create_room("hot", "host", ("127.0.0.1", 30000))
+        save_events = max(1, events // 100)
+        started = time.perf_counter()
+        for i in range(save_events):
+            room_manager.join_room("hot", f"user{i}", ("127.0.0.1", 30001))
+            room_manager.save_to_json(os.path.join(workdir, "save.json"))
+        save_us = (time.perf_counter() - started) / save_events * 1e6
+
+        # Journal attached from the start, compacting about twice on the way
+        journal = Journal(os.path.join(workdir, f"{tokens}.journal"), os.path.join(workdir, f"{tokens}.json"),
+                          compact_every=tokens // 2)
+        live = RoomManager()
+        journal.attach(live)
+        populate(live, tokens)
+        live.create_room("hot", "host", ("127.0.0.1", 30000))
+        started = time.perf_counter()
+        for i in range(events):
+            live.join_room("hot", f"user{i}", ("127.0.0.1", 30001))
+        journal_us = (time.perf_counter() - started) / events * 1e6
+        journal.close()
+
+        restored = RoomManager()
+        Journal(journal.journal_path, journal.snapshot_path).restore(restored)
+
+    return {
+        "tokens": len(live.tokens),
+        "save_to_json_us": round(save_us, 1),
+        "journal_us": round(journal_us, 2),
+        "restore_matches": restored.export_tokens() == live.export_tokens() and restored.rooms.keys() == live.rooms.keys(),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-event persistence cost versus state size")
+    parser.add_argument("--sizes", default="1000,10000,50000")
+    parser.add_argument("--events", type=int, default=5000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        for size in args.sizes.split(","):
+            result = measure(int(size), args.events, workdir)
+            print(" ".join(f"{k}={v}" for k, v in result.items()))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,535 @@
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import resource
+import selectors
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, 'client'))
+
+from protocol.ucrp import build_udp_payload, build_session_payload, iter_udp_messages
+from tcp_client import TCP_Create_Join_Client
+
+# End-to-end load test against a real server/server.py on loopback.
+#
+# Every simulated client goes through the same steps as client/client.py:
+# a TCRP create/join with TCP_Create_Join_Client, a UCRP __REGISTER__ from
+# its own UDP socket, then chat messages (compact session id packets unless
+# --legacy). The host of each room is the sender; a separate process paces
+# the senders at --rate messages per second across all rooms, stamping each
+# message with time.monotonic_ns(), so fan-out latency is measured from just
+# before sendto() to each member's recv(). Server CPU and RSS include the
+# shard worker processes. Members send __HEARTBEAT__ like the real client,
+# and the server's session count is scraped from /metrics to report stale
+# sessions: those left behind by clients that are gone. The server's rate
+# limit is off unless a scenario (flood) or --rate-limit sets it.
+#
+# One JSON object per scenario is printed (or appended to --output), so runs
+# can be diffed or checked against thresholds before deploying.
+
+SCENARIOS = {
+    # Many small rooms: per-packet relay cost dominates
+    "small_rooms": dict(rooms=200, members=4, rate=2000, duration=5.0),
+    # One huge room: fan-out cost dominates
+    "huge_room": dict(rooms=1, members=500, rate=100, duration=5.0),
+    # Everyone joins at once through the TCP handshake, then chats lightly
+    "join_storm": dict(rooms=20, members=100, rate=200, duration=3.0, join_concurrency=200),
+    # Members keep leaving with __LEAVE__ and rejoining while rooms chat
+    "churn": dict(rooms=50, members=5, rate=1000, duration=5.0, churners=2, churn_rate=50),
+    # Members crash (no __LEAVE__) and new users join; idle expiry cleans up
+    "crash_churn": dict(rooms=50, members=5, rate=1000, duration=8.0, churners=2, churn_rate=50, crash=True,
+                        session_timeout=2.0),
+    # One member of the first room floods it while the other rooms chat normally
+    "flood": dict(rooms=20, members=10, rate=200, duration=5.0, flood_rate=20000, rate_limit=50),
+}
+
+DEFAULTS = dict(join_concurrency=0, churners=0, churn_rate=0, crash=False, session_timeout=60.0, flood_rate=0,
+                rate_limit=0, size=64)
+
+SETTLE_SECONDS = 1.0   # quiet period that ends the drain after the last send
+REGISTER_BATCH = 100   # REGISTERs sent per 10ms during setup
+
+def free_port(kind=socket.SOCK_STREAM):
+    with socket.socket(socket.AF_INET, kind) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_server(workdir, tcp_engine, udp_engine, workers, coalesce_ms, session_timeout=60.0, metrics_port=0,
+                 rate_limit=0, ports=None, state_backend="journal"):
+    tcp_port, udp_port = ports or (free_port(), free_port(socket.SOCK_DGRAM))
+    answers = ["127.0.0.1", tcp_port, udp_port, tcp_engine, udp_engine, workers, coalesce_ms, session_timeout,
+               rate_limit, "warning", metrics_port, state_backend]
+    proc = subprocess.Popen([sys.executable, os.path.join(ROOT, 'server', 'server.py')], cwd=workdir,
+                            stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT, text=True)
+    proc.stdin.write("".join(f"{answer}\n" for answer in answers))
+    proc.stdin.flush()
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", tcp_port), timeout=0.2).close()
+            break
+        except OSError:
+            if proc.poll() is not None or time.monotonic() > deadline:
+                raise RuntimeError("server.py did not start")
+            time.sleep(0.05)
+    # The UDP side (and its workers) comes up right after the TCP bind
+    time.sleep(0.5)
+    return proc, tcp_port, udp_port
+
+def stop_server(proc):
+    proc.send_signal(2)
+    try:
+        proc.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+def _process_tree(pid):
+    pids = [pid]
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    if int(f.read().rsplit(")", 1)[1].split()[1]) == pid:
+                        pids.append(int(entry))
+            except (OSError, IndexError, ValueError):
+                pass
+    return pids
+
+def server_usage(pid):
+    # (cpu seconds, current RSS kB, peak RSS kB) summed over server.py and its workers
+    cpu = rss = peak = 0
+    for p in _process_tree(pid):
+        try:
+            with open(f"/proc/{p}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            cpu += (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+            with open(f"/proc/{p}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        rss += int(line.split()[1])
+                    elif line.startswith("VmHWM:"):
+                        peak += int(line.split()[1])
+        except OSError:
+            pass
+    return cpu, rss, peak
+
+def scrape(metrics_port):
+    # {series: value} from the server's /metrics endpoint, e.g.
+    # 'chat_tokens' or 'chat_udp_rejected_total{shard="0",reason="malformed"}'
+    samples = {}
+    with urllib.request.urlopen(f"http://127.0.0.1:{metrics_port}/metrics", timeout=2) as response:
+        for line in response.read().decode().splitlines():
+            if line and not line.startswith("#"):
+                series, value = line.rsplit(" ", 1)
+                samples[series] = float(value)
+    return samples
+
+def metric_total(samples, name, **labels):
+    # Sum of every series of `name` carrying the given labels (any shard)
+    wanted = [f'{key}="{value}"' for key, value in labels.items()]
+    return sum(value for series, value in samples.items()
+               if series.split("{")[0] == name and all(label in series for label in wanted))
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+def udp_socket():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024)
+    return sock
+
+class Member:
+    __slots__ = ("room_name", "username", "token", "session_id", "sock")
+
+    def __init__(self, room_name, username, token, session_id):
+        self.room_name = room_name
+        self.username = username
+        self.token = token
+        self.session_id = session_id
+        self.sock = None
+
+    def register(self, server):
+        self.sock = udp_socket()
+        self.sock.sendto(build_udp_payload(self.room_name, self.token, "__REGISTER__"), server)
+
+    def payload(self, message, legacy):
+        if legacy or not self.session_id:
+            return build_udp_payload(self.room_name, self.token, message)
+        return build_session_payload(self.session_id, message)
+
+def handshake(tcp_port, room_name, username, create=False):
+    # One client, one connection, one request: what client.py does
+    client = TCP_Create_Join_Client("127.0.0.1", tcp_port)
+    if not client.connect():
+        return None
+    try:
+        ok = client.create_room(room_name, username) if create else client.join_room(room_name, username)
+        return Member(room_name, username, client.get_token(), client.get_session_id()) if ok else None
+    finally:
+        client.disconnect()
+
+def setup_rooms(tcp_port, rooms, members, join_concurrency):
+    # Returns {room_name: [host, member, ...]} and handshake stats
+    hosts = {}
+    for r in range(rooms):
+        room_name = f"load{r}"
+        hosts[room_name] = handshake(tcp_port, room_name, "host", create=True)
+
+    joins = [(room_name, f"user{i}") for i in range(members) for room_name in hosts]
+    latencies = []
+    started = time.perf_counter()
+    if join_concurrency:
+        def timed_join(job):
+            began = time.perf_counter()
+            member = handshake(tcp_port, *job)
+            latencies.append(time.perf_counter() - began)
+            return member
+        with ThreadPoolExecutor(join_concurrency) as pool:
+            joined = list(pool.map(timed_join, joins))
+    else:
+        # Bulk setup: one pipelined connection per room
+        joined = []
+        for room_name in hosts:
+            client = TCP_Create_Join_Client("127.0.0.1", tcp_port)
+            client.connect()
+            tokens = client.pipeline([(2, room_name, f"user{i}") for i in range(members)])
+            joined.extend(Member(room_name, f"user{i}", token, client.session_ids.get(token)) if token else None
+                          for i, token in enumerate(tokens))
+            client.disconnect()
+    elapsed = time.perf_counter() - started
+
+    room_members = {room_name: [host] for room_name, host in hosts.items()}
+    failed = 0
+    for member in joined:
+        if member is None:
+            failed += 1
+        else:
+            room_members[member.room_name].append(member)
+    stats = {"joins": len(joins) - failed, "join_failures": failed,
+             "joins_per_sec": round((len(joins) - failed) / elapsed) if elapsed else 0}
+    if latencies:
+        latencies.sort()
+        stats["handshake_p50_ms"] = round(percentile(latencies, 0.50) * 1e3, 2)
+        stats["handshake_p99_ms"] = round(percentile(latencies, 0.99) * 1e3, 2)
+    return room_members, stats
+
+def run_senders(hosts, server, rate, duration, size, legacy, conn):
+    # Child process: paces the hosts round-robin at `rate` messages/second
+    total = int(rate * duration)
+    padding = "x" * max(0, size - 20)
+    sent = [0] * len(hosts)
+    started = time.monotonic()
+    for i in range(total):
+        due = started + i / rate
+        delay = due - time.monotonic()
+        if delay > 0.001:
+            time.sleep(delay)
+        lane = i % len(hosts)
+        host = hosts[lane]
+        try:
+            host.sock.sendto(host.payload(f"{time.monotonic_ns()} {padding}", legacy), server)
+            sent[lane] += 1
+        except OSError:
+            pass
+    conn.send((sent, time.monotonic() - started))
+
+def run_flood(member, server, rate, duration, legacy, conn):
+    # Child process: one client sending as fast as `rate` allows
+    total = int(rate * duration)
+    started = time.monotonic()
+    sent = 0
+    for i in range(total):
+        if i % 100 == 0:
+            delay = started + i / rate - time.monotonic()
+            if delay > 0.001:
+                time.sleep(delay)
+        try:
+            member.sock.sendto(member.payload(f"F {i}", legacy), server)
+            sent += 1
+        except OSError:
+            pass
+    conn.send(sent)
+
+def run_churn(room_members, churners, tcp_port, server, rate, legacy, crash, stop, stats):
+    # Leaves with __LEAVE__ and rejoins with a fresh handshake and REGISTER;
+    # with crash, just goes silent and a new user joins in its place.
+    # Churners are kept out of the delivery accounting.
+    lanes = list(room_members.items())
+    rejoin_latencies = []
+    cycle = 0
+    while not stop.is_set():
+        # The churners are the last members of each room
+        room_name, members = lanes[cycle % len(lanes)]
+        index = len(members) - churners + (cycle // len(lanes)) % churners
+        member = members[index]
+        if not crash:
+            member.sock.sendto(member.payload("__LEAVE__", legacy), server)
+        member.sock.close()
+        began = time.perf_counter()
+        username = f"{member.username.split('~')[0]}~{cycle}" if crash else member.username
+        # A rejoin racing its own __LEAVE__ (still on its way from the UDP
+        # worker in sharded mode) is answered as failed; clients retry
+        for _ in range(3):
+            fresh = handshake(tcp_port, room_name, username)
+            if fresh is not None:
+                break
+            time.sleep(0.01)
+        if fresh is not None:
+            fresh.register(server)
+            rejoin_latencies.append(time.perf_counter() - began)
+            members[index] = fresh
+        cycle += 1
+        stop.wait(1.0 / rate)
+    rejoin_latencies.sort()
+    stats["churn_cycles"] = cycle
+    stats["rejoin_p50_ms"] = round(percentile(rejoin_latencies, 0.50) * 1e3, 2) if rejoin_latencies else None
+    stats["rejoin_p99_ms"] = round(percentile(rejoin_latencies, 0.99) * 1e3, 2) if rejoin_latencies else None
+
+class Heartbeats:
+    # What client/udp_client.py does for an idle member, every `interval`.
+    # Real clients' heartbeats are spread out; sending everyone's at once
+    # overflows the server's receive buffer the same way every round, so
+    # they go out REGISTER_BATCH at a time. Driven from the receiving
+    # thread: a separate thread waits for the GIL on every sendto() and
+    # falls behind the session timeout.
+    def __init__(self, room_members, server, interval, legacy):
+        self.room_members = room_members
+        self.server = server
+        self.interval = interval
+        self.legacy = legacy
+        self.queue = []
+        self.next_round = time.monotonic() + interval
+
+    def send_due(self):
+        if not self.queue:
+            if time.monotonic() < self.next_round:
+                return
+            self.next_round += self.interval
+            self.queue = [m for members in self.room_members.values() for m in members]
+        batch, self.queue = self.queue[:REGISTER_BATCH], self.queue[REGISTER_BATCH:]
+        for member in batch:
+            try:
+                member.sock.sendto(member.payload("__HEARTBEAT__", self.legacy), self.server)
+            except OSError:
+                pass   # closed by a churner
+
+def run_scenario(name, params, args):
+    result = {"scenario": name, "tcp_engine": args.tcp_engine, "udp_engine": args.udp_engine,
+              "workers": args.workers, "format": "legacy" if args.legacy else "session",
+              "coalesce_ms": args.coalesce_ms, **params}
+    metrics_port = free_port()
+    with tempfile.TemporaryDirectory() as workdir:
+        proc, tcp_port, udp_port = start_server(workdir, args.tcp_engine, args.udp_engine, args.workers, args.coalesce_ms,
+                                                params["session_timeout"], metrics_port, params["rate_limit"])
+        try:
+            # TCP_Create_Join_Client reports progress with print()
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                room_members, join_stats = setup_rooms(tcp_port, params["rooms"], params["members"],
+                                                       params["join_concurrency"])
+                result.update(join_stats)
+                result.update(run_traffic(proc, tcp_port, ("127.0.0.1", udp_port), metrics_port, room_members, params,
+                                          args.legacy))
+        finally:
+            stop_server(proc)
+    return result
+
+def run_traffic(proc, tcp_port, server, metrics_port, room_members, params, legacy):
+    # A burst of REGISTERs overflows the server's receive buffer like any
+    # other burst; pace them and send each twice (re-registering is a no-op)
+    everyone = [member for members in room_members.values() for member in members]
+    for repeat in range(2):
+        for start in range(0, len(everyone), REGISTER_BATCH):
+            for member in everyone[start:start + REGISTER_BATCH]:
+                if repeat:
+                    member.sock.sendto(build_udp_payload(member.room_name, member.token, "__REGISTER__"), server)
+                else:
+                    member.register(server)
+            time.sleep(0.01)
+    time.sleep(0.5)
+
+    # Receivers: every member except the host, the churners and the flooder
+    churners = params["churners"]
+    hosts = [members[0] for members in room_members.values()]
+    flooder = next(iter(room_members.values()))[-1] if params["flood_rate"] else None
+    recipients = {}
+    selector = selectors.DefaultSelector()
+    for members in room_members.values():
+        stable = [m for m in members[1:len(members) - churners] if m is not flooder]
+        recipients[members[0].room_name] = len(stable)
+        for member in stable:
+            member.sock.setblocking(False)
+            selector.register(member.sock, selectors.EVENT_READ)
+
+    cpu_before, _, _ = server_usage(proc.pid)
+    wall_started = time.monotonic()
+    parent_conn, child_conn = multiprocessing.Pipe()
+    sender = multiprocessing.Process(target=run_senders, args=(
+        hosts, server, params["rate"], params["duration"], params["size"], legacy, child_conn))
+    sender.start()
+    flood = None
+    if flooder:
+        flood_conn, flood_child_conn = multiprocessing.Pipe()
+        flood = multiprocessing.Process(target=run_flood, args=(
+            flooder, server, params["flood_rate"], params["duration"], legacy, flood_child_conn))
+        flood.start()
+
+    stop = threading.Event()
+    churn_stats = {}
+    churn_thread = None
+    if churners:
+        churn_thread = threading.Thread(target=run_churn, args=(
+            room_members, churners, tcp_port, server, params["churn_rate"], legacy, params["crash"], stop, churn_stats))
+        churn_thread.start()
+    heartbeats = Heartbeats(room_members, server, params["session_timeout"] / 3, legacy) if params["session_timeout"] else None
+
+    latencies = []
+    datagrams = 0
+    flood_delivered = 0
+    quiet_since = None
+    sender_result = None
+    stale = []
+    next_scrape = time.monotonic()
+    while True:
+        events = selector.select(0.05)
+        if heartbeats:
+            heartbeats.send_due()
+        if time.monotonic() >= next_scrape:
+            # Sessions the server holds beyond the clients that exist
+            live = sum(len(members) for members in room_members.values())
+            stale.append(scrape(metrics_port).get("chat_tokens", 0) - live)
+            next_scrape += 0.5
+        now = time.monotonic_ns()
+        for key, _ in events:
+            sock = key.fileobj
+            while True:
+                try:
+                    data = sock.recv(65536)
+                except BlockingIOError:
+                    break
+                datagrams += 1
+                try:
+                    for _, message in iter_udp_messages(data):
+                        if message.startswith("F "):
+                            flood_delivered += 1
+                            continue
+                        latencies.append(now - int(message.split(" ", 1)[0]))
+                except ValueError:
+                    pass   # __ROOM_CLOSED__ or anything not sent by us
+        if sender_result is None and parent_conn.poll():
+            sender_result = parent_conn.recv()
+            stop.set()
+        if sender_result is not None:
+            if events:
+                quiet_since = None
+            elif quiet_since is None:
+                quiet_since = time.monotonic()
+            elif time.monotonic() - quiet_since >= SETTLE_SECONDS:
+                break
+    sender.join()
+    flood_stats = {}
+    if flood:
+        flood.join()
+        flood_recipients = recipients[flooder.room_name]
+        samples = scrape(metrics_port)
+        flood_stats = {
+            "flood_sent": flood_conn.recv(),
+            "flood_delivered_per_member": flood_delivered // flood_recipients if flood_recipients else 0,
+            "rate_limited_address": int(metric_total(samples, "chat_udp_rejected_total", reason="rate_limited_address")),
+            "rate_limited_token": int(metric_total(samples, "chat_udp_rejected_total", reason="rate_limited_token")),
+        }
+    if churn_thread:
+        churn_thread.join()
+    wall = time.monotonic() - wall_started - SETTLE_SECONDS
+    cpu_after, rss_kb, peak_rss_kb = server_usage(proc.pid)
+    if params["crash"] and heartbeats:
+        # Give the last crashed sessions time to expire
+        deadline = time.monotonic() + params["session_timeout"] + 1.5
+        while time.monotonic() < deadline:
+            heartbeats.send_due()
+            time.sleep(0.01)
+        stale.append(scrape(metrics_port).get("chat_tokens", 0) - sum(len(m) for m in room_members.values()))
+    selector.close()
+    for members in room_members.values():
+        for member in members:
+            member.sock.close()
+
+    sent_per_room, send_seconds = sender_result
+    sent = sum(sent_per_room)
+    expected = sum(count * recipients[host.room_name] for count, host in zip(sent_per_room, hosts))
+    delivered = len(latencies)
+    latencies.sort()
+
+    def latency_ms(fraction):
+        return round(percentile(latencies, fraction) / 1e6, 3) if latencies else None
+
+    return {
+        "sent": sent,
+        "send_rate": round(sent / send_seconds) if send_seconds else 0,
+        "expected_deliveries": expected,
+        "delivered": delivered,
+        "datagrams_received": datagrams,
+        "loss_pct": round(100.0 * (1 - delivered / expected), 3) if expected else 0.0,
+        "deliveries_per_sec": round(delivered / wall) if wall > 0 else 0,
+        "latency_p50_ms": latency_ms(0.50),
+        "latency_p99_ms": latency_ms(0.99),
+        "latency_p999_ms": latency_ms(0.999),
+        "latency_max_ms": latency_ms(1.0),
+        "server_cpu_pct": round(100.0 * (cpu_after - cpu_before) / wall, 1) if wall > 0 else None,
+        "server_rss_kb": rss_kb,
+        "server_peak_rss_kb": peak_rss_kb,
+        "stale_sessions_max": int(max(stale)) if stale else None,
+        "stale_sessions_end": int(stale[-1]) if stale else None,
+        **churn_stats,
+        **flood_stats,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end load test against server/server.py")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"comma separated: {', '.join(SCENARIOS)}")
+    parser.add_argument("--tcp-engine", default="asyncio")
+    parser.add_argument("--udp-engine", default="threaded")
+    parser.add_argument("--workers", type=int, default=1, help="UDP worker processes (> 1 = sharded)")
+    parser.add_argument("--legacy", action="store_true", help="send room name + token packets instead of session ids")
+    parser.add_argument("--coalesce-ms", type=float, default=0, help="server outbound coalescing window; 0 = off")
+    parser.add_argument("--rooms", type=int, help="override the scenario's room count")
+    parser.add_argument("--members", type=int, help="override the scenario's members per room (besides the host)")
+    parser.add_argument("--rate", type=float, help="override the scenario's messages per second")
+    parser.add_argument("--duration", type=float, help="override the scenario's seconds of sending")
+    parser.add_argument("--size", type=int, help="message body bytes")
+    parser.add_argument("--session-timeout", type=float, help="server idle session timeout in seconds; 0 = never")
+    parser.add_argument("--rate-limit", type=float, help="server per-client rate limit in packets/s; 0 = off")
+    parser.add_argument("--output", help="append JSON lines to this file as well")
+    args = parser.parse_args()
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    for name in args.scenarios.split(","):
+        params = {**DEFAULTS, **SCENARIOS[name.strip()]}
+        for key in ("rooms", "members", "rate", "duration", "size", "session_timeout", "rate_limit"):
+            if getattr(args, key) is not None:
+                params[key] = getattr(args, key)
+        result = run_scenario(name.strip(), params, args)
+        line = json.dumps(result)
+        print(line, flush=True)
+        if args.output:
+            with open(args.output, 'a') as f:
+                f.write(line + "\n")
+
+if __name__ == "__main__":
+    main()
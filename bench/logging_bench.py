@@ -0,0 +1,102 @@
+import argparse
+import contextlib
+import os
+import socket
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, 'server'))
+
+import logger
+from protocol.ucrp import build_udp_payload
+from room_manager import RoomManager
+from udp_server import UDP_Chat_Server
+
+# Per-packet cost of logging on the relay path at each log level:
+# "statements_us" is the three per-packet log statements alone, as the relay
+# makes them; "handle_packet_us" is a whole relay of one chat message into a
+# small room, for scale. The reference is the three print() calls per packet
+# the relay used to make. Output goes to /dev/null, so only the cost paid by
+# the relay thread is measured; a terminal or pipe makes print() far slower.
+
+def setup(members):
+    room_manager = RoomManager()
+    sinks = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for _ in range(members)]
+    for sink in sinks:
+        sink.bind(("127.0.0.1", 0))
+        sink.setblocking(False)
+    ok, host_token = room_manager.create_room("bench", "host", None)
+    room_manager.register_address(host_token, sinks[0].getsockname())
+    for i, sink in enumerate(sinks[1:]):
+        ok, token = room_manager.join_room("bench", f"user{i}", None)
+        room_manager.register_address(token, sink.getsockname())
+    server = UDP_Chat_Server("127.0.0.1", 0, room_manager)
+    server.bind()
+    return server, host_token, sinks
+
+def drain(sinks):
+    for sink in sinks:
+        while True:
+            try:
+                sink.recv(65536)
+            except BlockingIOError:
+                break
+
+def measure(server, packet, address, sinks, packets):
+    total = 0.0
+    batch = 200
+    for _ in range(packets // batch):
+        started = time.perf_counter()
+        for _ in range(batch):
+            server.handle_packet(packet, address)
+        total += time.perf_counter() - started
+        drain(sinks)
+    return total / (packets // batch * batch) * 1e6
+
+def measure_statements(log, address, packets):
+    token = "token_" + "ab" * 16
+    started = time.perf_counter()
+    for _ in range(packets):
+        if log.debug_enabled:
+            log.debug("[Received] UDP packet", address=address, size=64, hot="received")
+        if log.debug_enabled:
+            log.debug("[Processing received] %r", "hello", room="bench", token=token, address=address, hot="processing")
+        if log.debug_enabled:
+            log.debug("[Sent] %r: %d sent, %d failed", "host", 4, 0, room="bench", token=token, hot="relay")
+    return (time.perf_counter() - started) / packets * 1e6
+
+def measure_prints(packet, address, packets, devnull):
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(devnull):
+        for _ in range(packets):
+            print(f"[Received] UDP packet: {address} size={len(packet)}")
+            print(f"[Processing received] Room: bench, Token: token_ab..., Message: hello")
+            print(f"[Sent] 'host' -> room 'bench': 4 sent, 0 failed")
+    return (time.perf_counter() - started) / packets * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description="Relay per-packet cost by log level")
+    parser.add_argument("--members", type=int, default=5)
+    parser.add_argument("--packets", type=int, default=20000)
+    args = parser.parse_args()
+
+    with open(os.devnull, 'w') as devnull:
+        logger.configure("warning", stream=devnull)
+        server, token, sinks = setup(args.members)
+        address = sinks[0].getsockname()
+        packet = build_udp_payload("bench", token, "hello")
+
+        for level in ("debug", "info", "warning"):
+            logger.configure(level, stream=devnull)
+            statements_us = measure_statements(logger.get_logger("bench"), address, args.packets)
+            us = measure(server, packet, address, sinks, args.packets)
+            print(f"level={level} statements_us={statements_us:.3f} handle_packet_us={us:.2f}")
+        logger.configure("warning", stream=devnull)
+        print_us = measure_prints(packet, address, args.packets, devnull)
+        print(f"reference=print statements_us={print_us:.3f}")
+        logger.shutdown()
+
+if __name__ == "__main__":
+    main()
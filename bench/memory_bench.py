@@ -0,0 +1,78 @@
+import argparse
+import contextlib
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(os.path.join(ROOT, 'server'))
+
+from room_manager import RoomManager
+
+# Bytes per session held by RoomManager, measured with tracemalloc.
+# "dict" rebuilds the dict-per-record layout (a 5-key dict per token, a dict
+# per room) with the same indexes from the same inputs; "slots" is the
+# current RoomManager with Session/Room records.
+
+PER_ROOM = 50
+
+def _inputs(sessions):
+    for i in range(sessions):
+        yield f"room{i // PER_ROOM}", f"user{i % PER_ROOM}", ("10.0.0.1", 20000 + i % 40000)
+
+def build_dicts(sessions):
+    # Same lookup indexes as RoomManager, so only the record layout differs
+    rooms = {}
+    tokens = {}
+    address_index = {}
+    session_ids = {}
+    manager = RoomManager()
+    for room_name, username, address in _inputs(sessions):
+        token = manager.generate_token()
+        room = rooms.get(room_name)
+        if room is None:
+            room = rooms[room_name] = {"host_token": token, "members": {}, "created_at": time.time(), "users": {}}
+        room["members"][token] = None
+        room["users"][username] = token
+        session_id = manager.generate_session_id(room_name)
+        tokens[token] = {"username": username, "room_name": room_name, "is_host": room["host_token"] == token,
+                         "address": address, "session_id": session_id}
+        address_index[address] = token
+        session_ids[session_id] = token
+    return rooms, tokens, address_index, session_ids
+
+def build_slots(sessions):
+    manager = RoomManager()
+    for room_name, username, address in _inputs(sessions):
+        if not manager.room_exists(room_name):
+            manager.create_room(room_name, username, address)
+        else:
+            manager.join_room(room_name, username, address)
+    return manager
+
+def measure(builder, sessions):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        state = builder(sessions)
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del state
+    return (after - before) / sessions
+
+def main():
+    parser = argparse.ArgumentParser(description="RoomManager memory per session")
+    parser.add_argument("--sessions", type=int, default=200000)
+    args = parser.parse_args()
+
+    dict_bytes = measure(build_dicts, args.sessions)
+    slot_bytes = measure(build_slots, args.sessions)
+    print(f"sessions={args.sessions} dict_bytes_per_session={dict_bytes:.0f} "
+          f"slots_bytes_per_session={slot_bytes:.0f} saved_pct={100 * (1 - slot_bytes / dict_bytes):.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import selectors
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, 'client'))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from protocol.ucrp import iter_udp_messages
+from protocol.reliable import is_ack_payload
+from udp_client import UDP_Chat_Client
+from load_bench import start_server, stop_server, handshake, percentile
+
+# Delivery under packet loss, with and without reliable delivery.
+#
+# One room on a real server/server.py; the host and every member talk to
+# the server through a lossy UDP shim that drops each datagram, in both
+# directions, with the given probability. The members are
+# client/udp_client.UDP_Chat_Client instances, so the client side of the
+# reliable layer is the one users run. The host sends --messages messages
+# at --rate per second; each member records which arrived and how long
+# they took. The shim only starts dropping once everyone is registered.
+#
+# Reported per loss rate and mode: delivered fraction, duplicates, latency
+# percentiles, and the datagrams the shim carried (data vs ACK) as the
+# cost of reliability.
+
+SETTLE_SECONDS = 2.0   # quiet period that ends the drain after the last send
+
+class Lossy_Shim:
+    # Relays datagrams between clients and the server through one upstream
+    # socket per client, so the server sees a distinct address per client
+    def __init__(self, server, seed=1):
+        self.server = server
+        self.loss = 0.0
+        self.random = random.Random(seed)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.address = self.sock.getsockname()
+        self.upstream = {}     # client addr -> socket towards the server
+        self.clients = {}      # upstream socket -> client addr
+        self.counts = dict(data=0, acks=0, dropped=0)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ)
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _forward(self, data, sock, addr):
+        if is_ack_payload(data):
+            self.counts["acks"] += 1
+        else:
+            self.counts["data"] += 1
+        if self.loss and self.random.random() < self.loss:
+            self.counts["dropped"] += 1
+            return
+        sock.sendto(data, addr)
+
+    def _run(self):
+        while self.running:
+            for key, _ in self.selector.select(0.1):
+                sock = key.fileobj
+                try:
+                    data, addr = sock.recvfrom(65536)
+                except OSError:
+                    continue
+                if sock is self.sock:
+                    up = self.upstream.get(addr)
+                    if up is None:
+                        up = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                        up.bind(("127.0.0.1", 0))
+                        self.upstream[addr] = up
+                        self.clients[up] = addr
+                        self.selector.register(up, selectors.EVENT_READ)
+                    self._forward(data, up, self.server)
+                else:
+                    self._forward(data, self.sock, self.clients[sock])
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        for sock in [self.sock, *self.upstream.values()]:
+            sock.close()
+
+class Recording_Client(UDP_Chat_Client):
+    # Records deliveries instead of printing them
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.seen = {}
+        self.duplicates = 0
+        self.latencies = []
+
+    def deliver(self, data):
+        now = time.monotonic_ns()
+        for _, message in iter_udp_messages(data):
+            number, _, stamp = message.partition(" ")
+            if not number.isdigit():
+                continue
+            if number in self.seen:
+                self.duplicates += 1
+                continue
+            self.seen[number] = True
+            self.latencies.append((now - int(stamp)) / 1e6)
+
+def run_case(tcp_port, shim, room, params, reliable, loss):
+    shim.loss = 0.0
+    with contextlib.redirect_stdout(io.StringIO()):
+        joined = [handshake(tcp_port, room, "host", create=True)]
+        joined += [handshake(tcp_port, room, f"m{i}") for i in range(params["members"])]
+        clients = [Recording_Client(m.username, *shim.address, room, m.token, m.session_id, reliable) for m in joined]
+        for client in clients:
+            client.register()
+    for client in clients:
+        threading.Thread(target=client.receive_messages, daemon=True).start()
+    time.sleep(0.2)
+
+    before = dict(shim.counts)
+    shim.loss = loss
+    host, members = clients[0], clients[1:]
+    interval = 1.0 / params["rate"]
+    next_send = time.monotonic()
+    for i in range(params["messages"]):
+        host.send_packet(host.build_payload(f"{i} {time.monotonic_ns()}"))
+        next_send += interval
+        delay = next_send - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    expected = params["messages"]
+    last, last_change = -1, time.monotonic()
+    while time.monotonic() - last_change < SETTLE_SECONDS:
+        total = sum(len(m.seen) for m in members)
+        if total == expected * len(members):
+            break
+        if total != last:
+            last, last_change = total, time.monotonic()
+        time.sleep(0.05)
+
+    counts = {k: shim.counts[k] - before[k] for k in before}
+    shim.loss = 0.0
+    with contextlib.redirect_stdout(io.StringIO()):
+        # Members first: the host leaving closes the room
+        for client in members + [host]:
+            client.stop()
+
+    latencies = sorted(l for m in members for l in m.latencies)
+    delivered = sum(len(m.seen) for m in members)
+    return {
+        "loss": loss,
+        "reliable": reliable and all(c.stream is not None for c in clients),
+        "delivered": round(delivered / (expected * len(members)), 5),
+        "duplicates": sum(m.duplicates for m in members),
+        "latency_ms_p50": percentile(latencies, 0.5),
+        "latency_ms_p99": percentile(latencies, 0.99),
+        "latency_ms_max": latencies[-1] if latencies else None,
+        "datagrams": counts["data"],
+        "acks": counts["acks"],
+        "shim_dropped": counts["dropped"],
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Delivery under packet loss with and without reliable UCRP")
+    parser.add_argument("--loss", default="0,0.01,0.05,0.2", help="comma separated drop probabilities")
+    parser.add_argument("--modes", default="plain,reliable", help="comma separated: plain, reliable")
+    parser.add_argument("--members", type=int, default=8, help="members besides the host")
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--rate", type=float, default=500, help="messages per second from the host")
+    parser.add_argument("--tcp-engine", default="asyncio")
+    parser.add_argument("--udp-engine", default="threaded")
+    parser.add_argument("--workers", type=int, default=1, help="UDP worker processes (> 1 = sharded)")
+    parser.add_argument("--coalesce-ms", type=float, default=0, help="server outbound coalescing window; 0 = off")
+    parser.add_argument("--output", help="append JSON lines to this file as well")
+    args = parser.parse_args()
+    params = dict(members=args.members, messages=args.messages, rate=args.rate)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        proc, tcp_port, udp_port = start_server(workdir, args.tcp_engine, args.udp_engine, args.workers, args.coalesce_ms)
+        shim = Lossy_Shim(("127.0.0.1", udp_port))
+        try:
+            case = 0
+            for loss in (float(l) for l in args.loss.split(",")):
+                for mode in args.modes.split(","):
+                    case += 1
+                    result = run_case(tcp_port, shim, f"bench{case}", params, mode.strip() == "reliable", loss)
+                    line = json.dumps({"mode": mode.strip(), **result})
+                    print(line, flush=True)
+                    if args.output:
+                        with open(args.output, 'a') as f:
+                            f.write(line + "\n")
+        finally:
+            shim.stop()
+            stop_server(proc)
+
+if __name__ == "__main__":
+    main()
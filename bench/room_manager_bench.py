@@ -0,0 +1,57 @@
+import argparse
+import contextlib
+import os
+import sys
+import timeit
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(os.path.join(ROOT, 'server'))
+
+from room_manager import RoomManager
+
+# Micro-benchmark for RoomManager lookups on the relay and join paths.
+# Each lookup targets the most recently joined member, the worst case for a
+# linear scan, so a flat ns/op column across sizes means O(1).
+
+def build_room(members):
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        room_manager = RoomManager()
+        room_manager.create_room("bench", "host", ("127.0.0.1", 10000))
+        token = None
+        for i in range(members):
+            _, token = room_manager.join_room("bench", f"user{i}", ("127.0.0.1", 10001 + i))
+    return room_manager, token, f"user{members - 1}", ("127.0.0.1", 10000 + members)
+
+def measure(members, number):
+    room_manager, token, username, address = build_room(members)
+    cases = {
+        "validate": lambda: room_manager.validate_token_and_address(token, "bench"),
+        "find_user": lambda: room_manager.find_user_token_in_room("bench", username),
+        "find_address": lambda: room_manager.find_token_by_address(address),
+    }
+    result = {"members": members}
+    for name, func in cases.items():
+        seconds = min(timeit.repeat(func, number=number, repeat=5))
+        result[f"{name}_ns"] = round(seconds / number * 1e9)
+
+    # Join then leave one extra member; each copies the member dict (copy-on-write, see room_manager.py)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        def join_leave():
+            _, extra = room_manager.join_room("bench", "extra", ("127.0.0.1", 9999))
+            room_manager.delete_room_if_host_left("bench", extra)
+        seconds = min(timeit.repeat(join_leave, number=number // 10, repeat=5))
+    result["join_leave_ns"] = round(seconds / (number // 10) * 1e9)
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="RoomManager lookup cost versus room size")
+    parser.add_argument("--sizes", default="10,100,1000,10000")
+    parser.add_argument("--number", type=int, default=100000)
+    args = parser.parse_args()
+
+    for size in args.sizes.split(","):
+        result = measure(int(size), args.number)
+        print(" ".join(f"{k}={v}" for k, v in result.items()))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter, deque
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, 'server'))
+
+from protocol.tcrp import OP_CREATE_ROOM, OP_JOIN_ROOM, STATE_REQUEST
+from protocol.ucrp import build_session_payload
+import logger
+from room_manager import RoomManager
+from tcp_server import TCP_Create_Join_Server
+from udp_server import UDP_Chat_Server
+from load_bench import percentile
+
+# Concurrency stress for RoomManager, in one process with the real handlers.
+#
+# --handshake-threads threads answer create and join requests through
+# TCP_Create_Join_Server.handle_request, as the threaded TCP engine does,
+# while one thread plays the UDP server: it registers the new sessions,
+# relays chat through UDP_Chat_Server.handle_packet (compact session
+# packets, so the real fan-out runs against real member lists), and makes
+# members and hosts leave, which closes rooms under the handshake threads.
+# A third kind of thread reads like the metrics endpoint and the journal
+# snapshot do. Relayed datagrams go to loopback ports nobody listens on.
+#
+# Reported: operations done, exceptions by type and where they were
+# raised, RoomManager index inconsistencies found afterwards, and relay
+# and join latency percentiles (relays must not stall behind joins).
+
+REGISTER_BACKLOG = 100   # issued sessions not yet registered before handshakes wait
+REGISTER_BATCH = 10      # REGISTERs the UDP thread handles between relays
+
+def check_invariants(room_manager):
+    problems = Counter()
+    rooms = room_manager.rooms
+    tokens = room_manager.tokens
+    for token, info in tokens.items():
+        room = rooms.get(info.room_name)
+        if room is None:
+            problems["token_without_room"] += 1
+            continue
+        if token not in room.members:
+            problems["token_not_member"] += 1
+        if room.users.get(info.username) != token:
+            problems["users_index"] += 1
+        if room_manager.session_ids.get(info.session_id) != token:
+            problems["session_index"] += 1
+        if info.address is not None and room_manager.address_index.get(info.address) != token:
+            problems["address_index"] += 1
+    for room_name, room in rooms.items():
+        if room.host_token not in tokens:
+            problems["room_without_host"] += 1
+        problems["member_without_token"] += sum(1 for token in room.members if token not in tokens)
+    problems["dangling_session_id"] += sum(1 for token in room_manager.session_ids.values() if token not in tokens)
+    problems["dangling_address"] += sum(1 for token in room_manager.address_index.values() if token not in tokens)
+    return {name: count for name, count in problems.items() if count}
+
+class Stress:
+    def __init__(self, args):
+        self.args = args
+        self.room_manager = RoomManager()
+        self.tcp = TCP_Create_Join_Server("127.0.0.1", 0, self.room_manager)
+        self.udp = UDP_Chat_Server("127.0.0.1", 0, self.room_manager, session_timeout=0)
+        self.udp.bind()
+        self.running = True
+        self.errors = Counter()
+        self.counts = Counter()
+        self.issued = deque()          # (room_name, token, address) waiting for REGISTER
+        self.registered = []           # (room_name, token, session_id, address)
+        self.next_port = 20000
+        self.port_lock = threading.Lock()
+        self.join_latencies = []
+        self.relay_latencies = []
+
+    def address(self):
+        with self.port_lock:
+            self.next_port += 1
+            port = self.next_port
+        return ("127.0.0.%d" % (2 + port // 60000), 1024 + port % 60000)
+
+    def error(self, where, e):
+        self.errors[f"{where}: {type(e).__name__}"] += 1
+
+    def handshakes(self, seed):
+        rng = random.Random(seed)
+        latencies = []
+        counts = Counter()
+        tokens = self.room_manager.tokens
+        while self.running:
+            if len(tokens) >= self.args.max_sessions or len(self.issued) >= REGISTER_BACKLOG:
+                # Leaves make room; keeps rooms at a size a relay can fan out to
+                time.sleep(0.0005)
+                continue
+            room_name = f"room{rng.randrange(self.args.rooms)}"
+            op = OP_CREATE_ROOM if rng.random() < 0.1 else OP_JOIN_ROOM
+            username = json.dumps(f"user{rng.randrange(1 << 30)}")
+            address = self.address()
+            started = time.perf_counter()
+            try:
+                response = self.tcp.handle_request(op, STATE_REQUEST, room_name, username, address, request_id=1)
+            except Exception as e:
+                with self.port_lock:
+                    self.error("handle_request", e)
+                continue
+            latencies.append(time.perf_counter() - started)
+            token = json.loads(response[response.index(b'{"token"'):])["token"]
+            if token:
+                counts["created" if op == OP_CREATE_ROOM else "joined"] += 1
+                self.issued.append((room_name, token, address))
+        with self.port_lock:
+            self.join_latencies.extend(latencies)
+            self.counts.update(counts)
+
+    def udp_thread(self):
+        rng = random.Random(0)
+        udp = self.udp
+        tokens = self.room_manager.tokens
+        while self.running:
+            for _ in range(min(len(self.issued), REGISTER_BATCH)):
+                room_name, token, address = self.issued.popleft()
+                try:
+                    udp.process_message(room_name, token, "__REGISTER__", address)
+                except Exception as e:
+                    self.error("register", e)
+                    continue
+                info = tokens.get(token)
+                if info is not None:
+                    self.registered.append((room_name, token, info.session_id, address))
+            if not self.registered:
+                time.sleep(0.0005)
+                continue
+            i = rng.randrange(len(self.registered))
+            room_name, token, session_id, address = self.registered[i]
+            if token not in tokens:
+                # Gone with its room
+                self.registered[i] = self.registered[-1]
+                self.registered.pop()
+                continue
+            if rng.random() < self.args.leave_fraction:
+                self.registered[i] = self.registered[-1]
+                self.registered.pop()
+                try:
+                    udp.process_message(room_name, token, "__LEAVE__", address)
+                    self.counts["left"] += 1
+                except Exception as e:
+                    self.error("leave", e)
+                continue
+            started = time.perf_counter()
+            try:
+                udp.handle_packet(build_session_payload(session_id.to_bytes(8, 'big'), "stress"), address)
+                self.counts["relayed"] += 1
+            except Exception as e:
+                self.error("relay", e)
+            self.relay_latencies.append(time.perf_counter() - started)
+            udp.run_timers(time.monotonic())
+
+    def reader_thread(self):
+        # What the metrics endpoint, the cluster gossip and a snapshot read
+        room_manager = self.room_manager
+        while self.running:
+            try:
+                len(room_manager.rooms), len(room_manager.tokens), len(room_manager.address_index)
+                list(room_manager.rooms)
+                room_manager.export_rooms()
+                room_manager.export_tokens()
+                self.counts["snapshots"] += 1
+            except Exception as e:
+                self.error("snapshot", e)
+            time.sleep(0.001)
+
+    def run(self):
+        threads = [threading.Thread(target=self.handshakes, args=(i,)) for i in range(self.args.handshake_threads)]
+        threads.append(threading.Thread(target=self.udp_thread))
+        threads.append(threading.Thread(target=self.reader_thread))
+        for thread in threads:
+            thread.start()
+        time.sleep(self.args.duration)
+        self.running = False
+        for thread in threads:
+            thread.join()
+        self.udp.stop()
+        self.join_latencies.sort()
+        self.relay_latencies.sort()
+        ms = lambda values, fraction: round(percentile(values, fraction) * 1e3, 3) if values else None
+        return {
+            "handshake_threads": self.args.handshake_threads, "rooms": self.args.rooms, "duration": self.args.duration,
+            **self.counts, "open_rooms": len(self.room_manager.rooms), "sessions": len(self.room_manager.tokens),
+            "errors": dict(self.errors), "inconsistencies": check_invariants(self.room_manager),
+            "join_p50_ms": ms(self.join_latencies, 0.5), "join_p99_ms": ms(self.join_latencies, 0.99),
+            "relay_p50_ms": ms(self.relay_latencies, 0.5), "relay_p99_ms": ms(self.relay_latencies, 0.99),
+            "relay_max_ms": ms(self.relay_latencies, 1.0),
+        }
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent join, leave and relay against one RoomManager")
+    parser.add_argument("--handshake-threads", type=int, default=8)
+    parser.add_argument("--rooms", type=int, default=20, help="room names the handshakes pick from")
+    parser.add_argument("--max-sessions", type=int, default=2000, help="handshakes wait while this many are open")
+    parser.add_argument("--leave-fraction", type=float, default=0.2, help="UDP operations that are a leave")
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--switch-interval", type=float, default=0.0001,
+                        help="sys.setswitchinterval; smaller interleaves threads more often")
+    parser.add_argument("--output", help="append JSON lines to this file as well")
+    args = parser.parse_args()
+
+    logger.configure("error")
+    sys.setswitchinterval(args.switch_interval)
+    line = json.dumps(Stress(args).run())
+    print(line, flush=True)
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write(line + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+import argparse
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+import timeit
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(os.path.join(ROOT, 'server'))
+
+import logger
+from room_manager import RoomManager
+from journal import Journal
+from sqlite_state import SQLite_State, SQLite_State_Reader, SCHEMA, STATE_DB
+
+# State backends (server/journal.py, server/sqlite_state.py) against
+# RoomManager's dicts alone.
+#
+#   mutations: the same seeded mix of creates, joins, registers and leaves
+#   through RoomManager with no backend, the journal, SQLite, and SQLite
+#   committing every event on its own (what batching saves). "caller" is
+#   what the TCP and UDP threads pay; "durable" includes the wait for the
+#   backend to write everything (close()).
+#
+#   lookups: token, address, session id and room member lookups on a state
+#   of --sessions sessions, in RoomManager's dicts, through
+#   SQLite_State_Reader with its cache warm, and with the cache off (one
+#   indexed SQL query per lookup), as another process would read them.
+
+def operations(count, seed=0):
+    # [(op, args)], replayed identically against every backend
+    rng = random.Random(seed)
+    return [(rng.random(), rng.randrange(1 << 30)) for _ in range(count)]
+
+def run_mutations(room_manager, ops):
+    live = []
+    rooms = 0
+    for i, (r, n) in enumerate(ops):
+        if r < 0.1 or not live:
+            ok, token = room_manager.create_room(f"room{rooms}", f"host{n}", None)
+            rooms += 1
+            live.append(token)
+        elif r < 0.55:
+            info = room_manager.tokens.get(live[n % len(live)])
+            if info is None:
+                continue
+            ok, token = room_manager.join_room(info.room_name, f"user{n}", None)
+            if ok:
+                live.append(token)
+        elif r < 0.9:
+            address = ("10.0.%d.%d" % (n >> 8 & 255, n & 255), 40000 + n % 1000)
+            room_manager.register_address(live[n % len(live)], address)
+        else:
+            token = live[n % len(live)]
+            info = room_manager.tokens.get(token)
+            if info is not None:
+                room_manager.delete_room_if_host_left(info.room_name, token)
+        if i % 1000 == 999:
+            # Tokens that left stay picked until here, and their operations are no-ops
+            live = [token for token in live if token in room_manager.tokens]
+
+class Unbatched_SQLite(SQLite_State):
+    # One transaction per event, applied on the caller's thread
+    def attach(self, room_manager):
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        room_manager.add_listener(self.record)
+
+    def record(self, event, data):
+        self.seq += 1
+        with self.conn:
+            self._apply(self.conn, event, data)
+
+    def close(self):
+        self.conn.close()
+
+def measure_mutations(count, workdir):
+    ops = operations(count)
+    results = []
+    backends = {"dicts": None, "journal": Journal, "sqlite": SQLite_State, "sqlite_unbatched": Unbatched_SQLite}
+    for name, backend in backends.items():
+        os.chdir(tempfile.mkdtemp(dir=workdir))
+        room_manager = RoomManager()
+        state = None
+        if backend is not None:
+            state = backend()
+            state.restore(room_manager)
+            state.attach(room_manager)
+        started = time.perf_counter()
+        run_mutations(room_manager, ops)
+        caller = time.perf_counter() - started
+        if state is not None:
+            state.close()
+        durable = time.perf_counter() - started
+        results.append({"phase": "mutations", "backend": name, "operations": count,
+                        "sessions_left": len(room_manager.tokens),
+                        "caller_ops_per_sec": round(count / caller), "durable_ops_per_sec": round(count / durable)})
+    return results
+
+def measure_lookups(sessions, number, workdir):
+    os.chdir(tempfile.mkdtemp(dir=workdir))
+    room_manager = RoomManager()
+    state = SQLite_State()
+    state.restore(room_manager)
+    state.attach(room_manager)
+    for i in range(sessions // 10):
+        ok, host = room_manager.create_room(f"room{i}", "host", None)
+        for j in range(9):
+            room_manager.join_room(f"room{i}", f"user{j}", None)
+    for i, token in enumerate(list(room_manager.tokens)):
+        room_manager.register_address(token, ("10.%d.%d.%d" % (i >> 16 & 255, i >> 8 & 255, i & 255), 40000))
+    state.close()
+
+    rng = random.Random(1)
+    picks = rng.sample(list(room_manager.tokens), min(1000, len(room_manager.tokens)))
+    keys = [(token, room_manager.tokens[token]) for token in picks]
+
+    def cases(prefix, session, by_address, by_session_id, members):
+        def cycle(lookup, key):
+            # Round-robin over the picked sessions, so a cache sees a hot set of 1000
+            index = [0]
+            def call():
+                i = index[0] = (index[0] + 1) % len(keys)
+                lookup(key(*keys[i]))
+            return call
+        return {
+            f"{prefix}_token": cycle(session, lambda token, info: token),
+            f"{prefix}_address": cycle(by_address, lambda token, info: info.address),
+            f"{prefix}_session_id": cycle(by_session_id, lambda token, info: info.session_id),
+            f"{prefix}_members": cycle(members, lambda token, info: info.room_name),
+        }
+
+    rooms = room_manager.rooms
+    cached = SQLite_State_Reader(STATE_DB)
+    uncached = SQLite_State_Reader(STATE_DB, cache_size=0)
+    all_cases = {}
+    all_cases.update(cases("dicts", room_manager.tokens.get, room_manager.find_token_by_address,
+                           room_manager.find_token_by_session_id, lambda room_name: list(rooms[room_name].members)))
+    all_cases.update(cases("cached", cached.session, cached.token_by_address, cached.token_by_session_id,
+                           cached.room_members))
+    all_cases.update(cases("sql", uncached.session, uncached.token_by_address, uncached.token_by_session_id,
+                           uncached.room_members))
+    result = {"phase": "lookups", "sessions": len(room_manager.tokens)}
+    for name, func in all_cases.items():
+        n = number if not name.startswith("sql") else number // 10
+        seconds = min(timeit.repeat(func, number=n, repeat=3))
+        result[f"{name}_per_sec"] = round(n / seconds)
+    cached.close()
+    uncached.close()
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="State backends versus RoomManager's dicts")
+    parser.add_argument("--operations", type=int, default=50000, help="mutations per backend")
+    parser.add_argument("--sessions", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--number", type=int, default=100000, help="lookups per case (a tenth for uncached SQL)")
+    parser.add_argument("--output", help="append JSON lines to this file as well")
+    args = parser.parse_args()
+
+    logger.configure("error")
+    lines = []
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        try:
+            for line in measure_mutations(args.operations, workdir):
+                print(json.dumps(line), flush=True)
+                lines.append(line)
+            for sessions in args.sessions:
+                line = measure_lookups(sessions, args.number, workdir)
+                print(json.dumps(line), flush=True)
+                lines.append(line)
+        finally:
+            os.chdir(cwd)
+    if args.output:
+        with open(args.output, 'a') as f:
+            for line in lines:
+                f.write(json.dumps(line) + "\n")
+
+if __name__ == "__main__":
+    main()
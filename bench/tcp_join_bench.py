@@ -0,0 +1,164 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, 'server'))
+
+from protocol.tcrp import TCRProtocol, OP_CREATE_ROOM, OP_JOIN_ROOM, STATE_REQUEST, STATE_COMPLETE
+
+# Joins per second against the TCRP server engines at increasing numbers of
+# concurrent clients. The server runs in its own process; clients are
+# coroutines here so that 5,000 of them do not need 5,000 threads.
+# --depth 0 opens a fresh connection per join (legacy one-shot TCRP);
+# --depth N keeps one connection per client and pipelines N joins per write.
+
+def _run_server(engine, port, conn):
+    from room_manager import RoomManager
+    from tcp_server import TCP_Create_Join_Server
+    from async_tcp_server import Async_TCP_Create_Join_Server
+
+    engines = {"threaded": TCP_Create_Join_Server, "asyncio": Async_TCP_Create_Join_Server}
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        server = engines[engine]("127.0.0.1", port, RoomManager())
+        server.bind()
+        if engine == "threaded":
+            server.socket.listen(4096)
+        threading.Thread(target=server.start, daemon=True).start()
+        conn.send("ready")
+        conn.recv()
+        server.stop()
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def _request(room_name, op, username, request_id=None):
+    room_bytes = room_name.encode('utf-8')
+    payload_obj = username if request_id is None else {"username": username, "request_id": request_id}
+    payload = json.dumps(payload_obj).encode('utf-8')
+    return TCRProtocol.encode_tcrp_header(len(room_bytes), op, STATE_REQUEST, len(payload)) + room_bytes + payload
+
+async def _read_frame(reader):
+    header = await reader.readexactly(TCRProtocol.HEADER_SIZE)
+    room_name_size, op, state, payload_size = TCRProtocol.decode_tcrp_header(header)
+    body = await reader.readexactly(room_name_size + payload_size)
+    return state, body[room_name_size:]
+
+async def _handshake(port, request):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    try:
+        writer.write(request)
+        await writer.drain()
+        await _read_frame(reader)
+        state, payload = await _read_frame(reader)
+        return state == STATE_COMPLETE and bool(json.loads(payload).get("token"))
+    finally:
+        writer.close()
+
+async def _pipelined(port, counter, depth):
+    ok = failed = 0
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    try:
+        while True:
+            batch = [i for _, i in zip(range(depth), counter)]
+            if not batch:
+                break
+            writer.write(b"".join(_request("bench", OP_JOIN_ROOM, f"user{i}", i) for i in batch))
+            await writer.drain()
+            for _ in batch:
+                await _read_frame(reader)
+                state, payload = await _read_frame(reader)
+                if state == STATE_COMPLETE and json.loads(payload).get("token"):
+                    ok += 1
+                else:
+                    failed += 1
+    finally:
+        writer.close()
+    return ok, failed
+
+async def _drive(port, concurrency, joins, depth):
+    await _handshake(port, _request("bench", OP_CREATE_ROOM, "host"))
+    counter = iter(range(joins))
+    ok = failed = 0
+
+    if depth:
+        started = time.perf_counter()
+        results = await asyncio.gather(*(_pipelined(port, counter, depth) for _ in range(concurrency)))
+        return sum(r[0] for r in results), sum(r[1] for r in results), time.perf_counter() - started
+
+    async def client():
+        nonlocal ok, failed
+        for i in counter:
+            try:
+                if await _handshake(port, _request("bench", OP_JOIN_ROOM, f"user{i}")):
+                    ok += 1
+                else:
+                    failed += 1
+            except (OSError, asyncio.IncompleteReadError):
+                failed += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return ok, failed, time.perf_counter() - started
+
+def _peak_rss_kb(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def run(engine, concurrency, joins, depth):
+    port = _free_port()
+    parent_conn, child_conn = multiprocessing.Pipe()
+    proc = multiprocessing.Process(target=_run_server, args=(engine, port, child_conn))
+    proc.start()
+    parent_conn.recv()
+    try:
+        ok, failed, elapsed = asyncio.run(_drive(port, concurrency, joins, depth))
+        peak_rss_kb = _peak_rss_kb(proc.pid)
+    finally:
+        parent_conn.send("stop")
+        proc.join(timeout=5)
+        if proc.is_alive():
+            proc.terminate()
+    return {
+        "engine": engine,
+        "concurrency": concurrency,
+        "depth": depth,
+        "joins": ok,
+        "failed": failed,
+        "seconds": round(elapsed, 3),
+        "joins_per_sec": round(ok / elapsed) if elapsed else 0,
+        "server_peak_rss_kb": peak_rss_kb,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="TCRP join throughput versus concurrent clients")
+    parser.add_argument("--engines", default="threaded,asyncio")
+    parser.add_argument("--concurrency", default="1,100,5000")
+    parser.add_argument("--joins", type=int, default=10000)
+    parser.add_argument("--depth", default="0", help="pipelined joins per write; 0 = one connection per join")
+    args = parser.parse_args()
+
+    for engine in args.engines.split(","):
+        for concurrency in args.concurrency.split(","):
+            for depth in args.depth.split(","):
+                result = run(engine.strip(), int(concurrency), max(args.joins, int(concurrency)), int(depth))
+                print(" ".join(f"{k}={v}" for k, v in result.items()))
+
+if __name__ == "__main__":
+    main()
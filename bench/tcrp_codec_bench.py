@@ -0,0 +1,85 @@
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(ROOT)
+
+from protocol.tcrp import TCRProtocol, TCRPDecoder, OP_JOIN_ROOM, STATE_REQUEST
+
+# Decoding cost of TCRP frames arriving on a socket: the original reader
+# (three blocking reads per frame, buffers grown with `buf += part`) against
+# TCRPDecoder (recv_into one bytearray, frames sliced out of a memoryview).
+# "small" is a pipelined stream of join requests; "large" is a few frames
+# with big payloads, where the quadratic concatenation shows.
+
+def legacy_recv_exactly(sock, size):
+    buf = b''
+    while len(buf) < size:
+        part = sock.recv(size - len(buf))
+        if not part:
+            raise ConnectionError("Connection lost (during reception)")
+        buf += part
+    return buf
+
+def legacy_receive(sock):
+    header = legacy_recv_exactly(sock, TCRProtocol.HEADER_SIZE)
+    room_name_size, op, state, payload_size = TCRProtocol.decode_tcrp_header(header)
+    room_name = legacy_recv_exactly(sock, room_name_size).decode('utf-8')
+    payload = legacy_recv_exactly(sock, payload_size).decode('utf-8')
+    return op, state, room_name, payload
+
+def decoder_receiver(max_payload_size):
+    decoder = TCRPDecoder(max_payload_size=max_payload_size)
+
+    def receive(sock):
+        while True:
+            frame = decoder.next_frame()
+            if frame is not None:
+                return frame
+            if not decoder.recv_from(sock):
+                raise ConnectionError("Connection lost (during reception)")
+    return receive
+
+def encode(room_name, payload):
+    room_bytes = room_name.encode('utf-8')
+    payload_bytes = payload.encode('utf-8')
+    return TCRProtocol.encode_tcrp_header(len(room_bytes), OP_JOIN_ROOM, STATE_REQUEST, len(payload_bytes)) + room_bytes + payload_bytes
+
+def measure(receive, stream, frames):
+    reader, writer = socket.socketpair()
+    sender = threading.Thread(target=writer.sendall, args=(stream,))
+    started = time.perf_counter()
+    sender.start()
+    for _ in range(frames):
+        receive(reader)
+    elapsed = time.perf_counter() - started
+    sender.join()
+    reader.close()
+    writer.close()
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description="TCRP frame decoding: legacy reader versus TCRPDecoder")
+    parser.add_argument("--small-frames", type=int, default=200000)
+    parser.add_argument("--large-frames", type=int, default=20)
+    parser.add_argument("--large-size", type=int, default=4 * 1024 * 1024)
+    args = parser.parse_args()
+
+    cases = {
+        "small": (encode("lobby", '{"username": "user", "request_id": 1}'), args.small_frames),
+        "large": (encode("lobby", "x" * args.large_size), args.large_frames),
+    }
+    for case, (frame, frames) in cases.items():
+        stream = frame * frames
+        for name, receive in (("legacy", legacy_receive), ("decoder", decoder_receiver(len(frame)))):
+            elapsed = measure(receive, stream, frames)
+            print(f"case={case} codec={name} frames={frames} frame_bytes={len(frame)} "
+                  f"seconds={elapsed:.3f} frames_per_sec={frames / elapsed:.0f} "
+                  f"mb_per_sec={len(stream) / elapsed / 1e6:.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+import argparse
+import contextlib
+import os
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, 'server'))
+
+from protocol.ucrp import build_udp_payload, parse_udp_payload, build_session_payload, parse_session_payload, SESSION_HEADER_SIZE
+from room_manager import RoomManager
+
+# Header bytes and server-side resolve cost per data packet: the legacy
+# room name + token packet (parse_udp_payload + validate_token_and_address)
+# against the compact session id packet (parse_session_payload + one
+# integer-keyed lookup + address check), as done before relaying.
+
+def setup(sessions, room_name):
+    room_manager = RoomManager()
+    room_manager.create_room(room_name, "host", ("127.0.0.1", 20000))
+    for i in range(sessions - 1):
+        room_manager.join_room(room_name, f"user{i}", ("127.0.0.1", 20001 + i))
+    return room_manager
+
+def resolve_legacy(room_manager, packet, address):
+    room_name, token, message = parse_udp_payload(packet)
+    is_valid, reason = room_manager.validate_token_and_address(token, room_name)
+    return is_valid
+
+def resolve_session(room_manager, packet, address):
+    session_id, message = parse_session_payload(packet)
+    token = room_manager.session_ids.get(session_id)
+    if token is None:
+        return False
+    return room_manager.tokens[token].address == address
+
+def measure(resolve, room_manager, packet, address, iterations):
+    started = time.perf_counter()
+    for _ in range(iterations):
+        resolve(room_manager, packet, address)
+    return (time.perf_counter() - started) / iterations * 1e9
+
+def main():
+    parser = argparse.ArgumentParser(description="UCRP legacy versus session id packets")
+    parser.add_argument("--room", default="general-discussion")
+    parser.add_argument("--sessions", type=int, default=1000)
+    parser.add_argument("--message", default="hello, world")
+    parser.add_argument("--iterations", type=int, default=500000)
+    args = parser.parse_args()
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        room_manager = setup(args.sessions, args.room)
+    token = next(iter(room_manager.tokens))
+    info = room_manager.tokens[token]
+    session_id = info.session_id.to_bytes(8, 'big')
+
+    legacy = build_udp_payload(args.room, token, args.message)
+    compact = build_session_payload(session_id, args.message)
+    body = len(args.message.encode('utf-8'))
+
+    for name, resolve, packet in (("legacy", resolve_legacy, legacy), ("session", resolve_session, compact)):
+        assert resolve(room_manager, packet, info.address)
+        ns = measure(resolve, room_manager, packet, info.address, args.iterations)
+        print(f"format={name} header_bytes={len(packet) - body} packet_bytes={len(packet)} resolve_ns={ns:.0f}")
+    assert len(compact) - body == SESSION_HEADER_SIZE
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+import argparse
+import contextlib
+import multiprocessing
+import os
+import select
+import socket
+import sys
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, 'server'))
+
+from protocol.ucrp import build_udp_payload
+
+# Throughput comparison of the UDP relay engines selectable in server/server.py
+# ("threaded", "asyncio", or "sharded:N" for N SO_REUSEPORT worker processes).
+# The server runs in its own process; this process plays one sender and
+# --members receivers per room and keeps at most --window messages in flight
+# per room so we measure relay capacity rather than kernel buffer overflow.
+
+def _make_server(engine, port, room_manager):
+    from udp_server import UDP_Chat_Server
+    from async_udp_server import Async_UDP_Chat_Server
+    from udp_shard import UDP_Shard_Supervisor
+
+    if engine.startswith("sharded:"):
+        return UDP_Shard_Supervisor("127.0.0.1", port, room_manager, int(engine.split(":")[1]))
+    engines = {"threaded": UDP_Chat_Server, "asyncio": Async_UDP_Chat_Server}
+    return engines[engine]("127.0.0.1", port, room_manager)
+
+def _run_server(engine, port, rooms, members, conn):
+    from room_manager import RoomManager
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        room_manager = RoomManager()
+        room_manager.save_to_json = lambda *args, **kwargs: True
+        server = _make_server(engine, port, room_manager)
+        server.bind()
+
+        room_tokens = {}
+        for r in range(rooms):
+            room_name = f"bench{r}"
+            _, host_token = room_manager.create_room(room_name, "sender", None)
+            room_tokens[room_name] = [host_token] + [
+                room_manager.join_room(room_name, f"member{i}", None)[1] for i in range(members)
+            ]
+        conn.send(room_tokens)
+        threading.Thread(target=server.start, daemon=True).start()
+        conn.recv()
+        server.stop()
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def _udp_socket():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    return sock
+
+def run_engine(engine, messages, rooms, members, window, size):
+    port = _free_port()
+    parent_conn, child_conn = multiprocessing.Pipe()
+    proc = multiprocessing.Process(target=_run_server, args=(engine, port, rooms, members, child_conn))
+    proc.start()
+    room_tokens = parent_conn.recv()
+    server_addr = ("127.0.0.1", port)
+
+    # Per room: [sender, payload, probe receiver, sent, delivered]
+    lanes = []
+    others = []
+    for room_name, tokens in room_tokens.items():
+        sender = _udp_socket()
+        sender.sendto(build_udp_payload(room_name, tokens[0], "__REGISTER__"), server_addr)
+        receivers = []
+        for token in tokens[1:]:
+            sock = _udp_socket()
+            sock.sendto(build_udp_payload(room_name, token, "__REGISTER__"), server_addr)
+            receivers.append(sock)
+        payload = build_udp_payload(room_name, tokens[0], "x" * size)
+        lanes.append([sender, payload, receivers[0], 0, 0])
+        others.extend(receivers[1:])
+    time.sleep(0.5)
+
+    # The first receiver of each room paces its sender; the rest are drained in a thread
+    stop = threading.Event()
+
+    def drain(socks):
+        while not stop.is_set():
+            ready, _, _ = select.select(socks, [], [], 0.2)
+            for sock in ready:
+                sock.recv(65536)
+
+    drainer = threading.Thread(target=drain, args=(others,), daemon=True)
+    if others:
+        drainer.start()
+
+    by_probe = {lane[2]: lane for lane in lanes}
+    per_room = messages // rooms
+    total = per_room * rooms
+    delivered = 0
+    started = last_delivery = time.perf_counter()
+    while delivered < total:
+        for lane in lanes:
+            sender, payload, _, sent, got = lane
+            while sent < per_room and sent - got < window:
+                sender.sendto(payload, server_addr)
+                sent += 1
+            lane[3] = sent
+        ready, _, _ = select.select(list(by_probe), [], [], 0.5)
+        if not ready:
+            # Whatever is still in flight was dropped
+            break
+        for probe in ready:
+            probe.recv(65536)
+            by_probe[probe][4] += 1
+            delivered += 1
+        last_delivery = time.perf_counter()
+    elapsed = last_delivery - started
+
+    stop.set()
+    if others:
+        drainer.join()
+    parent_conn.send("stop")
+    proc.join(timeout=5)
+    for lane in lanes:
+        lane[0].close()
+        lane[2].close()
+    for sock in others:
+        sock.close()
+
+    return {
+        "engine": engine,
+        "rooms": rooms,
+        "sent": sum(lane[3] for lane in lanes),
+        "delivered": delivered,
+        "loss_pct": round(100.0 * (1 - delivered / max(1, sum(lane[3] for lane in lanes))), 2),
+        "seconds": round(elapsed, 3),
+        "msgs_per_sec": round(delivered / elapsed) if elapsed else 0,
+        "datagrams_out_per_sec": round(delivered * members / elapsed) if elapsed else 0,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare UDP relay engine throughput on loopback")
+    parser.add_argument("--engines", default="threaded,asyncio", help="comma separated; sharded:N for N workers")
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--rooms", type=int, default=1)
+    parser.add_argument("--members", type=int, default=1, help="recipients per message")
+    parser.add_argument("--window", type=int, default=64, help="max messages in flight per room")
+    parser.add_argument("--size", type=int, default=64, help="message body bytes")
+    args = parser.parse_args()
+
+    for engine in args.engines.split(","):
+        result = run_engine(engine.strip(), args.messages, args.rooms, args.members, args.window, args.size)
+        print(" ".join(f"{k}={v}" for k, v in result.items()))
+
+if __name__ == "__main__":
+    main()
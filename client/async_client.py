@@ -0,0 +1,543 @@
+import asyncio
+import functools
+import json
+import os
+import random
+import secrets
+import socket
+import sys
+import time
+import zlib
+from collections import deque
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from protocol.tcrp import TCRPDecoder, OP_CREATE_ROOM, OP_JOIN_ROOM, STATE_COMPLIANCE, STATE_COMPLETE
+from protocol.ucrp import build_udp_payload, build_session_payload, iter_udp_messages
+from protocol.reliable import (ReliableStream, is_reliable_payload, parse_reliable_payload, is_ack_payload,
+                               parse_ack_payload, RELIABLE_HEADER_SIZE, TICK)
+from protocol.fragment import (Reassembler, build_fragments, is_relayed_fragment, parse_relayed_fragment,
+                               MAX_FRAGMENTED_MESSAGE)
+from protocol.compress import (Message_Codec, build_compressed_payload, parse_compressed_message,
+                               DICTIONARY_ID_SIZE)
+from tcp_client import encode_request, accept_compression, MAX_REDIRECTS
+from udp_client import (MAX_MESSAGE_SIZE, REGISTER_TIMEOUT, LEAVE_TIMEOUT, HEARTBEAT_INTERVAL, FRAGMENT_BURST,
+                        FRAGMENT_GAP)
+
+# The client side of TCRP and UCRP on an asyncio event loop, for programs
+# that run many sessions in one process (load generators, bots, bridges)
+# and for client.py.
+#
+#   session = await open_session(host, tcp_port, udp_port, "lobby", "alice")
+#   await session.send("hello")
+#   async for sender, message in session:
+#       ...
+#   await session.leave()
+#
+# The handshake (TCRP_Connection, handshake()) pipelines requests, so any
+# number of sessions can be set up over one connection. A Chat_Session
+# keeps UDP_Chat_Client's behaviour (reliable delivery, fragments,
+# compression, heartbeats) with timers on the loop instead of threads; a
+# room closing ends its iteration and sets room_closed.
+#
+# Every session gets a UDP socket of its own unless it registers on a
+# shared Chat_Endpoint (open_endpoint()). The server relays to addresses,
+# and a relayed datagram names neither the room nor the recipient, so what
+# arrives on a shared socket cannot be told apart by session: it is read
+# from the endpoint as one stream, with one copy per receiving session,
+# and room-closed notices are only counted. Reliable delivery is per
+# address and needs a socket of its own. A shared socket is also one
+# source address to the server's per-address rate limit.
+
+ROOM_CLOSED = b"__ROOM_CLOSED__"
+SHARED_RCVBUF = 4 * 1024 * 1024   # receive buffer of a shared endpoint, which takes every session's traffic
+CODEC_CACHE_SIZE = 256            # room dictionaries whose codec sessions share
+
+@functools.lru_cache(maxsize=CODEC_CACHE_SIZE)
+def codec_for(dictionary):
+    # A primed compressor is a few hundred KB; the sessions of a room share one
+    return Message_Codec(dictionary)
+
+class Ticket:
+    # What a successful create/join hands to the UDP session; server is
+    # the (host, port) to chat on, another node's after a cluster redirect
+    __slots__ = ("room_name", "username", "token", "session_id", "dictionary", "server")
+
+    def __init__(self, room_name, username, token, session_id=None, dictionary=None, server=None):
+        self.room_name = room_name
+        self.username = username
+        self.token = token
+        self.session_id = session_id
+        self.dictionary = dictionary
+        self.server = server
+
+class TCRP_Connection:
+    # One TCRP connection. Requests may be made concurrently: each is
+    # written as a pipelined frame as soon as it is made, and answers are
+    # matched back by request_id.
+    def __init__(self, reader, writer, compression=True, dictionaries=None):
+        self.reader = reader
+        self.writer = writer
+        self.compression = compression
+        # {crc32: bytes}, shared with the connections of a redirect
+        self.dictionaries = {} if dictionaries is None else dictionaries
+        self.decoder = TCRPDecoder()
+        self.next_request_id = 0
+        self.pending = {}   # request_id -> [future, success, room_name, username]
+        self.error = None
+        self.reader_task = asyncio.get_running_loop().create_task(self._read())
+
+    @classmethod
+    async def open(cls, host, port, compression=True, dictionaries=None):
+        reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer, compression, dictionaries)
+
+    async def close(self):
+        self.reader_task.cancel()
+        for entry in self.pending.values():
+            entry[0].cancel()
+        self.pending.clear()
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except OSError:
+            pass
+
+    async def create_room(self, room_name, username):
+        return await self.request(OP_CREATE_ROOM, room_name, username)
+
+    async def join_room(self, room_name, username):
+        return await self.request(OP_JOIN_ROOM, room_name, username)
+
+    async def request(self, op, room_name, username):
+        # (Ticket, None) on success; (None, redirect) if the server refused,
+        # redirect being the cluster node that owns the room, if any
+        if self.error is not None:
+            raise self.error
+        self.next_request_id += 1
+        request_id = self.next_request_id
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = [future, False, room_name, username]
+        self.writer.write(encode_request(op, room_name, username, request_id,
+                                         self.dictionaries if self.compression else None))
+        return await future
+
+    async def _read(self):
+        try:
+            while True:
+                data = await self.reader.read(65536)
+                if not data:
+                    raise ConnectionError("Connection lost (during reception)")
+                self.decoder.feed(data)
+                for _, state, _, payload in self.decoder.frames():
+                    self._answer(state, json.loads(payload))
+        except (OSError, ValueError) as e:
+            self.error = e if isinstance(e, ConnectionError) else ConnectionError(f"Processing error: {e}")
+            for entry in self.pending.values():
+                if not entry[0].done():
+                    entry[0].set_exception(self.error)
+            self.pending.clear()
+
+    def _answer(self, state, result):
+        entry = self.pending.get(result.get("request_id"))
+        if entry is None:
+            return
+        if state == STATE_COMPLIANCE:
+            entry[1] = bool(result.get("success", False))
+            return
+        if state != STATE_COMPLETE:
+            raise ValueError(f"Unexpected response state {state}")
+        del self.pending[result["request_id"]]
+        future, success, room_name, username = entry
+        token = result.get("token")
+        ticket = None
+        if success and token:
+            session_id = bytes.fromhex(result["session_id"]) if result.get("session_id") else None
+            checksum = accept_compression(result.get("compression"), self.dictionaries)
+            ticket = Ticket(room_name, username, token, session_id, self.dictionaries.get(checksum))
+        if not future.done():
+            future.set_result((ticket, result.get("redirect")))
+
+async def handshake(host, tcp_port, udp_port, room_name, username, create=False, compression=True, connection=None):
+    # A Ticket for room_name, or None if the server refused. Runs on
+    # connection if one is given (it stays open), else on a connection of
+    # its own; a cluster redirect is followed on a new connection.
+    op = OP_CREATE_ROOM if create else OP_JOIN_ROOM
+    server = (host, udp_port)
+    owned = connection is None
+    if owned:
+        connection = await TCRP_Connection.open(host, tcp_port, compression)
+    try:
+        for attempt in range(MAX_REDIRECTS + 1):
+            ticket, redirect = await connection.request(op, room_name, username)
+            if ticket is not None:
+                ticket.server = server
+                return ticket
+            if redirect is None or attempt == MAX_REDIRECTS:
+                return None
+            dictionaries = connection.dictionaries
+            if owned:
+                await connection.close()
+            owned = False
+            connection = await TCRP_Connection.open(redirect["host"], redirect["tcp_port"], compression, dictionaries)
+            owned = True
+            server = (redirect["host"], redirect["udp_port"])
+    finally:
+        if owned:
+            await connection.close()
+
+async def open_endpoint(shared=True, local_addr=("0.0.0.0", 0), on_message=None):
+    loop = asyncio.get_running_loop()
+    _, endpoint = await loop.create_datagram_endpoint(lambda: Chat_Endpoint(shared, on_message),
+                                                      local_addr=local_addr)
+    return endpoint
+
+async def open_session(host, tcp_port, udp_port, room_name, username, create=False, reliable=False,
+                       compression=True, endpoint=None, connection=None, on_message=None):
+    # Handshake, then REGISTER: a registered Chat_Session, or None if the server refused
+    ticket = await handshake(host, tcp_port, udp_port, room_name, username, create, compression, connection)
+    if ticket is None:
+        return None
+    session = Chat_Session(ticket, reliable, on_message)
+    await session.register(endpoint)
+    return session
+
+class Message_Stream:
+    # Relayed (sender, message) pairs, read with async for until the stream
+    # ends. With on_message they are handed to the callback instead of
+    # being queued. One reader at a time.
+    def __init__(self, on_message=None):
+        self.on_message = on_message
+        self.inbox = deque()
+        self.waiter = None
+        self.ended = False
+        self.fragments = Reassembler()
+        self.undecodable = 0
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self.inbox:
+            if self.ended:
+                raise StopAsyncIteration
+            self.waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self.waiter
+            finally:
+                self.waiter = None
+        return self.inbox.popleft()
+
+    def _put(self, sender, message):
+        if self.on_message is not None:
+            self.on_message(sender, message)
+            return
+        self.inbox.append((sender, message))
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    def _end(self):
+        self.ended = True
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    def _deliver(self, data, inflate):
+        try:
+            if is_relayed_fragment(data):
+                sender, message_id, index, count, chunk = parse_relayed_fragment(data)
+                message = self.fragments.add(sender, message_id, index, count, chunk, time.monotonic())
+                if message:
+                    self._put(sender, message.decode('utf-8', errors='replace'))
+                return
+            # One datagram may carry several messages when the server coalesces
+            for sender, message in iter_udp_messages(data, inflate):
+                self._put(sender, message)
+        except (ValueError, zlib.error):
+            self.undecodable += 1
+
+class Chat_Endpoint(asyncio.DatagramProtocol, Message_Stream):
+    # A UDP socket. A private one (shared=False) belongs to one session and
+    # passes it everything; a shared one is read as a Message_Stream of its
+    # own (see the top of this file).
+    def __init__(self, shared=True, on_message=None):
+        Message_Stream.__init__(self, on_message)
+        self.shared = shared
+        self.transport = None
+        self.session = None
+        self.sessions = set()
+        self.codecs = {}        # dictionary id -> Message_Codec of the sessions' rooms, None if ambiguous
+        self.rooms_closed = 0   # room-closed notices received (shared only)
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self.shared:
+            transport.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SHARED_RCVBUF)
+
+    def connection_lost(self, exc):
+        if self.session is not None:
+            self.session._close()
+        for session in list(self.sessions):
+            session._close()
+        self._end()
+
+    def error_received(self, exc):
+        # ICMP errors for an earlier sendto; UDP carries on
+        pass
+
+    def datagram_received(self, data, address):
+        if not self.shared:
+            if self.session is not None:
+                self.session._received(data)
+        elif data == ROOM_CLOSED:
+            self.rooms_closed += 1
+        else:
+            self._deliver(data, self._inflate if self.codecs else None)
+
+    def attach(self, session):
+        if not self.shared:
+            self.session = session
+            return
+        self.sessions.add(session)
+        codec = session.codec
+        if codec is None:
+            return
+        known = self.codecs.get(codec.id, codec)
+        if known is None or known.checksum != codec.checksum:
+            # Two rooms whose dictionaries share an id: a message cannot be
+            # told apart here, so neither is inflated rather than the wrong one
+            self.codecs[codec.id] = None
+        else:
+            self.codecs[codec.id] = codec
+
+    def detach(self, session):
+        if not self.shared:
+            self.session = None
+            self.transport.close()
+        else:
+            self.sessions.discard(session)
+
+    def close(self):
+        self.transport.close()
+
+    def _inflate(self, frame):
+        sender, body = parse_compressed_message(frame)
+        codec = self.codecs.get(int.from_bytes(body[:DICTIONARY_ID_SIZE], 'big'))
+        if codec is None:
+            raise ValueError("Message compressed with an unknown or ambiguous dictionary")
+        return sender, codec.inflate(body).decode('utf-8')
+
+class Chat_Session(Message_Stream):
+    def __init__(self, ticket, reliable=False, on_message=None):
+        super().__init__(on_message)
+        self.room_name = ticket.room_name
+        self.username = ticket.username
+        self.token = ticket.token
+        self.session_id = ticket.session_id
+        self.server = ticket.server
+        self.address = None
+        self.endpoint = None
+        self.registered = False
+        self.closed = False
+        self.room_closed = asyncio.Event()
+        self.reliable_lost = asyncio.Event()
+        self.last_sent = time.monotonic()
+        self.heartbeat = None
+
+        # Reliable delivery is negotiated in register(), and needs the
+        # session id so a sharded server can route our ACKs
+        self.stream = ReliableStream(ticket.session_id) if reliable and ticket.session_id else None
+        self.poll_handle = None
+
+        # Messages over one datagram go out as fragments (session id required)
+        self.next_message_id = secrets.randbits(32)
+
+        self.codec = codec_for(ticket.dictionary) if ticket.dictionary and ticket.session_id else None
+
+    @property
+    def reliable(self):
+        return self.stream is not None
+
+    @property
+    def local_address(self):
+        return self.endpoint.transport.get_extra_info('sockname')
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.leave()
+
+    def __aiter__(self):
+        if self.endpoint is not None and self.endpoint.shared:
+            raise RuntimeError("Sessions on a shared endpoint are read through the endpoint")
+        return self
+
+    async def register(self, endpoint=None):
+        # On a socket of its own unless a shared endpoint is given
+        if endpoint is not None and self.stream is not None:
+            raise ValueError("Reliable delivery needs an endpoint of its own")
+        host, port = self.server
+        try:
+            socket.inet_aton(host)
+            self.address = (host, port)
+        except OSError:
+            infos = await asyncio.get_running_loop().getaddrinfo(host, port, family=socket.AF_INET,
+                                                                 type=socket.SOCK_DGRAM)
+            self.address = infos[0][4]
+        self.endpoint = endpoint or await open_endpoint(shared=False)
+        self.endpoint.attach(self)
+
+        payload = build_udp_payload(self.room_name, self.token, "__REGISTER__")
+        self._send_packet(payload)
+        if self.stream is not None:
+            # The reliable REGISTER is seq 0; the server acknowledging it is the negotiation
+            deadline = time.monotonic() + REGISTER_TIMEOUT
+            while self.stream is not None and self.stream.unacked and time.monotonic() < deadline:
+                await asyncio.sleep(TICK)
+            if self.stream is None or self.stream.unacked:
+                self._drop_stream()
+                self._send_packet(payload)
+        self.registered = True
+        # Sessions registered together would heartbeat together; the first
+        # one lands anywhere in the second half of the interval
+        self.heartbeat = asyncio.get_running_loop().call_later(HEARTBEAT_INTERVAL * (0.5 + random.random() / 2),
+                                                               self._heartbeat)
+
+    async def send(self, message):
+        # Raises ValueError if the message is too large to send
+        if self.closed:
+            raise ConnectionError("Session is closed")
+        limit = MAX_MESSAGE_SIZE - (RELIABLE_HEADER_SIZE if self.stream else 0)
+        payload = self._payload(message)
+        if len(payload) <= limit:
+            # Compressed only when the plain message fits one datagram too:
+            # the server inflates it for members without compression
+            if self.codec is not None:
+                body = self.codec.compress(message.encode('utf-8'))
+                if body is not None:
+                    self._send_packet(build_compressed_payload(self.session_id, body))
+                    return
+            self._send_packet(payload)
+            return
+        data = message.encode('utf-8')
+        if not self.session_id or len(data) > MAX_FRAGMENTED_MESSAGE:
+            raise ValueError(f"Message exceeds {MAX_FRAGMENTED_MESSAGE if self.session_id else limit} bytes")
+        message_id = self.next_message_id
+        self.next_message_id = (message_id + 1) & 0xFFFFFFFF
+        for i, fragment in enumerate(build_fragments(self.session_id, message_id, data)):
+            if i and i % FRAGMENT_BURST == 0:
+                await asyncio.sleep(FRAGMENT_GAP)
+            if self.closed:
+                raise ConnectionError("Session is closed")
+            self._send_packet(fragment)
+
+    async def leave(self):
+        if self.closed:
+            return
+        self._send_packet(self._payload("__LEAVE__"))
+        # Retransmitted by the poll timer until the server acknowledges it
+        deadline = time.monotonic() + LEAVE_TIMEOUT
+        while self.stream is not None and self.stream.unacked and time.monotonic() < deadline:
+            await asyncio.sleep(TICK)
+        self._close()
+
+    def _payload(self, message):
+        # Registration always carries the full token; once the address is
+        # bound, the 8-byte session id replaces room name + token
+        if self.session_id:
+            return build_session_payload(self.session_id, message)
+        return build_udp_payload(self.room_name, self.token, message)
+
+    def _send_packet(self, payload):
+        self.last_sent = time.monotonic()
+        if self.stream is None:
+            self.endpoint.transport.sendto(payload, self.address)
+            return
+        datagram = self.stream.send(payload, self.last_sent)
+        if datagram is not None:
+            self.endpoint.transport.sendto(datagram, self.address)
+        self._schedule_poll()
+
+    def _received(self, data):
+        if self.stream is not None:
+            data = self._unwrap(data)
+            self._schedule_poll()
+            if data is None:
+                return
+        if data == ROOM_CLOSED:
+            if self.stream is not None:
+                self.stream.ack_at = time.monotonic()
+                self.endpoint.transport.sendto(self.stream.take_ack(self.stream.ack_at), self.address)
+            self._close(room_closed=True)
+            return
+        self._deliver(data, self.codec.parse_message if self.codec else None)
+
+    def _unwrap(self, data):
+        # ACKs and envelopes are consumed here; returns what is left to deliver
+        now = time.monotonic()
+        if is_ack_payload(data):
+            _, ack, sack = parse_ack_payload(data)
+            out = self.stream.on_ack(ack, sack, now)
+            packet = None
+        elif is_reliable_payload(data):
+            seq, packet = parse_reliable_payload(data)
+            if not self.stream.receive(seq, now):
+                packet = None
+            ack = self.stream.take_ack(now)
+            out = [ack] if ack else []
+        else:
+            packet = data
+            out = []
+        for datagram in out:
+            self.endpoint.transport.sendto(datagram, self.address)
+        return packet
+
+    def _schedule_poll(self):
+        # Retransmissions and delayed ACKs, checked every TICK while any are pending
+        if self.poll_handle is None and self.stream is not None and not self.stream.idle():
+            self.poll_handle = asyncio.get_running_loop().call_later(TICK, self._poll)
+
+    def _poll(self):
+        self.poll_handle = None
+        if self.stream is None or self.closed:
+            return
+        for datagram in self.stream.poll(time.monotonic()):
+            self.endpoint.transport.sendto(datagram, self.address)
+        if self.stream.failed:
+            # The server stopped acknowledging; carry on without it
+            self._drop_stream()
+            if self.registered:
+                self.reliable_lost.set()
+            return
+        self._schedule_poll()
+
+    def _drop_stream(self):
+        self.stream = None
+        if self.poll_handle is not None:
+            self.poll_handle.cancel()
+            self.poll_handle = None
+
+    def _heartbeat(self):
+        # The server expires sessions that go silent, so an idle session
+        # sends __HEARTBEAT__ now and then
+        self.heartbeat = None
+        if self.closed:
+            return
+        if time.monotonic() - self.last_sent >= HEARTBEAT_INTERVAL:
+            self._send_packet(self._payload("__HEARTBEAT__"))
+        delay = max(TICK, self.last_sent + HEARTBEAT_INTERVAL - time.monotonic())
+        self.heartbeat = asyncio.get_running_loop().call_later(delay, self._heartbeat)
+
+    def _close(self, room_closed=False):
+        if self.closed:
+            return
+        self.closed = True
+        if self.heartbeat is not None:
+            self.heartbeat.cancel()
+            self.heartbeat = None
+        if self.poll_handle is not None:
+            self.poll_handle.cancel()
+            self.poll_handle = None
+        if room_closed:
+            self.room_closed.set()
+        self.endpoint.detach(self)
+        self._end()
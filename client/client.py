@@ -1,10 +1,11 @@
+import asyncio
 import os
 import sys
+import threading
 
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
-from tcp_client import TCP_Create_Join_Client
-from udp_client import UDP_Chat_Client
+from async_client import TCRP_Connection, Chat_Session, handshake
 
 def prompt_valid_input(prompt_text):
     while True:
@@ -14,12 +15,33 @@ def prompt_valid_input(prompt_text):
             continue
         return value
 
+def stdin_lines():
+    # Lines typed at the terminal, as an asyncio.Queue (None at EOF). The
+    # reader is a daemon thread, so a chat that ends while it waits on
+    # input does not hold the process open.
+    loop = asyncio.get_running_loop()
+    lines = asyncio.Queue()
+
+    def read():
+        while True:
+            line = sys.stdin.readline()
+            try:
+                loop.call_soon_threadsafe(lines.put_nowait, line or None)
+            except RuntimeError:
+                # The chat is over and its loop closed
+                return
+            if not line:
+                return
+
+    threading.Thread(target=read, daemon=True).start()
+    return lines
+
 class Client:
-    def __init__(self, server_ip, tcp_port, udp_port):
+    def __init__(self, server_ip, tcp_port, udp_port, reliable=False):
         self.server_ip = server_ip
         self.tcp_port = tcp_port
         self.udp_port = udp_port
-        self.tcp_client = TCP_Create_Join_Client(server_ip, tcp_port)
+        self.reliable = reliable
 
     def run(self):
         try:
@@ -47,28 +69,35 @@ class Client:
     def _handle_room_operation(self, choice):
         room_name = prompt_valid_input("Enter room name: ")
         username = prompt_valid_input("Enter username: ")
+        return asyncio.run(self.chat(choice, room_name, username))
 
+    async def chat(self, choice, room_name, username):
         print(f"\n--- TCP Connection Phase ---")
-        if not self.tcp_client.connect():
+        try:
+            connection = await TCRP_Connection.open(self.server_ip, self.tcp_port)
+        except OSError as e:
+            print(f"Cannot connect to server: {e}")
             print("[Error] TCP connection failed")
             return False
+        print(f"TCP connection successful")
 
-        success = False
         if choice == '1':
             print(f"Creating room '{room_name}'...")
-            success = self.tcp_client.create_room(room_name, username)
-        elif choice == '2':
+        else:
             print(f"Joining room '{room_name}'...")
-            success = self.tcp_client.join_room(room_name, username)
+        try:
+            ticket = await handshake(self.server_ip, self.tcp_port, self.udp_port, room_name, username,
+                                     create=choice == '1', connection=connection)
+        except OSError as e:
+            print(f"Processing error: {e}")
+            ticket = None
+        finally:
+            await connection.close()
 
-        if not success:
+        if ticket is None:
             print("[Error] Failed to obtain token")
-            self.tcp_client.disconnect()
             return False
-
-        token = self.tcp_client.get_token()
         print("Token obtained successfully")
-        self.tcp_client.disconnect()
         print("TCP connection disconnected")
 
         print(f"\n--- UDP Connection Phase ---")
@@ -76,17 +105,61 @@ class Client:
         print(f"User: {username}")
         print(f"Status: {'Entered as room creator' if choice == '1' else 'Joined room'}")
 
-        udp_client = UDP_Chat_Client(
-            username=username,
-            server_ip=self.server_ip,
-            server_port=self.udp_port,
-            room_name=room_name,
-            token=token
-        )
-        udp_client.start()
-
+        # In a cluster, ticket.server is the node the room lives on
+        session = Chat_Session(ticket, reliable=self.reliable)
+        await session.register()
+        if self.reliable and not session.reliable:
+            print("[Reliable delivery] Not supported by the server; continuing without it")
+        ip, port = session.local_address
+        print()
+        print(f"[Registration complete] My address: {ip}:{port}" + (" (reliable delivery)" if session.reliable else ""))
+        print()
+        print("=== Chat started === (Press Ctrl+C or type exit/q to quit)")
+
+        tasks = [asyncio.ensure_future(coro) for coro in
+                 (self.show_messages(session), self.send_lines(session), self.watch_reliable(session))]
+        try:
+            await asyncio.wait(tasks[:2], return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            print("\nEnding chat")
+        finally:
+            for task in tasks:
+                task.cancel()
+            if session.room_closed.is_set():
+                print(f"\n[System notification] Chat ending because the host of room '{room_name}' has left")
+            elif not session.closed:
+                await session.leave()
+                print("[Leave notification] Sent leave message to server")
         return True
 
+    async def show_messages(self, session):
+        async for sender, message in session:
+            if sender != session.username:
+                print(f"{sender}: {message}")
+                print("> ", end="", flush=True)
+
+    async def send_lines(self, session):
+        lines = stdin_lines()
+        while True:
+            print("> ", end="", flush=True)
+            line = await lines.get()
+            if line is None:
+                break
+            msg = line.strip()
+            if not msg:
+                continue
+            if msg.lower() in ["exit", "quit", "q"]:
+                print("Ending chat")
+                break
+            try:
+                await session.send(msg)
+            except ValueError as e:
+                print(f"Error: {e}")
+
+    async def watch_reliable(self, session):
+        await session.reliable_lost.wait()
+        print("\n[Reliable delivery] Server stopped acknowledging; continuing without it")
+
 def main():
     try:
         server_ip = input("Server address (default: 127.0.0.1): ").strip() or "127.0.0.1"
@@ -97,7 +170,9 @@ def main():
         udp_port_input = input("UDP port number (default: 9091): ").strip()
         udp_port = int(udp_port_input) if udp_port_input else 9091
 
-        client = Client(server_ip, tcp_port, udp_port)
+        reliable = input("Reliable delivery (y/N): ").strip().lower() in ("y", "yes")
+
+        client = Client(server_ip, tcp_port, udp_port, reliable)
         client.run()
 
     except ValueError:
@@ -1,22 +1,67 @@
+import base64
 import json
 import os
 import socket
 import sys
 
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
-from protocol.tcrp import TCRProtocol, OP_CREATE_ROOM, OP_JOIN_ROOM, STATE_REQUEST, STATE_COMPLIANCE, STATE_COMPLETE
+from protocol.tcrp import (TCRProtocol, TCRPDecoder, OP_CREATE_ROOM, OP_JOIN_ROOM, STATE_REQUEST, STATE_COMPLIANCE,
+                           STATE_COMPLETE, EXTENDED_FRAMES)
+from protocol.compress import CODEC_ZLIB, dictionary_checksum
+
+MAX_REDIRECTS = 3   # cluster nodes tried after the first before giving up
+
+def encode_request(op, room_name, username, request_id, dictionaries=None):
+    # One pipelined create/join frame; compression is offered when
+    # dictionaries ({crc32: bytes} already held) is given. The UDP clients
+    # here read batches and fragments, so every request says so
+    room_name_bytes = room_name.encode('utf-8')
+    request = {"username": username, "request_id": request_id, "frames": EXTENDED_FRAMES}
+    if dictionaries is not None:
+        request["compression"] = {"codecs": [CODEC_ZLIB], "dictionaries": list(dictionaries)}
+    payload_bytes = json.dumps(request).encode('utf-8')
+    header = TCRProtocol.encode_tcrp_header(len(room_name_bytes), op, STATE_REQUEST, len(payload_bytes))
+    return header + room_name_bytes + payload_bytes
+
+def accept_compression(compression, dictionaries):
+    # The crc32 of the dictionary a successful answer negotiated, None
+    # without one; a dictionary sent along is added to dictionaries
+    if not compression or compression.get("codec") != CODEC_ZLIB:
+        return None
+    if "dictionary" in compression:
+        dictionary = base64.b64decode(compression["dictionary"])
+        checksum = dictionary_checksum(dictionary)
+        dictionaries[checksum] = dictionary
+        return checksum
+    checksum = compression.get("dictionary_crc32")
+    return checksum if checksum in dictionaries else None
 
 class TCP_Create_Join_Client:
-    def __init__(self, host='localhost', port=9090):
+    def __init__(self, host='localhost', port=9090, compression=True):
         self.host = host
         self.port = port
         self.client_socket = None
         self.token = None
+        self.session_id = None
+        self.session_ids = {}
+        # Offer compression; the server answers with the room's dictionary,
+        # sent only if we do not have it yet ({crc32: bytes})
+        self.compression = compression
+        self.dictionary = None
+        self.dictionaries = {}
+        self.dictionary_checksums = {}
+        self.next_request_id = 0
+        self.decoder = None
+        # Cluster mode: room name -> the node a server sent us to, and the
+        # UDP endpoint of the node that finally answered (None if not moved)
+        self.redirects = {}
+        self.udp_endpoint = None
 
     def connect(self):
         try:
             self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.client_socket.connect((self.host, self.port))
+            self.decoder = TCRPDecoder()
             print(f"TCP connection successful")
             return True
         except Exception as e:
@@ -38,32 +83,89 @@ class TCP_Create_Join_Client:
         op = OP_CREATE_ROOM if choice == '1' else OP_JOIN_ROOM
 
         try:
-            TCRProtocol.send_tcrp_message(
-                self.client_socket, room_name, op, STATE_REQUEST, username
-            )
-
-            op_c, state_c, room_c, payload_c = TCRProtocol.receive_tcrp_message(self.client_socket)
-            if state_c != STATE_COMPLIANCE:
-                print("Error receiving compliance response")
-                return False
-
-            compliance_result = json.loads(payload_c)
-            if not compliance_result.get("success", False):
-                print("Operation failed (server response)")
-                return False
-
-            op_f, state_f, room_f, payload_f = TCRProtocol.receive_tcrp_message(self.client_socket)
-            if state_f == STATE_COMPLETE:
-                complete_result = json.loads(payload_f)
-                self.token = complete_result.get("token")
-                return True
-            else:
-                print("Could not receive completion response")
-                return False
-
+            token = self.pipeline([(op, room_name, username)])[0]
+            for _ in range(MAX_REDIRECTS):
+                target = self.redirects.pop(room_name, None)
+                if token is not None or target is None:
+                    break
+                print(f"Room '{room_name}' is on node {target['node']} ({target['host']}:{target['tcp_port']}), reconnecting")
+                self.disconnect()
+                self.host, self.port = target["host"], target["tcp_port"]
+                if not self.connect():
+                    return False
+                self.udp_endpoint = (target["host"], target["udp_port"])
+                token = self.pipeline([(op, room_name, username)])[0]
         except Exception as e:
             print(f"Processing error: {e}")
             return False
 
+        if token is None:
+            print("Operation failed (server response)")
+            return False
+        self.token = token
+        self.session_id = self.session_ids.get(token)
+        self.dictionary = self.dictionaries.get(self.dictionary_checksums.get(token))
+        return True
+
+    def pipeline(self, requests):
+        # Sends every (op, room_name, username) request in one write on the
+        # open connection, then matches the answers back by request_id.
+        # Returns one token per request, None where the server refused; the
+        # compact UCRP session id of each token is kept in session_ids, and
+        # the crc32 of the compression dictionary, if negotiated, in
+        # dictionary_checksums.
+        # A cluster node's redirect for a room is kept in redirects.
+        # The connection stays open for further calls until disconnect().
+        request_ids = []
+        frames = []
+        for op, room_name, username in requests:
+            self.next_request_id += 1
+            request_ids.append(self.next_request_id)
+            frames.append(encode_request(op, room_name, username, self.next_request_id,
+                                         self.dictionaries if self.compression else None))
+        self.client_socket.sendall(b"".join(frames))
+
+        results = {}
+        successes = {}
+        while len(results) < len(request_ids):
+            op_r, state_r, room_r, payload_r = self._receive_frame()
+            result = json.loads(payload_r)
+            request_id = result.get("request_id")
+            if state_r == STATE_COMPLIANCE:
+                successes[request_id] = bool(result.get("success", False))
+            elif state_r == STATE_COMPLETE:
+                token = result.get("token")
+                results[request_id] = token if successes.pop(request_id, False) and token else None
+                if result.get("redirect"):
+                    self.redirects[room_r] = result["redirect"]
+                if results[request_id] and result.get("session_id"):
+                    self.session_ids[token] = bytes.fromhex(result["session_id"])
+                if results[request_id]:
+                    checksum = accept_compression(result.get("compression"), self.dictionaries)
+                    if checksum is not None:
+                        self.dictionary_checksums[token] = checksum
+            else:
+                raise ConnectionError(f"Unexpected response state {state_r}")
+        return [results.get(request_id) for request_id in request_ids]
+
+    def _receive_frame(self):
+        while True:
+            frame = self.decoder.next_frame()
+            if frame is not None:
+                return frame
+            if not self.decoder.recv_from(self.client_socket):
+                raise ConnectionError("Connection lost (during reception)")
+
     def get_token(self):
         return self.token
+
+    def get_session_id(self):
+        return self.session_id
+
+    def get_udp_endpoint(self):
+        # (host, port) to chat on when a cluster node redirected us, else None
+        return self.udp_endpoint
+
+    def get_dictionary(self):
+        # The room's compression dictionary, None if compression was not negotiated
+        return self.dictionary
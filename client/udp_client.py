@@ -1,61 +1,236 @@
 import os
+import secrets
 import socket
 import sys
 import threading
+import time
+import zlib
 
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
-from protocol.ucrp import build_udp_payload, parse_udp_message
+from protocol.ucrp import build_udp_payload, build_session_payload, iter_udp_messages
+from protocol.reliable import (ReliableStream, is_reliable_payload, parse_reliable_payload, is_ack_payload,
+                               parse_ack_payload, RELIABLE_HEADER_SIZE, TICK)
+from protocol.fragment import (Reassembler, build_fragments, is_relayed_fragment, parse_relayed_fragment,
+                               MAX_FRAGMENTED_MESSAGE)
+from protocol.compress import Message_Codec, build_compressed_payload
 
 MAX_MESSAGE_SIZE = 4096
+REGISTER_TIMEOUT = 2.0   # seconds to wait for the server to accept reliable delivery
+LEAVE_TIMEOUT = 1.0      # seconds to wait for __LEAVE__ to be acknowledged
+HEARTBEAT_INTERVAL = 15.0   # idle seconds before telling the server we are still here
+FRAGMENT_BURST = 16      # fragments sent back to back before pausing
+FRAGMENT_GAP = 0.002     # seconds between bursts, so a large message does not overrun the server's receive buffer
 
 class UDP_Chat_Client:
-    def __init__(self, username, server_ip, server_port, room_name, token):
+    def __init__(self, username, server_ip, server_port, room_name, token, session_id=None, reliable=False,
+                 dictionary=None):
         self.username = username
         self.server_ip = server_ip
         self.server_port = server_port
         self.room_name = room_name
         self.token = token
+        self.session_id = session_id
         self.running = True
 
+        # Reliable delivery is negotiated in register(). The session id is
+        # required so a sharded server can route our ACKs.
+        self.stream = ReliableStream(session_id) if reliable and session_id else None
+        self.stream_lock = threading.Lock()
+        self.next_poll = 0.0
+        self.last_sent = time.monotonic()
+
+        # Messages over one datagram go out as fragments (session id required)
+        self.next_message_id = secrets.randbits(32)
+        self.fragments = Reassembler()
+
+        # Compression negotiated over TCP: messages are sent compressed when
+        # that is smaller, and compressed messages from others are inflated
+        self.codec = Message_Codec(dictionary) if dictionary and session_id else None
+
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.sock.bind(("0.0.0.0", 0))
 
+    def build_payload(self, message):
+        # Registration always carries the full token; once the address is
+        # bound, the 8-byte session id replaces room name + token
+        if self.session_id:
+            return build_session_payload(self.session_id, message)
+        return build_udp_payload(self.room_name, self.token, message)
+
+    def send_packet(self, payload):
+        self.last_sent = time.monotonic()
+        if self.stream is None:
+            self.sock.sendto(payload, (self.server_ip, self.server_port))
+            return
+        with self.stream_lock:
+            datagram = self.stream.send(payload, time.monotonic())
+        if datagram is not None:
+            self.sock.sendto(datagram, (self.server_ip, self.server_port))
+
+    def send_message(self, message):
+        # Returns an error string if the message cannot be sent
+        limit = MAX_MESSAGE_SIZE - (RELIABLE_HEADER_SIZE if self.stream else 0)
+        payload = self.build_payload(message)
+        if len(payload) <= limit:
+            # Compressed only when the plain message fits one datagram too:
+            # the server inflates it for members without compression
+            if self.codec is not None:
+                body = self.codec.compress(message.encode('utf-8'))
+                if body is not None:
+                    self.send_packet(build_compressed_payload(self.session_id, body))
+                    return None
+            self.send_packet(payload)
+            return None
+        data = message.encode('utf-8')
+        if not self.session_id or len(data) > MAX_FRAGMENTED_MESSAGE:
+            return f"Error: Message exceeds {MAX_FRAGMENTED_MESSAGE if self.session_id else limit} bytes"
+        message_id = self.next_message_id
+        self.next_message_id = (message_id + 1) & 0xFFFFFFFF
+        for i, fragment in enumerate(build_fragments(self.session_id, message_id, data)):
+            if i and i % FRAGMENT_BURST == 0:
+                time.sleep(FRAGMENT_GAP)
+            self.send_packet(fragment)
+        return None
+
     def register(self):
         payload = build_udp_payload(self.room_name, self.token, "__REGISTER__")
-        self.sock.sendto(payload, (self.server_ip, self.server_port))
+        self.send_packet(payload)
+        if self.stream is not None and not self._await_register_ack():
+            print("[Reliable delivery] Not supported by the server; continuing without it")
+            self.stream = None
+            self.send_packet(payload)
         ip, port = self.sock.getsockname()
         print()
-        print(f"[Registration complete] My address: {ip}:{port}")
+        print(f"[Registration complete] My address: {ip}:{port}" + (" (reliable delivery)" if self.stream else ""))
         print()
 
+    def _await_register_ack(self):
+        # The reliable REGISTER is seq 0; the server acknowledging it is the
+        # negotiation. Anything relayed meanwhile is shown as usual.
+        deadline = time.monotonic() + REGISTER_TIMEOUT
+        self.sock.settimeout(TICK)
+        try:
+            while self.stream.unacked and time.monotonic() < deadline:
+                try:
+                    data, _ = self.sock.recvfrom(MAX_MESSAGE_SIZE)
+                except socket.timeout:
+                    data = None
+                if data:
+                    packet = self._unwrap(data)
+                    if packet:
+                        self.deliver(packet)
+                self._poll_stream()
+            return not self.stream.unacked
+        finally:
+            self.sock.settimeout(None)
+
+    def _unwrap(self, data):
+        # ACKs and envelopes are consumed here; returns what is left to deliver
+        now = time.monotonic()
+        with self.stream_lock:
+            if is_ack_payload(data):
+                _, ack, sack = parse_ack_payload(data)
+                out = self.stream.on_ack(ack, sack, now)
+                packet = None
+            elif is_reliable_payload(data):
+                seq, packet = parse_reliable_payload(data)
+                if not self.stream.receive(seq, now):
+                    packet = None
+                ack = self.stream.take_ack(now)
+                out = [ack] if ack else []
+            else:
+                packet = data
+                out = []
+        for datagram in out:
+            self.sock.sendto(datagram, (self.server_ip, self.server_port))
+        return packet
+
+    def _poll_stream(self):
+        now = time.monotonic()
+        if now < self.next_poll:
+            return
+        self.next_poll = now + TICK
+        with self.stream_lock:
+            out = self.stream.poll(now)
+            failed = self.stream.failed
+        for datagram in out:
+            self.sock.sendto(datagram, (self.server_ip, self.server_port))
+        if failed and self.running:
+            print("\n[Reliable delivery] Server stopped acknowledging; continuing without it")
+            self.stream = None
+            self.sock.settimeout(None)
+
+    def _ack_now(self):
+        with self.stream_lock:
+            self.stream.ack_at = time.monotonic()
+            ack = self.stream.take_ack(self.stream.ack_at)
+        self.sock.sendto(ack, (self.server_ip, self.server_port))
+
     def receive_messages(self):
+        if self.stream is not None:
+            # Wake up for retransmissions and delayed ACKs
+            self.sock.settimeout(TICK)
         while self.running:
             try:
-                data, _ = self.sock.recvfrom(MAX_MESSAGE_SIZE)
+                try:
+                    data, _ = self.sock.recvfrom(MAX_MESSAGE_SIZE)
+                except socket.timeout:
+                    data = None
+                if self.stream is not None:
+                    if data:
+                        data = self._unwrap(data)
+                    self._poll_stream()
                 if not data:
                     continue
+                self.deliver(data)
 
-                try:
-                    text = data.decode("utf-8")
-                    if text == "__ROOM_CLOSED__":
-                        print(f"\n[System notification] Chat ending because the host of room '{self.room_name}' has left")
-                        self.running = False
-                        self.sock.close()
-                        os._exit(0)
-                except UnicodeDecodeError:
-                    pass
-
-                sender, message = parse_udp_message(data)
-                if sender != self.username:
-                    print(f"{sender}: {message}")
-                    print("> ", end="", flush=True)
-                    
             except OSError as e:
                 if not self.running:
                     break
                 print(f"[Receive error] {e}")
                 break
 
+    def deliver(self, data):
+        try:
+            text = data.decode("utf-8")
+            if text == "__ROOM_CLOSED__":
+                print(f"\n[System notification] Chat ending because the host of room '{self.room_name}' has left")
+                if self.stream is not None:
+                    self._ack_now()
+                self.running = False
+                self.sock.close()
+                os._exit(0)
+        except UnicodeDecodeError:
+            pass
+
+        if is_relayed_fragment(data):
+            sender, message_id, index, count, chunk = parse_relayed_fragment(data)
+            message = self.fragments.add(sender, message_id, index, count, chunk, time.monotonic())
+            if message and sender != self.username:
+                print(f"{sender}: {message.decode('utf-8', errors='replace')}")
+                print("> ", end="", flush=True)
+            return
+
+        # One datagram may carry several messages when the server coalesces
+        try:
+            for sender, message in iter_udp_messages(data, self.codec.parse_message if self.codec else None):
+                if sender != self.username:
+                    print(f"{sender}: {message}")
+                    print("> ", end="", flush=True)
+        except (ValueError, zlib.error) as e:
+            print(f"\n[Receive error] Undecodable message: {e}")
+
+    def heartbeat_loop(self):
+        # The server expires sessions that go silent, so an idle client
+        # (reading, not typing) sends __HEARTBEAT__ now and then
+        while self.running:
+            time.sleep(max(0.0, self.last_sent + HEARTBEAT_INTERVAL - time.monotonic()))
+            if self.running and time.monotonic() - self.last_sent >= HEARTBEAT_INTERVAL:
+                try:
+                    self.send_packet(self.build_payload("__HEARTBEAT__"))
+                except OSError:
+                    break
+
     def send_loop(self):
         try:
             while self.running:
@@ -66,11 +241,9 @@ class UDP_Chat_Client:
                 if msg.lower() in ["exit", "quit", "q"]:
                     print("Ending chat")
                     break
-                payload = build_udp_payload(self.room_name, self.token, msg)
-                if len(payload) > MAX_MESSAGE_SIZE:
-                    print("Error: Message exceeds 4096 bytes")
-                    continue
-                self.sock.sendto(payload, (self.server_ip, self.server_port))
+                error = self.send_message(msg)
+                if error:
+                    print(error)
         except KeyboardInterrupt:
             print("\nEnding chat")
         finally:
@@ -79,6 +252,7 @@ class UDP_Chat_Client:
     def start(self):
         self.register()
         threading.Thread(target=self.receive_messages, daemon=True).start()
+        threading.Thread(target=self.heartbeat_loop, daemon=True).start()
         print("=== Chat started === (Press Ctrl+C or type exit/q to quit)")
         self.send_loop()
 
@@ -86,9 +260,13 @@ class UDP_Chat_Client:
         if not self.running:
             return
         try:
-            payload = build_udp_payload(self.room_name, self.token, "__LEAVE__")
-            self.sock.sendto(payload, (self.server_ip, self.server_port))
+            payload = self.build_payload("__LEAVE__")
+            self.send_packet(payload)
             print("[Leave notification] Sent leave message to server")
+            # The receiver thread retransmits it until the server acknowledges
+            deadline = time.monotonic() + LEAVE_TIMEOUT
+            while self.stream is not None and self.stream.unacked and time.monotonic() < deadline:
+                time.sleep(TICK)
         except Exception as e:
             print(f"[Leave notification error] {e}")
         self.running = False
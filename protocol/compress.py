@@ -0,0 +1,145 @@
+import struct
+import zlib
+from collections import Counter
+
+from protocol.ucrp import UCRP_EXTENDED, SESSION_ID_SIZE
+
+# Optional per-message compression, negotiated in the TCRP handshake.
+#
+# A client that offers "zlib" in its join/create request gets the room's
+# dictionary in the COMPLETE response. It then sends a chat message
+# compressed whenever that is smaller than sending it as is:
+#
+#   client -> server  0x00, 0x85, session id (8 bytes), body
+#   server -> client  0x00, 0x85, [sender_len][sender], body
+#   body              dictionary id (2 bytes), raw deflate of the UTF-8 message
+#
+# The server swaps the session id for the sender like any compact packet
+# and relays the body as it is to members that negotiated compression too;
+# members that did not (Session.codec is None) get the message inflated,
+# as a plain frame. A relayed compressed frame may also sit
+# inside a batch datagram: a plain frame never starts with 0x00, so a
+# batched frame that does is an extended one.
+#
+# Each message is deflated on its own, primed with the room's preset
+# dictionary, so it can be read without any earlier message having
+# arrived. The dictionary id (crc32 & 0xFFFF) lets a receiver notice a
+# message compressed against a dictionary it does not have. Two different
+# dictionaries can share an id, so anything that stores dictionaries (the
+# handshake's "dictionaries" list, client caches) keys them on the full
+# crc32, dictionary_checksum(); the id only travels in the UDP body.
+
+KIND_COMPRESSED = 0x85
+CODEC_ZLIB = "zlib"
+
+COMPRESSED_HEADER_SIZE = 2 + SESSION_ID_SIZE
+DICTIONARY_ID_SIZE = 2
+DICTIONARY_SIZE = 4096    # trained dictionaries; deflate can use up to 32 KB
+COMPRESSION_LEVEL = 9     # messages are short, so the best level is still cheap
+
+_DICTIONARY_ID = struct.Struct('!H')
+
+# Words and phrases common in chat, least common first: deflate finds
+# matches near the end of the dictionary with the shortest distances.
+PRESET_DICTIONARY = (
+    "http://https://www..com/.org/.html.png.jpg github.com/ youtube.com/watch?v= "
+    "Traceback (most recent call last):\n  File \"line , in Error: error warning: "
+    "def return import from self None True False function const let var null undefined "
+    "Monday Tuesday Wednesday Thursday Friday Saturday Sunday tomorrow yesterday tonight "
+    "morning afternoon evening weekend meeting schedule minutes hours o'clock "
+    "please thank you thanks so much sorry about that no problem you're welcome "
+    "what do you think? how are you doing? what's up? did you see the "
+    "I don't know I'm not sure I think that I agree with you that makes sense "
+    "let me know if you have any questions can you send me the link "
+    "haha lol lmao omg btw idk imo tbh brb gtg np ty thx ok okay yeah yes no "
+    "good morning good night see you later talk to you soon have a good one "
+    "I'll be there in a few minutes on my way just a sec be right back "
+    "that's a good idea sounds good to me great job nice work awesome cool "
+    "anyone else having this problem? it works for me does it work now? "
+    "the and that have with this for not you are but was they will would there "
+    "what about which when just like about could should their been into more "
+    "I'm it's don't can't that's we're you're I'll I've isn't doesn't won't "
+).encode('utf-8')
+
+def dictionary_checksum(dictionary: bytes) -> int:
+    return zlib.crc32(dictionary)
+
+def dictionary_id(dictionary: bytes) -> int:
+    return dictionary_checksum(dictionary) & 0xFFFF
+
+def train_dictionary(samples, size=DICTIONARY_SIZE) -> bytes:
+    # A preset dictionary built from sample messages: the word runs (one to
+    # three words) that save the most bytes, count times length, packed
+    # until `size` with the best ones last. zlib has no trainer of its own;
+    # this gets most of what a trained zstd dictionary would on chat text.
+    counts = Counter()
+    for text in samples:
+        words = text.split()
+        for n in (1, 2, 3):
+            for i in range(len(words) - n + 1):
+                counts[" ".join(words[i:i + n])] += 1
+    ranked = sorted(((count * len(phrase.encode('utf-8')), phrase) for phrase, count in counts.items() if count > 1),
+                    reverse=True)
+    chosen = []
+    total = 0
+    for _, phrase in ranked:
+        encoded = (phrase + " ").encode('utf-8')
+        if total + len(encoded) > size:
+            continue
+        if any(phrase in longer for longer in chosen):
+            continue
+        chosen.append(phrase)
+        total += len(encoded)
+    return "".join(phrase + " " for phrase in reversed(chosen)).encode('utf-8')
+
+class Message_Codec:
+    # Compresses and inflates single messages against one room dictionary
+    def __init__(self, dictionary: bytes, level=COMPRESSION_LEVEL):
+        self.dictionary = dictionary
+        self.checksum = dictionary_checksum(dictionary)
+        self.id = self.checksum & 0xFFFF
+        self.prefix = _DICTIONARY_ID.pack(self.id)
+        # Priming a compressor with the dictionary costs more than
+        # compressing a message; copy() reuses a primed one
+        self.primed = zlib.compressobj(level, zlib.DEFLATED, -15, 9, zlib.Z_DEFAULT_STRATEGY, dictionary)
+
+    def compress(self, data: bytes):
+        # The body to send, or None when compressing would not save bytes
+        compressor = self.primed.copy()
+        body = self.prefix + compressor.compress(data) + compressor.flush()
+        return body if len(body) < len(data) else None
+
+    def inflate(self, body: bytes, max_length=0) -> bytes:
+        # max_length caps the inflated size (0: no cap)
+        if _DICTIONARY_ID.unpack_from(body)[0] != self.id:
+            raise ValueError("Message compressed with a different dictionary")
+        inflater = zlib.decompressobj(-15, self.dictionary)
+        data = inflater.decompress(body[DICTIONARY_ID_SIZE:], max_length)
+        if inflater.unconsumed_tail:
+            raise ValueError("Compressed message inflates past the limit")
+        if not inflater.eof:
+            raise ValueError("Truncated compressed message")
+        return data
+
+    def parse_message(self, frame: bytes, max_length=0) -> tuple[str, str]:
+        # (sender, message) of a relayed compressed frame
+        sender, body = parse_compressed_message(frame)
+        return sender, self.inflate(body, max_length).decode('utf-8')
+
+def build_compressed_payload(session_id: bytes, body: bytes) -> bytes:
+    return bytes([UCRP_EXTENDED, KIND_COMPRESSED]) + session_id + body
+
+def is_compressed_payload(data: bytes) -> bool:
+    return (len(data) >= COMPRESSED_HEADER_SIZE + DICTIONARY_ID_SIZE and data[0] == UCRP_EXTENDED
+            and data[1] == KIND_COMPRESSED)
+
+def build_compressed_message(sender: bytes, data: bytes, offset: int = COMPRESSED_HEADER_SIZE) -> bytes:
+    # The relayed frame for a compressed packet: its body, copied once, behind the sender
+    return b"".join((bytes([UCRP_EXTENDED, KIND_COMPRESSED, len(sender)]), sender, memoryview(data)[offset:]))
+
+def is_compressed_message(frame: bytes) -> bool:
+    return len(frame) > 3 and frame[0] == UCRP_EXTENDED and frame[1] == KIND_COMPRESSED
+
+def parse_compressed_message(frame: bytes) -> tuple[str, bytes]:
+    end = 3 + frame[2]
+    return frame[3:end].decode('utf-8'), frame[end:]
@@ -0,0 +1,148 @@
+import struct
+from collections import OrderedDict
+
+from protocol.ucrp import UCRP_EXTENDED
+
+# Messages too large for one datagram are sent as fragments.
+#
+#   client -> server  0x00, 0x84, session id (8 bytes), message id (4 bytes),
+#                     index (2 bytes), count (2 bytes), chunk
+#   server -> client  0x00, 0x84, message id (4 bytes), index (2 bytes),
+#                     count (2 bytes), [sender_len][sender], chunk
+#
+# The chunks are consecutive slices of the UTF-8 message. Like the compact
+# data packet, a fragment is addressed by session id, so the sharded data
+# plane routes it without a room name. The server does not reassemble: it
+# swaps the session id for the sender and relays each fragment as it
+# arrives. Receivers put the message back together, keyed by sender and
+# message id; fragments may arrive in any order.
+#
+# Reassembly state is bounded per sender, in total, and in time: a
+# fragment that would take its sender or everyone past their byte cap is
+# dropped with the rest of its message, and a message still incomplete
+# REASSEMBLY_TIMEOUT after its first fragment is abandoned.
+
+KIND_FRAGMENT = 0x84
+
+_FRAGMENT = struct.Struct('!BB8sIHH')
+_RELAYED = struct.Struct('!BBIHH')
+FRAGMENT_HEADER_SIZE = _FRAGMENT.size
+RELAYED_HEADER_SIZE = _RELAYED.size
+
+FRAGMENT_DATAGRAM = 1200                 # client datagram size, inside one packet on a 1280+ byte MTU
+FRAGMENT_CHUNK = FRAGMENT_DATAGRAM - FRAGMENT_HEADER_SIZE
+MAX_FRAGMENTS = 64
+MAX_FRAGMENTED_MESSAGE = 64 * 1024       # message bytes
+REASSEMBLY_TIMEOUT = 5.0                 # seconds from a message's first fragment
+SESSION_REASSEMBLY_BYTES = 256 * 1024    # held for one sender
+TOTAL_REASSEMBLY_BYTES = 16 * 1024 * 1024
+
+def build_fragments(session_id: bytes, message_id: int, data: bytes, chunk=FRAGMENT_CHUNK) -> list:
+    count = (len(data) + chunk - 1) // chunk
+    if count > MAX_FRAGMENTS:
+        raise ValueError(f"Message needs {count} fragments, more than {MAX_FRAGMENTS}")
+    return [_FRAGMENT.pack(UCRP_EXTENDED, KIND_FRAGMENT, session_id, message_id, index, count)
+            + data[index * chunk:(index + 1) * chunk] for index in range(count)]
+
+def is_fragment_payload(data: bytes) -> bool:
+    return len(data) > FRAGMENT_HEADER_SIZE and data[0] == UCRP_EXTENDED and data[1] == KIND_FRAGMENT
+
+def parse_fragment_header(data: bytes) -> tuple[int, int, int, int]:
+    # (session id, message id, index, count); the chunk is data[FRAGMENT_HEADER_SIZE:]
+    _, _, session_id, message_id, index, count = _FRAGMENT.unpack_from(data)
+    return int.from_bytes(session_id, 'big'), message_id, index, count
+
+def build_relayed_header(sender: bytes, message_id: int, index: int, count: int) -> bytes:
+    # Everything the server sends before the chunk; sender is the encoded username
+    return _RELAYED.pack(UCRP_EXTENDED, KIND_FRAGMENT, message_id, index, count) + bytes([len(sender)]) + sender
+
+def is_relayed_fragment(data: bytes) -> bool:
+    return len(data) > RELAYED_HEADER_SIZE and data[0] == UCRP_EXTENDED and data[1] == KIND_FRAGMENT
+
+def parse_relayed_fragment(data: bytes) -> tuple[str, int, int, int, bytes]:
+    _, _, message_id, index, count = _RELAYED.unpack_from(data)
+    start = RELAYED_HEADER_SIZE + 1
+    end = start + data[RELAYED_HEADER_SIZE]
+    return data[start:end].decode('utf-8'), message_id, index, count, data[end:]
+
+class Reassembler:
+    # Partial messages by (sender, message id). With keep=False only the
+    # bookkeeping is done: the server uses it to hold senders to the caps
+    # receivers will apply, without buffering anything itself.
+    def __init__(self, session_bytes=SESSION_REASSEMBLY_BYTES, total_bytes=TOTAL_REASSEMBLY_BYTES,
+                 timeout=REASSEMBLY_TIMEOUT, keep=True):
+        self.session_bytes = session_bytes
+        self.total_bytes = total_bytes
+        self.timeout = timeout
+        self.keep = keep
+        self.pending = OrderedDict()   # (sender, message id) -> [deadline, count, missing, size, chunks], oldest first
+        self.held = {}                 # sender -> bytes held
+        self.bytes = 0
+        self.expired = 0
+        self.rejected = 0
+
+    def add(self, sender, message_id, index, count, chunk, now):
+        # The whole message once its last fragment is in (True with
+        # keep=False); None while incomplete; False if it was dropped
+        if self.pending:
+            self.expire(now)
+        key = (sender, message_id)
+        partial = self.pending.get(key)
+        if partial is None:
+            if not 0 < count <= MAX_FRAGMENTS or index >= count:
+                self.rejected += 1
+                return False
+            partial = self.pending[key] = [now + self.timeout, count, set(range(count)), 0,
+                                           [None] * count if self.keep else None]
+        elif partial[1] != count or index >= count:
+            self._drop(key)
+            self.rejected += 1
+            return False
+        missing = partial[2]
+        if index not in missing:
+            return None
+        size = len(chunk)
+        held = self.held.get(sender, 0) + size
+        if held > self.session_bytes or self.bytes + size > self.total_bytes:
+            self._drop(key)
+            self.rejected += 1
+            return False
+        missing.discard(index)
+        if size:
+            partial[3] += size
+            self.held[sender] = held
+            self.bytes += size
+        if self.keep:
+            partial[4][index] = chunk
+        if missing:
+            return None
+        self._drop(key)
+        return b"".join(partial[4]) if self.keep else True
+
+    def _drop(self, key):
+        partial = self.pending.pop(key)
+        size = partial[3]
+        if size:
+            sender = key[0]
+            held = self.held[sender] - size
+            if held:
+                self.held[sender] = held
+            else:
+                del self.held[sender]
+            self.bytes -= size
+
+    def expire(self, now):
+        # Deadlines are a fixed timeout after insertion, so the oldest are first
+        pending = self.pending
+        while pending:
+            key = next(iter(pending))
+            if pending[key][0] > now:
+                return
+            self._drop(key)
+            self.expired += 1
+
+    def forget(self, sender):
+        # The sender left; its partial messages can never complete
+        if self.pending:
+            for key in [k for k in self.pending if k[0] == sender]:
+                self._drop(key)
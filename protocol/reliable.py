@@ -0,0 +1,199 @@
+import struct
+from collections import deque
+
+from protocol.ucrp import UCRP_EXTENDED
+
+# Optional reliable delivery over UCRP.
+#
+# A client opts in by sending its __REGISTER__ inside a reliable envelope
+# with seq 0. A server that accepts it ACKs that envelope; from then on both
+# sides wrap every datagram they send to each other in an envelope with the
+# next sequence number of their direction, and acknowledge what they get.
+#
+#   envelope  0x00, 0x82, seq (4 bytes), the packet it carries
+#   ACK       0x00, 0x83, session id (8 bytes), ack (4 bytes), sack (4 bytes)
+#
+# ack is the next sequence number expected (everything below it arrived);
+# bit i of sack is set when ack + 1 + i arrived too. The session id lets
+# the sharded data plane route a client's ACKs like its data packets; the
+# server sends zeros.
+#
+# Messages are delivered as soon as they arrive, not in sequence order:
+# a lost datagram is retransmitted without holding back the ones behind it.
+# At most WINDOW datagrams are unacknowledged per direction, and up to
+# BACKLOG more wait for the window to open; beyond that new datagrams are
+# dropped (the peer is gone or far too slow). Retransmission is driven by
+# poll(), which the owner calls every TICK while the stream is busy.
+
+KIND_RELIABLE = 0x82
+KIND_ACK = 0x83
+
+_ENVELOPE = struct.Struct('!BBI')
+_ACK = struct.Struct('!BB8sII')
+RELIABLE_HEADER_SIZE = _ENVELOPE.size
+ACK_SIZE = _ACK.size
+NO_SESSION_ID = bytes(8)
+
+WINDOW = 256         # unacknowledged datagrams in flight, per direction
+BACKLOG = 1024       # datagrams waiting for window space
+SACK_BITS = 32
+ACK_EVERY = 8        # in-order datagrams per ACK
+ACK_DELAY = 0.02     # seconds an ACK may be held back waiting for more
+INITIAL_RTO = 0.2
+MIN_RTO = 0.05
+MAX_RTO = 2.0
+MAX_TRIES = 8        # transmissions of one datagram before the peer is given up
+TICK = 0.01
+
+def build_reliable_payload(seq: int, packet: bytes) -> bytes:
+    return _ENVELOPE.pack(UCRP_EXTENDED, KIND_RELIABLE, seq) + packet
+
+def is_reliable_payload(data: bytes) -> bool:
+    return len(data) >= RELIABLE_HEADER_SIZE and data[0] == UCRP_EXTENDED and data[1] == KIND_RELIABLE
+
+def parse_reliable_payload(data: bytes) -> tuple[int, bytes]:
+    _, _, seq = _ENVELOPE.unpack_from(data)
+    return seq, data[RELIABLE_HEADER_SIZE:]
+
+def build_ack_payload(session_id: bytes, ack: int, sack: int) -> bytes:
+    return _ACK.pack(UCRP_EXTENDED, KIND_ACK, session_id, ack, sack)
+
+def is_ack_payload(data: bytes) -> bool:
+    return len(data) == ACK_SIZE and data[0] == UCRP_EXTENDED and data[1] == KIND_ACK
+
+def parse_ack_payload(data: bytes) -> tuple[int, int, int]:
+    _, _, session_id, ack, sack = _ACK.unpack(data)
+    return int.from_bytes(session_id, 'big'), ack, sack
+
+class ReliableStream:
+    # Both directions of one peer: what we send to it and what it sends us
+    def __init__(self, session_id=NO_SESSION_ID):
+        self.session_id = session_id
+        self.next_seq = 0
+        self.unacked = {}        # seq -> [datagram, first_sent, last_sent, tries], in seq order
+        self.backlog = deque()
+        self.srtt = None
+        self.rttvar = 0.0
+        self.rto = INITIAL_RTO
+        self.failed = False
+        self.retransmits = 0
+        self.dropped = 0
+
+        self.expected = 0
+        self.received = set()    # delivered seqs above expected
+        self.acks_owed = 0
+        self.ack_at = None
+
+    def send(self, packet: bytes, now: float):
+        # The datagram to send now, or None if it had to wait (or was dropped)
+        if len(self.unacked) < WINDOW:
+            return self._transmit(packet, now)
+        if len(self.backlog) < BACKLOG:
+            self.backlog.append(packet)
+        else:
+            self.dropped += 1
+        return None
+
+    def _transmit(self, packet, now):
+        seq = self.next_seq
+        self.next_seq += 1
+        datagram = build_reliable_payload(seq, packet)
+        self.unacked[seq] = [datagram, now, now, 1]
+        return datagram
+
+    def on_ack(self, ack: int, sack: int, now: float) -> list:
+        # Datagrams to send: SACK-detected losses and backlog that now fits
+        unacked = self.unacked
+        highest = ack - 1
+        for seq in list(unacked):
+            offset = seq - ack - 1
+            if seq < ack or (0 <= offset < SACK_BITS and sack >> offset & 1):
+                entry = unacked.pop(seq)
+                highest = max(highest, seq)
+                if entry[3] == 1:
+                    # Karn: only datagrams sent once give a clean RTT sample
+                    self._sample_rtt(now - entry[1])
+            elif offset >= SACK_BITS:
+                break
+
+        out = []
+        # A hole below a SACKed datagram is lost; resend it without waiting
+        # for the timer, once per round trip
+        for seq, entry in unacked.items():
+            if seq > highest:
+                break
+            if now - entry[2] >= (self.srtt or self.rto):
+                out.append(self._retransmit(entry, now))
+        while self.backlog and len(unacked) < WINDOW:
+            out.append(self._transmit(self.backlog.popleft(), now))
+        return out
+
+    def _sample_rtt(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(MAX_RTO, max(MIN_RTO, self.srtt + 4 * self.rttvar))
+
+    def _retransmit(self, entry, now):
+        entry[2] = now
+        entry[3] += 1
+        self.retransmits += 1
+        return entry[0]
+
+    def receive(self, seq: int, now: float) -> bool:
+        # True if the datagram is new and should be delivered
+        if seq < self.expected or seq in self.received:
+            # Our ACK was lost; repeat it at once so the peer stops resending
+            self.ack_at = now
+            return False
+        if seq >= self.expected + WINDOW:
+            return False
+        if seq == self.expected:
+            self.expected += 1
+            while self.expected in self.received:
+                self.received.remove(self.expected)
+                self.expected += 1
+            in_order = True
+        else:
+            self.received.add(seq)
+            in_order = False
+        self.acks_owed += 1
+        if not in_order or self.acks_owed >= ACK_EVERY:
+            self.ack_at = now
+        elif self.ack_at is None:
+            self.ack_at = now + ACK_DELAY
+        return True
+
+    def take_ack(self, now: float):
+        # The ACK datagram if one is due, else None
+        if self.ack_at is None or self.ack_at > now:
+            return None
+        sack = 0
+        for seq in self.received:
+            offset = seq - self.expected - 1
+            if offset < SACK_BITS:
+                sack |= 1 << offset
+        self.acks_owed = 0
+        self.ack_at = None
+        return build_ack_payload(self.session_id, self.expected, sack)
+
+    def poll(self, now: float) -> list:
+        # Retransmissions and the ACK that are due; sets failed when a
+        # datagram has gone unacknowledged MAX_TRIES times
+        out = []
+        for entry in self.unacked.values():
+            if now - entry[2] >= min(MAX_RTO, self.rto * (1 << (entry[3] - 1))):
+                if entry[3] >= MAX_TRIES:
+                    self.failed = True
+                    return out
+                out.append(self._retransmit(entry, now))
+        ack = self.take_ack(now)
+        if ack is not None:
+            out.append(ack)
+        return out
+
+    def idle(self) -> bool:
+        return not self.unacked and not self.backlog and self.ack_at is None
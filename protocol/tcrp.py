@@ -1,3 +1,4 @@
+import base64
 import json
 import struct
 
@@ -8,6 +9,13 @@ STATE_REQUEST = 0
 STATE_COMPLIANCE = 1
 STATE_COMPLETE = 2
 
+MAX_PAYLOAD_SIZE = 64 * 1024   # the header allows 2**224 bytes; nothing legitimate comes close
+DECODER_BUFFER_SIZE = 16 * 1024
+
+# UCRP frames beyond single messages (protocol/ucrp.py KIND_BATCH,
+# protocol/fragment.py KIND_FRAGMENT); a client lists them in "frames" to be sent them
+EXTENDED_FRAMES = ["batch", "fragment"]
+
 class TCRProtocol:
     HEADER_SIZE = 32
 
@@ -32,39 +40,169 @@ class TCRProtocol:
         sock.sendall(header + room_name_bytes + payload_bytes)
 
     @staticmethod
-    def receive_tcrp_message(sock):
+    def receive_tcrp_message(sock, max_payload_size=MAX_PAYLOAD_SIZE):
+        # Reads exactly one frame and nothing past it. Connections that carry
+        # several frames should keep a TCRPDecoder instead.
         header = TCRProtocol._recv_exactly(sock, TCRProtocol.HEADER_SIZE)
-        if not header:
-            raise ConnectionError("ヘッダー受信中に切断されました")
         room_name_size, op, state, payload_size = TCRProtocol.decode_tcrp_header(header)
+        if payload_size > max_payload_size:
+            raise ValueError(f"Payload of {payload_size} bytes exceeds limit of {max_payload_size}")
 
-        room_name_bytes = TCRProtocol._recv_exactly(sock, room_name_size)
-        payload_bytes = TCRProtocol._recv_exactly(sock, payload_size)
-
-        room_name = room_name_bytes.decode('utf-8')
-        payload_str = payload_bytes.decode('utf-8')
+        body = TCRProtocol._recv_exactly(sock, room_name_size + payload_size)
+        room_name = str(body[:room_name_size], 'utf-8')
+        payload_str = str(body[room_name_size:], 'utf-8')
         return op, state, room_name, payload_str
 
     @staticmethod
-    def build_response_compliance(room_name, operation, success):
-        payload = json.dumps({"success": success}).encode('utf-8')
+    def parse_request_payload(payload_str):
+        # Legacy one-shot requests carry the username as a bare JSON string.
+        # Pipelined requests carry {"username": ..., "request_id": n}; the
+        # username is handed back in the legacy form so both store the same.
+        # They may also offer compression:
+        #   "compression": {"codecs": ["zlib"], "dictionaries": [crc32 of each dictionary the client has]}
+        # which is returned as the third value (None if absent), and list the
+        # extended frames they read ("frames": EXTENDED_FRAMES); the fourth
+        # value is True when all of them are listed.
+        try:
+            payload_obj = json.loads(payload_str)
+        except ValueError:
+            return payload_str, None, None, False
+        if isinstance(payload_obj, dict) and "request_id" in payload_obj:
+            compression = payload_obj.get("compression")
+            frames = payload_obj.get("frames")
+            extended = isinstance(frames, list) and all(kind in frames for kind in EXTENDED_FRAMES)
+            return (json.dumps(payload_obj.get("username", "")), payload_obj["request_id"],
+                    compression if isinstance(compression, dict) else None, extended)
+        return payload_str, None, None, False
+
+    @staticmethod
+    def build_response_compliance(room_name, operation, success, request_id=None):
+        result = {"success": success}
+        if request_id is not None:
+            result["request_id"] = request_id
+        payload = json.dumps(result).encode('utf-8')
         room_name_bytes = room_name.encode('utf-8')
         header = TCRProtocol.encode_tcrp_header(len(room_name_bytes), operation, STATE_COMPLIANCE, len(payload))
         return header + room_name_bytes + payload
 
     @staticmethod
-    def build_response_complete(room_name, operation, token):
-        payload = json.dumps({"token": token}).encode('utf-8')
+    def build_response_complete(room_name, operation, token, request_id=None, session_id=None, compression=None,
+                                redirect=None):
+        result = {"token": token}
+        if redirect is not None:
+            # In cluster mode: the room lives on another node
+            # ({"node", "host", "tcp_port", "udp_port"}); ask there instead
+            result["redirect"] = redirect
+        if session_id is not None:
+            # Fixed 8-byte id for compact UCRP packets, as 16 hex digits
+            result["session_id"] = f"{session_id:016x}"
+        if compression is not None:
+            # (codec, dictionary crc32, dictionary bytes or None if the client
+            # has it); dictionary_id is the 16-bit id compressed messages carry
+            codec, checksum, dictionary = compression
+            result["compression"] = {"codec": codec, "dictionary_id": checksum & 0xFFFF,
+                                     "dictionary_crc32": checksum}
+            if dictionary is not None:
+                result["compression"]["dictionary"] = base64.b64encode(dictionary).decode('ascii')
+        if request_id is not None:
+            result["request_id"] = request_id
+        payload = json.dumps(result).encode('utf-8')
         room_name_bytes = room_name.encode('utf-8')
         header = TCRProtocol.encode_tcrp_header(len(room_name_bytes), operation, STATE_COMPLETE, len(payload))
         return header + room_name_bytes + payload
 
     @staticmethod
     def _recv_exactly(sock, size):
-        buf = b''
-        while len(buf) < size:
-            part = sock.recv(size - len(buf))
-            if not part:
+        buf = bytearray(size)
+        view = memoryview(buf)
+        received = 0
+        while received < size:
+            n = sock.recv_into(view[received:])
+            if not n:
                 raise ConnectionError("Connection lost (during reception)")
-            buf += part
-        return buf
\ No newline at end of file
+            received += n
+        return buf
+
+class TCRPDecoder:
+    # Incremental TCRP decoder for one connection. Bytes land in a single
+    # preallocated bytearray, either straight from recv_into (recv_from) or
+    # from chunks handed over by an event loop (feed); next_frame() returns
+    # (op, state, room_name, payload) once a whole frame is buffered, else
+    # None. Partial frames stay in place; consumed bytes are reclaimed by
+    # sliding the unread tail to the front only when space runs out.
+    def __init__(self, max_payload_size=MAX_PAYLOAD_SIZE, buffer_size=DECODER_BUFFER_SIZE):
+        self.max_payload_size = max_payload_size
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        self.needed = TCRProtocol.HEADER_SIZE
+
+    def buffered(self):
+        return self.end - self.start
+
+    def writable(self):
+        # Free space after the buffered bytes, large enough for the pending frame
+        free = len(self.buffer) - self.end
+        if free > 0 and self.start + self.needed <= len(self.buffer):
+            return self.view[self.end:]
+        pending = self.end - self.start
+        if self.needed > len(self.buffer):
+            buffer = bytearray(max(self.needed, 2 * len(self.buffer)))
+            buffer[:pending] = self.view[self.start:self.end]
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        elif self.start:
+            self.view[:pending] = self.view[self.start:self.end]
+        self.start = 0
+        self.end = pending
+        return self.view[self.end:]
+
+    def recv_from(self, sock):
+        # One recv_into on a blocking or non-blocking socket; 0 means EOF
+        n = sock.recv_into(self.writable())
+        self.end += n
+        return n
+
+    def feed(self, data):
+        data = memoryview(data)
+        while data:
+            view = self.writable()
+            n = min(len(view), len(data))
+            view[:n] = data[:n]
+            self.end += n
+            data = data[n:]
+            # Grow only as far as the frame being assembled requires
+            if data and self.buffered() >= self.needed:
+                self.needed = self.buffered() + len(data)
+
+    def frames(self):
+        while True:
+            frame = self.next_frame()
+            if frame is None:
+                return
+            yield frame
+
+    def next_frame(self):
+        available = self.end - self.start
+        if available < TCRProtocol.HEADER_SIZE:
+            self.needed = TCRProtocol.HEADER_SIZE
+            return None
+        start = self.start
+        room_name_size, op, state = struct.unpack_from('!BBB', self.buffer, start)
+        payload_size = int.from_bytes(self.view[start + 4:start + TCRProtocol.HEADER_SIZE], byteorder='big')
+        if payload_size > self.max_payload_size:
+            raise ValueError(f"Payload of {payload_size} bytes exceeds limit of {self.max_payload_size}")
+        frame_size = TCRProtocol.HEADER_SIZE + room_name_size + payload_size
+        if available < frame_size:
+            self.needed = frame_size
+            return None
+
+        body = start + TCRProtocol.HEADER_SIZE
+        room_name = str(self.view[body:body + room_name_size], 'utf-8')
+        payload_str = str(self.view[body + room_name_size:start + frame_size], 'utf-8')
+        self.start += frame_size
+        if self.start == self.end:
+            self.start = self.end = 0
+        self.needed = TCRProtocol.HEADER_SIZE
+        return op, state, room_name, payload_str
\ No newline at end of file
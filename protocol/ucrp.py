@@ -1,3 +1,17 @@
+# Extended packets start with UCRP_EXTENDED and a kind byte. A legacy
+# client->server packet starts with the room name length and then the token
+# length (38 for every issued token), so even an empty room name cannot be
+# mistaken for a kind byte. The same holds server->client: a relayed
+# message starts with the sender length, and a stored username is
+# JSON-encoded, so never empty.
+UCRP_EXTENDED = 0x00
+KIND_SESSION = 0x80
+KIND_BATCH = 0x81
+SESSION_ID_SIZE = 8
+SESSION_HEADER_SIZE = 2 + SESSION_ID_SIZE
+BATCH_HEADER_SIZE = 2
+BATCH_FRAME_PREFIX = 2   # big-endian length before each message in a batch
+
 def parse_custom_payload(data: bytes) -> tuple[str, str, str, str]:
     if isinstance(data, bytes):
         data = data.decode('utf-8')
@@ -24,6 +38,18 @@ def parse_udp_payload(data: bytes) -> tuple[str, str, str]:
     message = data[msg_start:].decode('utf-8')
     return room_name, token, message
 
+def build_session_payload(session_id: bytes, message: str) -> bytes:
+    # Compact data packet: 10 header bytes instead of 2 + room name + token
+    return bytes([UCRP_EXTENDED, KIND_SESSION]) + session_id + message.encode('utf-8')
+
+def is_session_payload(data: bytes) -> bool:
+    return len(data) >= SESSION_HEADER_SIZE and data[0] == UCRP_EXTENDED and data[1] == KIND_SESSION
+
+def parse_session_payload(data: bytes) -> tuple[int, str]:
+    session_id = int.from_bytes(data[2:SESSION_HEADER_SIZE], 'big')
+    message = data[SESSION_HEADER_SIZE:].decode('utf-8')
+    return session_id, message
+
 def build_udp_message(sender: str, message: str) -> bytes:
     sender_bytes = sender.encode('utf-8')
     message_bytes = message.encode('utf-8')
@@ -37,6 +63,40 @@ def parse_udp_message(data: bytes) -> tuple[str, str]:
     message = data[1 + username_len:].decode("utf-8")
     return sender, message
 
+def build_batch_message(messages: list) -> bytes:
+    # Several build_udp_message() frames in one datagram
+    parts = [bytes([UCRP_EXTENDED, KIND_BATCH])]
+    for message in messages:
+        parts.append(len(message).to_bytes(BATCH_FRAME_PREFIX, 'big'))
+        parts.append(message)
+    return b"".join(parts)
+
+def is_batch_message(data: bytes) -> bool:
+    return len(data) >= BATCH_HEADER_SIZE and data[0] == UCRP_EXTENDED and data[1] == KIND_BATCH
+
+def iter_udp_messages(data: bytes, inflate=None):
+    # (sender, message) for each message in a relayed datagram, batched or
+    # not. A frame starting with UCRP_EXTENDED is a compressed message
+    # (protocol/compress.py); inflate(frame) decodes it, and without one it is skipped.
+    if not is_batch_message(data):
+        if not data or data[0] != UCRP_EXTENDED:
+            yield parse_udp_message(data)
+        elif inflate is not None:
+            yield inflate(data)
+        return
+    offset = BATCH_HEADER_SIZE
+    while offset + BATCH_FRAME_PREFIX <= len(data):
+        size = int.from_bytes(data[offset:offset + BATCH_FRAME_PREFIX], 'big')
+        offset += BATCH_FRAME_PREFIX
+        if offset + size > len(data):
+            raise ValueError("Truncated batch frame")
+        frame = data[offset:offset + size]
+        if not frame or frame[0] != UCRP_EXTENDED:
+            yield parse_udp_message(frame)
+        elif inflate is not None:
+            yield inflate(frame)
+        offset += size
+
 def parse_packet_auto(data: bytes) -> dict:
     try:
         decoded = data.decode('utf-8')
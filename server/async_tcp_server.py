@@ -0,0 +1,133 @@
+import asyncio
+import os
+import socket
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from protocol.tcrp import TCRProtocol, TCRPDecoder
+from logger import get_logger
+from tcp_server import TCP_Create_Join_Server, HANDSHAKE_SECONDS, REJECTED_CONNECTIONS, TIMED_OUT_CONNECTIONS, IDLE_TIMEOUT
+
+log = get_logger("tcp")
+
+READ_TIMEOUT = 10.0       # seconds for a client to deliver its whole request
+MAX_CONNECTIONS = 10000   # concurrently open handshakes; extra connections are closed
+LISTEN_BACKLOG = 4096     # kernel accept queue, absorbs reconnect storms
+READ_CHUNK = 16 * 1024
+
+class Async_TCP_Create_Join_Server(TCP_Create_Join_Server):
+    # Same CREATE/JOIN handling as TCP_Create_Join_Server, but every handshake
+    # runs as a coroutine on one event loop thread instead of a thread each.
+    def __init__(self, host, tcp_port, room_manager, cluster=None,
+                 read_timeout=READ_TIMEOUT, max_connections=MAX_CONNECTIONS, idle_timeout=IDLE_TIMEOUT):
+        super().__init__(host, tcp_port, room_manager, cluster, idle_timeout)
+        self.read_timeout = read_timeout
+        self.max_connections = max_connections
+        self.loop = None
+        self.server = None
+
+    def bind(self, sock=None):
+        super().bind(sock)
+        self.socket.listen(LISTEN_BACKLOG)
+        self.socket.setblocking(False)
+        self.loop = asyncio.new_event_loop()
+        self.server = self.loop.run_until_complete(
+            asyncio.start_server(self._serve, sock=self.socket)
+        )
+
+    def start(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_forever()
+        finally:
+            self.server.close()
+            self.loop.run_until_complete(self.server.wait_closed())
+            self.loop.close()
+
+    async def _serve(self, reader, writer):
+        accepted_at = time.perf_counter()
+        address = writer.get_extra_info('peername')
+        if self.active_connections >= self.max_connections:
+            REJECTED_CONNECTIONS.inc()
+            log.warning("[TCP] Rejected: %d connections already open", self.active_connections,
+                        address=address, hot="rejected")
+            writer.close()
+            return
+
+        self.active_connections += 1
+        writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if log.debug_enabled:
+            log.debug("[TCP] Connected", address=address, hot="connected")
+        decoder = TCRPDecoder()
+        served = 0
+        try:
+            # Legacy one-shot requests (no request_id) close after the answer;
+            # pipelined ones keep reading until the client closes or idles out
+            while self.running:
+                timeout = self.idle_timeout if served else self.read_timeout
+                waiting = served and not decoder.buffered()
+                if waiting:
+                    if self.draining:
+                        break
+                    # Between requests; drain() may close us here
+                    self.idle.add(writer)
+                try:
+                    op, state, room_name, payload = await asyncio.wait_for(self._read_request(reader, decoder), timeout)
+                finally:
+                    self.idle.discard(writer)
+                served += 1
+                username, request_id, compression, extended = TCRProtocol.parse_request_payload(payload)
+                response = self.handle_request(op, state, room_name, username, address, request_id, compression,
+                                               extended)
+                if response:
+                    writer.write(response)
+                    await writer.drain()
+                    if served == 1:
+                        HANDSHAKE_SECONDS.observe(time.perf_counter() - accepted_at)
+                if request_id is None:
+                    break
+        except asyncio.TimeoutError:
+            if served:
+                log.info("[TCP] Idle for %ss after %d requests", self.idle_timeout, served, address=address, hot="idle")
+            else:
+                TIMED_OUT_CONNECTIONS.inc()
+                log.warning("Client processing error: no complete request within %ss", self.read_timeout,
+                            address=address, hot="client_error")
+        except asyncio.IncompleteReadError as e:
+            if not (served and not e.partial):
+                log.warning("Client processing error: Connection lost (during reception)",
+                            address=address, hot="client_error")
+        except Exception as e:
+            log.warning("Client processing error: %s", e, address=address, hot="client_error")
+        finally:
+            self.active_connections -= 1
+            writer.close()
+            if log.debug_enabled:
+                log.debug("[TCP] Disconnected after %d requests", served, address=address, hot="disconnected")
+
+    async def _read_request(self, reader, decoder):
+        while True:
+            frame = decoder.next_frame()
+            if frame is not None:
+                return frame
+            chunk = await reader.read(READ_CHUNK)
+            if not chunk:
+                raise asyncio.IncompleteReadError(bytes(decoder.view[decoder.start:decoder.end]), None)
+            decoder.feed(chunk)
+
+    def drain(self):
+        def _drain():
+            self.draining = True
+            # Closes our copy of the listening socket; the new process keeps its own
+            self.server.close()
+            for writer in self.idle:
+                writer.close()
+            log.info("[TCP] Draining: %d connections open, %d idle closed", self.active_connections, len(self.idle))
+        self.loop.call_soon_threadsafe(_drain)
+
+    def stop(self):
+        self.running = False
+        if self.loop and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            log.info("[Stopped] TCP server stopped")
@@ -0,0 +1,140 @@
+import asyncio
+import threading
+import time
+
+from fanout import Fanout
+from logger import get_logger
+from udp_server import UDP_Chat_Server, PAUSE_TIMEOUT
+from coalesce import COALESCE_BYTES
+from presence import SESSION_TIMEOUT
+
+log = get_logger("udp")
+
+class _UDP_Relay_Protocol(asyncio.DatagramProtocol):
+    def __init__(self, server):
+        self.server = server
+
+    def datagram_received(self, data, address):
+        if not data:
+            return
+        if self.server.forward is not None:
+            # Handed off: the new process handles it
+            self.server.forward(data, address)
+            return
+        try:
+            self.server.on_datagram(data, address)
+        except Exception as e:
+            log.warning("[Receive error] %s", e, address=address, hot="receive_error")
+        self.server.arm_timer()
+
+    def error_received(self, exc):
+        # ICMP errors (e.g. port unreachable for a departed member) land here
+        if self.server.running:
+            log.warning("[Receive error] %s", exc, hot="receive_error")
+
+class Async_UDP_Chat_Server(UDP_Chat_Server):
+    # Same REGISTER/LEAVE/relay semantics as UDP_Chat_Server, but the socket is
+    # driven by an asyncio event loop. transport.sendto never blocks: if the
+    # kernel buffer is full the datagram is queued by the transport instead of
+    # stalling every other room behind one recipient.
+    def __init__(self, host: str, udp_port: int, room_manager, coalesce_window=0.0, coalesce_bytes=COALESCE_BYTES,
+                 session_timeout=SESSION_TIMEOUT, rate_limits=None):
+        super().__init__(host, udp_port, room_manager, coalesce_window, coalesce_bytes, session_timeout, rate_limits)
+        self.loop = None
+        self.transport = None
+        self.protocol = None
+        self.timer = None
+        self.timer_at = None
+
+    def bind(self, sock=None):
+        super().bind(sock)
+        self.udp_sock.setblocking(False)
+        self.loop = asyncio.new_event_loop()
+        self.transport, self.protocol = self.loop.run_until_complete(
+            self.loop.create_datagram_endpoint(lambda: _UDP_Relay_Protocol(self), sock=self.udp_sock)
+        )
+        # Batches go straight to the non-blocking socket; anything the kernel
+        # refuses with EAGAIN is handed to the transport to queue.
+        self.fanout = Fanout(self.udp_sock, self.transport.sendto)
+
+    def start(self):
+        asyncio.set_event_loop(self.loop)
+        self.arm_timer()
+        try:
+            self.loop.run_forever()
+        finally:
+            self.transport.close()
+            # Let the transport's close callbacks run before tearing the loop down
+            self.loop.run_until_complete(asyncio.sleep(0))
+            self.loop.close()
+
+    def send(self, payload: bytes, addr: tuple):
+        self.transport.sendto(payload, addr)
+
+    def arm_timer(self):
+        # One loop timer for coalescing flushes and reliable retransmits;
+        # loop.time() is time.monotonic(), the clock both of them use
+        if self.forward is not None:
+            return
+        deadline = self.next_timer()
+        if deadline is None or (self.timer is not None and self.timer_at <= deadline):
+            return
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer_at = deadline
+        self.timer = self.loop.call_at(deadline, self._on_timer)
+
+    def _on_timer(self):
+        self.timer = None
+        self.run_timers(time.monotonic())
+        self.arm_timer()
+
+    def hand_off(self, forward):
+        # Everything here runs on the loop thread, so once _pause has run no
+        # packet is half handled; datagrams still read are forwarded
+        def _pause():
+            self.forward = forward
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if self.coalescer:
+                self.coalescer.flush_all()
+            self.paused.set()
+        self.loop.call_soon_threadsafe(_pause)
+        return self.paused.wait(PAUSE_TIMEOUT)
+
+    def resume(self):
+        def _resume():
+            self.paused.clear()
+            self.forward = None
+            self.arm_timer()
+        self.loop.call_soon_threadsafe(_resume)
+
+    def stop_forwarding(self):
+        done = threading.Event()
+        def _stop_reading():
+            self.transport.pause_reading()
+            done.set()
+        self.loop.call_soon_threadsafe(_stop_reading)
+        done.wait(PAUSE_TIMEOUT)
+
+    def inject(self, data, address):
+        self.loop.call_soon_threadsafe(self.protocol.datagram_received, data, address)
+
+    def send_batch(self, payload: bytes, addrs: list) -> tuple[int, int]:
+        # Once the transport is holding a backlog, writing around it would
+        # reorder datagrams, so queue behind it instead
+        if self.transport.get_write_buffer_size():
+            return self.fanout.send_each(payload, addrs)
+        return self.fanout.send(payload, addrs)
+
+    def send_parts(self, head: bytes, data: bytes, offset: int, addrs: list) -> tuple[int, int]:
+        if self.transport.get_write_buffer_size():
+            return self.fanout.send_each(head + data[offset:], addrs)
+        return self.fanout.send_parts(head, data, offset, addrs)
+
+    def stop(self):
+        self.running = False
+        if self.loop and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            log.info("[Stopped] UDP server stopped")
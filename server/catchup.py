@@ -0,0 +1,122 @@
+import os
+import sys
+from collections import OrderedDict, deque
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from protocol.ucrp import build_batch_message, UCRP_EXTENDED, BATCH_HEADER_SIZE, BATCH_FRAME_PREFIX
+from protocol.compress import KIND_COMPRESSED
+from coalesce import COALESCE_BYTES
+import metrics
+
+# Paced replay of a room's history to a client that has just registered.
+#
+# The frames are packed into UCRP batch datagrams of up to `budget` bytes
+# and sent `burst` datagrams per address every `interval` seconds, so a
+# register storm after a restart does not turn into a burst the clients'
+# receive buffers (or the server's send buffer) cannot absorb. At most
+# `limit` catch-up datagrams go out per interval across all addresses.
+# A client that does not read batches (batches(addr) is false) is sent one
+# frame per datagram.
+#
+# Live messages relayed to an address whose catch-up is still running are
+# queued behind it, so the client sees the room in order.
+#
+# Like the coalescer, this has no timer of its own: the server calls run()
+# when next_deadline() passes.
+
+CATCH_UP_BURST = 8         # datagrams per address per interval
+CATCH_UP_INTERVAL = 0.01   # seconds
+CATCH_UP_LIMIT = 512       # datagrams per interval, all addresses
+
+CATCH_UP_MESSAGES = metrics.counter("chat_udp_catch_up_messages_total", "History messages replayed to registering clients")
+
+class Catch_Up_Queue:
+    def __init__(self, send, budget=COALESCE_BYTES, burst=CATCH_UP_BURST, interval=CATCH_UP_INTERVAL,
+                 limit=CATCH_UP_LIMIT, batches=None):
+        self.send = send          # send(payload, addrs) -> (sent, failed)
+        self.budget = budget
+        self.batches = batches    # batches(addr) -> bool; None = every address reads them
+        self.burst = burst
+        self.interval = interval
+        self.limit = limit
+        self.pending = OrderedDict()   # addr -> deque of frames still to send
+        self.next_at = None
+
+    def add(self, frames, addr, now):
+        # Replaces any catch-up still running for addr; the first burst goes out at once
+        if not frames:
+            return
+        CATCH_UP_MESSAGES.value += len(frames)
+        queue = self.pending[addr] = deque(frames)
+        batch = self.batches is None or self.batches(addr)
+        for _ in range(self.burst):
+            if not queue:
+                break
+            self.send(self._pack(queue, batch), [addr])
+        if not queue:
+            del self.pending[addr]
+        elif self.next_at is None:
+            self.next_at = now + self.interval
+
+    def hold(self, frame, addrs):
+        # Queues frame for addresses still catching up; returns the others
+        pending = self.pending
+        rest = []
+        for addr in addrs:
+            queue = pending.get(addr)
+            if queue is None:
+                rest.append(addr)
+            else:
+                queue.append(frame)
+        return rest
+
+    def discard(self, addrs):
+        for addr in addrs:
+            self.pending.pop(addr, None)
+        if not self.pending:
+            self.next_at = None
+
+    def next_deadline(self):
+        return self.next_at
+
+    def run(self, now):
+        if self.next_at is None or now < self.next_at:
+            return
+        pending = self.pending
+        budget = self.limit
+        for addr in list(pending):
+            if budget <= 0:
+                break
+            queue = pending[addr]
+            batch = self.batches is None or self.batches(addr)
+            for _ in range(min(self.burst, budget)):
+                self.send(self._pack(queue, batch), [addr])
+                budget -= 1
+                if not queue:
+                    break
+            if queue:
+                # Served this round; anyone the limit cut off goes first next time
+                pending.move_to_end(addr)
+            else:
+                del pending[addr]
+        self.next_at = now + self.interval if pending else None
+
+    def _fits(self, queue, size):
+        return queue and _batchable(queue[0]) and size + BATCH_FRAME_PREFIX + len(queue[0]) <= self.budget
+
+    def _pack(self, queue, batch=True):
+        frame = queue.popleft()
+        size = BATCH_HEADER_SIZE + BATCH_FRAME_PREFIX + len(frame)
+        if not batch or not _batchable(frame) or not self._fits(queue, size):
+            return frame
+        frames = [frame]
+        while self._fits(queue, size):
+            frame = queue.popleft()
+            size += BATCH_FRAME_PREFIX + len(frame)
+            frames.append(frame)
+        return build_batch_message(frames)
+
+def _batchable(frame):
+    # Of the extended frames only compressed messages may go in a batch;
+    # fragments of large messages are sent as they are
+    return frame[0] != UCRP_EXTENDED or frame[1] == KIND_COMPRESSED
@@ -0,0 +1,326 @@
+from bisect import bisect
+import hashlib
+import hmac
+import json
+import random
+import socket
+import threading
+import time
+
+from logger import get_logger
+import metrics
+
+log = get_logger("cluster")
+
+# Several server.py nodes sharing the rooms of one chat service.
+#
+# Room names are placed on a consistent-hash ring of the live nodes, with
+# VIRTUAL_NODES points per node. A TCRP create or join for a room this
+# node does not own is answered with a redirect to the owner's TCP and UDP
+# endpoints (see TCP_Create_Join_Server.handle_request); clients reconnect
+# there and chat over its UDP port.
+#
+# Membership comes from cluster.json in the working directory:
+#
+#   {"node_id": "a", "advertise_host": "127.0.0.1", "gossip_port": 9190,
+#    "seeds": ["127.0.0.1:9290", "127.0.0.1:9390"], "secret": "..."}
+#
+# With a secret (the same on every node) each gossip datagram starts with
+# an HMAC-SHA256 tag of the rest, cut to MAC_SIZE bytes, and a datagram
+# without a valid tag is dropped. Without one, gossip is only taken from
+# the seeds and from nodes already known, by source address; a new node
+# then has to be a seed of some node already in the cluster.
+#
+# Every GOSSIP_INTERVAL each node bumps its heartbeat and sends its view of
+# the membership (one small JSON datagram) to GOSSIP_FANOUT random peers,
+# and to any seed it has not heard from. Entries are merged by
+# (incarnation, heartbeat), so a restarted node replaces its old entry. A
+# node whose heartbeat has not moved for FAIL_TIMEOUT leaves the ring; one
+# that stops cleanly says so and leaves at once. A node first heard of
+# from a third party joins the ring once a newer heartbeat for it arrives,
+# so gossip about a dead node cannot revive it.
+#
+# Adding a node only changes the owner of the rooms the new node's points
+# take over, about 1/N of them. Rooms that exist keep running where they
+# are, since their members are bound to that node's UDP port: each node
+# tells its peers which rooms it holds but no longer owns, and joins for
+# those are redirected to the holder. New rooms go to the new owner.
+
+CLUSTER_FILE = "cluster.json"
+VIRTUAL_NODES = 64
+GOSSIP_INTERVAL = 0.5   # seconds
+GOSSIP_FANOUT = 3
+FAIL_TIMEOUT = 3.0      # seconds without a newer heartbeat
+FORGET_AFTER = 60.0     # seconds before a dead node's entry is dropped
+ROOMS_PER_DATAGRAM = 1000
+MAC_SIZE = 16
+
+def ring_hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'big')
+
+def cluster_config(filename=CLUSTER_FILE):
+    # The node's cluster.json, or None to run standalone
+    try:
+        with open(filename, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        log.warning("Ignoring %s: %s", filename, e)
+        return None
+    log.info("Cluster config loaded from %s (%d seeds)", filename, len(config.get("seeds", [])))
+    if not config.get("secret"):
+        log.warning("%s has no secret: gossip is not authenticated, only taken from seeds and known nodes", filename)
+    return config
+
+def parse_address(text):
+    host, _, port = text.rpartition(":")
+    return host, int(port)
+
+class Hash_Ring:
+    def __init__(self, node_ids, replicas=VIRTUAL_NODES):
+        points = sorted((ring_hash(f"{node_id}#{i}"), node_id) for node_id in node_ids for i in range(replicas))
+        self.hashes = [point for point, _ in points]
+        self.owners = [node_id for _, node_id in points]
+        self.nodes = frozenset(node_ids)
+
+    def owner(self, key):
+        if not self.hashes:
+            return None
+        return self.owners[bisect(self.hashes, ring_hash(key)) % len(self.hashes)]
+
+class Cluster_Node:
+    __slots__ = ("node_id", "host", "tcp_port", "udp_port", "gossip_port", "incarnation", "heartbeat", "seen_at",
+                 "left")
+
+    def __init__(self, node_id, host, tcp_port, udp_port, gossip_port, incarnation, heartbeat=0):
+        self.node_id = node_id
+        self.host = host
+        self.tcp_port = tcp_port
+        self.udp_port = udp_port
+        self.gossip_port = gossip_port
+        self.incarnation = incarnation
+        self.heartbeat = heartbeat
+        self.seen_at = time.monotonic()
+        self.left = False
+
+    def to_json(self):
+        return [self.host, self.tcp_port, self.udp_port, self.gossip_port, self.incarnation, self.heartbeat, self.left]
+
+    def endpoint(self):
+        return {"node": self.node_id, "host": self.host, "tcp_port": self.tcp_port, "udp_port": self.udp_port}
+
+class Cluster:
+    def __init__(self, config, host, tcp_port, udp_port, room_manager):
+        self.room_manager = room_manager
+        self.host = host
+        self.node_id = str(config.get("node_id") or f"{host}:{tcp_port}")
+        advertise_host = config.get("advertise_host", host)
+        self.gossip_port = int(config.get("gossip_port", tcp_port))
+        self.seeds = [parse_address(seed) for seed in config.get("seeds", [])]
+        secret = config.get("secret")
+        self.key = secret.encode('utf-8') if secret else None
+        self.trusted = set()    # seed addresses as datagrams come from them, when there is no key
+        for seed_host, seed_port in self.seeds:
+            try:
+                self.trusted.add((socket.gethostbyname(seed_host), seed_port))
+            except OSError:
+                self.trusted.add((seed_host, seed_port))
+        # Milliseconds since the epoch: a restarted node outranks its old entry
+        self.me = Cluster_Node(self.node_id, advertise_host, tcp_port, udp_port, self.gossip_port,
+                               int(time.time() * 1000))
+        self.nodes = {self.node_id: self.me}
+        self.ring = Hash_Ring([self.node_id])
+        self.held = {}          # room name -> id of the node holding it off its ring position
+        self.parts = {}         # node id -> (round, parts, {part: rooms}) while a room list arrives
+        self.stray_rooms = []   # rooms this node holds but no longer owns
+        self.round = 0
+        self.socket = None
+        self.running = False
+        self.thread = None
+        metrics.gauge("chat_cluster_nodes", "Live nodes on the cluster ring", lambda: len(self.ring.nodes))
+        metrics.gauge("chat_cluster_stray_rooms", "Rooms held here that the ring places on another node",
+                      lambda: len(self.stray_rooms))
+
+    def bind(self, sock=None):
+        # sock: the gossip socket handed over by the process this one replaces
+        if sock is not None:
+            self.socket = sock
+        else:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.socket.bind((self.host, self.gossip_port))
+        self.socket.settimeout(GOSSIP_INTERVAL)
+        self.running = True
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        log.info("[Cluster] Node %s gossiping on %s:%s", self.node_id, self.me.host, self.gossip_port)
+
+    def stop(self, announce=True):
+        # Tells the peers we are leaving so they take us off the ring now;
+        # not after a handoff, where the new process goes on as this node
+        self.running = False
+        if self.thread:
+            self.thread.join()
+        if self.socket:
+            if announce:
+                self.me.left = True
+                self.me.heartbeat += 1
+                for address in self._peer_addresses():
+                    self._send(self._membership_message(), address)
+            self.socket.close()
+            self.socket = None
+
+    def locate(self, room_name):
+        # The node to redirect a request for room_name to, None to serve it here
+        if room_name in self.room_manager.rooms:
+            return None
+        node_id = self.held.get(room_name)
+        if node_id is None:
+            node_id = self.ring.owner(room_name)
+        if node_id == self.node_id:
+            return None
+        node = self.nodes.get(node_id)
+        return node.endpoint() if node is not None else None
+
+    def _run(self):
+        next_round = time.monotonic()
+        while self.running:
+            now = time.monotonic()
+            if now >= next_round:
+                self._gossip()
+                next_round = now + GOSSIP_INTERVAL
+            try:
+                data, address = self.socket.recvfrom(65535)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            payload = self._open(data, address)
+            if payload is None:
+                log.warning("[Cluster] Dropped gossip from outside the cluster", address=address, hot="gossip_rejected")
+                continue
+            try:
+                self._merge(json.loads(payload), time.monotonic())
+            except Exception as e:
+                log.warning("[Cluster] Bad gossip: %s", e, address=address, hot="gossip_error")
+
+    def _gossip(self):
+        self.me.heartbeat += 1
+        self._update_ring(time.monotonic())
+        self.round += 1
+        # Rooms held off-ring travel in every round, split to fit datagrams
+        ring = self.ring
+        self.stray_rooms = [room for room in list(self.room_manager.rooms) if ring.owner(room) != self.node_id]
+        chunks = [self.stray_rooms[i:i + ROOMS_PER_DATAGRAM]
+                  for i in range(0, len(self.stray_rooms), ROOMS_PER_DATAGRAM)] or [[]]
+        messages = [self._membership_message()]
+        messages += [self._seal(json.dumps({"from": self.node_id, "incarnation": self.me.incarnation,
+                                            "round": self.round, "part": i, "parts": len(chunks),
+                                            "rooms": chunk}).encode('utf-8'))
+                     for i, chunk in enumerate(chunks)]
+        for address in self._gossip_targets():
+            for message in messages:
+                self._send(message, address)
+
+    def _membership_message(self):
+        members = {node_id: node.to_json() for node_id, node in self.nodes.items()}
+        return self._seal(json.dumps({"from": self.node_id, "members": members}).encode('utf-8'))
+
+    def _seal(self, payload):
+        if self.key is None:
+            return payload
+        return hmac.digest(self.key, payload, 'sha256')[:MAC_SIZE] + payload
+
+    def _open(self, data, address):
+        # The gossip payload of a datagram, None if it is not from this cluster
+        if self.key is not None:
+            payload = data[MAC_SIZE:]
+            if hmac.compare_digest(data[:MAC_SIZE], hmac.digest(self.key, payload, 'sha256')[:MAC_SIZE]):
+                return payload
+            return None
+        if address in self.trusted:
+            return data
+        for node in self.nodes.values():
+            if node is not self.me and node.gossip_port == address[1] and node.host == address[0]:
+                return data
+        return None
+
+    def _peer_addresses(self):
+        return [(node.host, node.gossip_port) for node in self.nodes.values()
+                if node is not self.me and node.node_id in self.ring.nodes]
+
+    def _gossip_targets(self):
+        peers = self._peer_addresses()
+        targets = random.sample(peers, min(GOSSIP_FANOUT, len(peers)))
+        known = set(peers)
+        # Seeds we have not heard from yet: how a new node finds the cluster
+        targets += [seed for seed in self.seeds if seed not in known and seed != (self.me.host, self.gossip_port)]
+        return targets
+
+    def _send(self, message, address):
+        try:
+            self.socket.sendto(message, address)
+        except OSError as e:
+            log.warning("[Cluster] Gossip to %s:%s failed: %s", address[0], address[1], e, hot="gossip_error")
+
+    def _merge(self, message, now):
+        if "rooms" in message:
+            self._merge_rooms(message)
+            return
+        for node_id, entry in message["members"].items():
+            if node_id == self.node_id:
+                continue
+            host, tcp_port, udp_port, gossip_port, incarnation, heartbeat, left = entry
+            node = self.nodes.get(node_id)
+            if node is None:
+                self.nodes[node_id] = node = Cluster_Node(node_id, host, tcp_port, udp_port, gossip_port,
+                                                          incarnation, heartbeat)
+                node.left = left
+                if node_id != message["from"]:
+                    node.seen_at = now - FAIL_TIMEOUT
+            elif (incarnation, heartbeat) > (node.incarnation, node.heartbeat):
+                node.host, node.tcp_port, node.udp_port, node.gossip_port = host, tcp_port, udp_port, gossip_port
+                node.incarnation, node.heartbeat, node.left = incarnation, heartbeat, left
+                node.seen_at = now
+        self._update_ring(now)
+
+    def _merge_rooms(self, message):
+        node_id = message["from"]
+        node = self.nodes.get(node_id)
+        if node is None or node.incarnation != message["incarnation"]:
+            return
+        round_, parts, chunks = self.parts.get(node_id, (None, 0, None))
+        if round_ != message["round"]:
+            round_, parts, chunks = message["round"], message["parts"], {}
+            self.parts[node_id] = (round_, parts, chunks)
+        chunks[message["part"]] = message["rooms"]
+        if len(chunks) < parts:
+            return
+        # A whole list: it replaces whatever this node held before
+        del self.parts[node_id]
+        held = {room: holder for room, holder in self.held.items() if holder != node_id}
+        for chunk in chunks.values():
+            for room in chunk:
+                held[room] = node_id
+        self.held = held
+
+    def _update_ring(self, now):
+        for node_id in [node_id for node_id, node in self.nodes.items() if now - node.seen_at > FORGET_AFTER]:
+            if node_id != self.node_id:
+                del self.nodes[node_id]
+        live = [node_id for node_id, node in self.nodes.items()
+                if node is self.me or (not node.left and now - node.seen_at < FAIL_TIMEOUT)]
+        if set(live) == self.ring.nodes:
+            return
+        added = set(live) - self.ring.nodes
+        removed = self.ring.nodes - set(live)
+        # Readers on the TCP threads only ever see a whole ring or map
+        self.ring = Hash_Ring(live)
+        if removed:
+            self.held = {room: holder for room, holder in self.held.items() if holder not in removed}
+        for node_id in removed:
+            self.parts.pop(node_id, None)
+        log.info("[Cluster] Ring now has %d nodes; joined: %s; left: %s", len(live),
+                 ", ".join(sorted(added)) or "-", ", ".join(sorted(removed)) or "-")
@@ -0,0 +1,117 @@
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from protocol.ucrp import build_batch_message, BATCH_HEADER_SIZE, BATCH_FRAME_PREFIX
+import metrics
+
+# Outbound coalescing (opt-in): instead of one datagram per message per
+# recipient, relayed messages are queued per recipient address and sent as
+# one UCRP batch datagram when the oldest queued message is `window`
+# seconds old, or earlier when the next message would push the datagram
+# past `budget` bytes. Added latency is bounded by the window.
+#
+# Members of a room are queued by the same broadcasts, so they normally
+# hold the same frames; a flush groups addresses with identical queues and
+# sends each group's batch through one broadcast (one sendmmsg call).
+# Addresses whose client does not read batches (batches(addr) is false) are
+# sent the group's frames one by one instead.
+#
+# The coalescer has no timer of its own: the server calls flush_due() when
+# next_deadline() passes.
+
+COALESCE_BYTES = 1200   # stays inside one IPv4 packet on a 1280+ byte MTU path
+
+COALESCED_MESSAGES = metrics.counter("chat_udp_coalesced_messages_total", "Message deliveries packed into multi-message datagrams")
+
+class Coalescer:
+    def __init__(self, send, window, budget=COALESCE_BYTES, batches=None):
+        self.send = send          # send(payload, addrs) -> (sent, failed)
+        self.window = window
+        self.budget = budget
+        self.batches = batches    # batches(addr) -> bool; None = every address reads them
+        self.pending = {}         # addr -> [deadline, size, frames], oldest first
+
+    def add(self, frame, addrs, now):
+        # Queues frame for every address; returns (sent, failed) for
+        # anything that had to go out immediately
+        size = len(frame) + BATCH_FRAME_PREFIX
+        if BATCH_HEADER_SIZE + size > self.budget:
+            sent, failed = self.flush(addrs)
+            s, f = self.send(frame, addrs)
+            return sent + s, failed + f
+
+        pending = self.pending
+        deadline = now + self.window
+        full = []
+        for addr in addrs:
+            entry = pending.get(addr)
+            if entry is None:
+                pending[addr] = [deadline, BATCH_HEADER_SIZE + size, [frame]]
+            elif entry[1] + size > self.budget:
+                full.append(addr)
+            else:
+                entry[1] += size
+                entry[2].append(frame)
+        if not full:
+            return 0, 0
+        sent, failed = self.flush(full)
+        for addr in full:
+            pending[addr] = [deadline, BATCH_HEADER_SIZE + size, [frame]]
+        return sent, failed
+
+    def next_deadline(self):
+        for entry in self.pending.values():
+            return entry[0]
+        return None
+
+    def flush_due(self, now):
+        due = []
+        for addr, entry in self.pending.items():
+            if entry[0] > now:
+                break
+            due.append(addr)
+        return self.flush(due)
+
+    def flush_all(self):
+        return self.flush(list(self.pending))
+
+    def flush(self, addrs):
+        groups = {}
+        for addr in addrs:
+            entry = self.pending.pop(addr, None)
+            if entry is None:
+                continue
+            frames = entry[2]
+            # The same frame objects are shared by every recipient of a broadcast
+            key = tuple(map(id, frames))
+            group = groups.get(key)
+            if group is None:
+                groups[key] = (frames, [addr])
+            else:
+                group[1].append(addr)
+
+        sent = failed = 0
+        for frames, group_addrs in groups.values():
+            if len(frames) == 1:
+                payload = frames[0]
+            else:
+                if self.batches is not None:
+                    batched = []
+                    single = []
+                    for addr in group_addrs:
+                        (batched if self.batches(addr) else single).append(addr)
+                    if single:
+                        for frame in frames:
+                            s, f = self.send(frame, single)
+                            sent += s
+                            failed += f
+                    if not batched:
+                        continue
+                    group_addrs = batched
+                payload = build_batch_message(frames)
+                COALESCED_MESSAGES.value += len(frames) * len(group_addrs)
+            s, f = self.send(payload, group_addrs)
+            sent += s
+            failed += f
+        return sent, failed
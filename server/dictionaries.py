@@ -0,0 +1,55 @@
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from protocol.compress import PRESET_DICTIONARY, dictionary_checksum
+from logger import get_logger
+
+log = get_logger("dictionaries")
+
+# Compression dictionaries handed to clients in the TCRP handshake.
+#
+# A room uses dictionaries/<room name>.zdict from the working directory if
+# there is one, else dictionaries/default.zdict, else the built-in preset.
+# bench/compression_bench.py --write-dictionary trains one from a corpus.
+# The directory is listed once at startup, so a join costs no file system
+# lookup and a room name is never used to build a path; a file is read the
+# first time its room is asked for. A room keeps the dictionary it started
+# with for as long as the server runs.
+
+DICTIONARY_DIR = "dictionaries"
+DICTIONARY_SUFFIX = ".zdict"
+
+class Room_Dictionaries:
+    def __init__(self, directory=DICTIONARY_DIR):
+        self.files = {}
+        try:
+            for name in os.listdir(directory):
+                if name.endswith(DICTIONARY_SUFFIX):
+                    self.files[name[:-len(DICTIONARY_SUFFIX)]] = os.path.join(directory, name)
+        except FileNotFoundError:
+            pass
+        self.loaded = {}
+        self.default = self._read("default") or PRESET_DICTIONARY
+        if self.files:
+            log.info("%d compression dictionaries found in %s", len(self.files), directory)
+
+    def _read(self, name):
+        path = self.files.get(name)
+        if path is None:
+            return None
+        dictionary = self.loaded.get(name)
+        if dictionary is None:
+            try:
+                with open(path, 'rb') as f:
+                    dictionary = f.read()
+            except OSError as e:
+                log.warning("Ignoring %s: %s", path, e)
+                dictionary = b""
+            self.loaded[name] = dictionary
+        return dictionary or None
+
+    def get(self, room_name):
+        # (dictionary checksum, dictionary bytes) for the room
+        dictionary = (self._read(room_name) if room_name != "default" else None) or self.default
+        return dictionary_checksum(dictionary), dictionary
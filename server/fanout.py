@@ -0,0 +1,167 @@
+import ctypes
+import ctypes.util
+import errno
+import socket
+import sys
+from collections import OrderedDict
+
+# sendmmsg(2) is not exposed by the socket module, so it is called through
+# libc. Where it is unavailable (non-Linux, non-AF_INET sockets, asyncio
+# transports) Fanout falls back to one sendto per recipient.
+
+SENDMMSG_MAX = 1024   # UIO_MAXIOV: the kernel caps vlen at this
+PLAN_CACHE_SIZE = 256
+
+class _IOVec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+class _SockaddrIn(ctypes.Structure):
+    _fields_ = [
+        ("sin_family", ctypes.c_ushort),
+        ("sin_port", ctypes.c_uint16),
+        ("sin_addr", ctypes.c_uint32),
+        ("sin_zero", ctypes.c_ubyte * 8),
+    ]
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(_IOVec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _MsgHdr), ("msg_len", ctypes.c_uint)]
+
+def _load_sendmmsg():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        func = libc.sendmmsg
+    except (OSError, AttributeError):
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+    func.restype = ctypes.c_int
+    return func
+
+_sendmmsg = _load_sendmmsg()
+
+class _Plan:
+    # Prebuilt mmsghdr vector for one recipient list. Every entry points at the
+    # same two iovecs, so a broadcast only has to repoint them at the payload;
+    # the second is empty unless the payload is sent in two parts.
+    def __init__(self, addrs):
+        n = len(addrs)
+        self.count = n
+        self.iov = (_IOVec * 2)()
+        self.names = (_SockaddrIn * n)()
+        self.msgs = (_MMsgHdr * n)()
+        iov_ptr = ctypes.cast(self.iov, ctypes.POINTER(_IOVec))
+        name_size = ctypes.sizeof(_SockaddrIn)
+        for i, (ip, port) in enumerate(addrs):
+            name = self.names[i]
+            name.sin_family = socket.AF_INET
+            name.sin_port = socket.htons(port)
+            name.sin_addr = int.from_bytes(socket.inet_aton(ip), sys.byteorder)
+            hdr = self.msgs[i].msg_hdr
+            hdr.msg_name = ctypes.addressof(name)
+            hdr.msg_namelen = name_size
+            hdr.msg_iov = iov_ptr
+            hdr.msg_iovlen = 2
+
+class Fanout:
+    def __init__(self, sock, sendto=None):
+        self.sock = sock
+        self.sendto = sendto or sock.sendto
+        self._plans = OrderedDict()
+        self.batched = (
+            _sendmmsg is not None
+            and isinstance(sock, socket.socket)
+            and sock.family == socket.AF_INET
+        )
+
+    def send(self, payload: bytes, addrs: list) -> tuple[int, int]:
+        if not addrs:
+            return 0, 0
+        if not self.batched or len(addrs) == 1:
+            return self.send_each(payload, addrs)
+        plan = self._plan(addrs)
+        if plan is None:
+            return self.send_each(payload, addrs)
+        return self._send_plan(plan, payload, addrs)
+
+    def send_parts(self, head: bytes, data: bytes, offset: int, addrs: list) -> tuple[int, int]:
+        # Sends head + data[offset:] without building it: sendmmsg gathers
+        # both parts, so the tail of a received datagram is relayed in place
+        if not addrs:
+            return 0, 0
+        plan = self._plan(addrs) if self.batched and len(addrs) > 1 else None
+        if plan is None:
+            return self.send_each(head + data[offset:], addrs)
+        return self._send_plan(plan, head, addrs, data, offset)
+
+    def _plan(self, addrs):
+        key = tuple(addrs)
+        plan = self._plans.get(key)
+        if plan is None:
+            try:
+                plan = _Plan(key)
+            except (OSError, TypeError, ValueError, OverflowError):
+                # Hostnames or non-IPv4 addresses cannot be packed into sockaddr_in
+                return None
+            self._plans[key] = plan
+            if len(self._plans) > PLAN_CACHE_SIZE:
+                self._plans.popitem(last=False)
+        else:
+            self._plans.move_to_end(key)
+        return plan
+
+    def _send_plan(self, plan, payload, addrs, tail=None, tail_start=0):
+        buf = ctypes.c_char_p(payload)
+        plan.iov[0].iov_base = ctypes.cast(buf, ctypes.c_void_p)
+        plan.iov[0].iov_len = len(payload)
+        if tail is None:
+            plan.iov[1].iov_len = 0
+        else:
+            plan.iov[1].iov_base = ctypes.cast(ctypes.c_char_p(tail), ctypes.c_void_p).value + tail_start
+            plan.iov[1].iov_len = len(tail) - tail_start
+        base = ctypes.addressof(plan.msgs)
+        entry_size = ctypes.sizeof(_MMsgHdr)
+        fd = self.sock.fileno()
+
+        sent = failed = 0
+        offset = 0
+        while offset < plan.count:
+            vlen = min(plan.count - offset, SENDMMSG_MAX)
+            result = _sendmmsg(fd, base + offset * entry_size, vlen, 0)
+            if result > 0:
+                sent += result
+                offset += result
+                continue
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            # The kernel reports the error of the first unsent message; retry it
+            # alone so per-recipient failures (or EAGAIN buffering) are handled
+            # exactly as in the unbatched path.
+            if tail is not None:
+                payload, tail = payload + tail[tail_start:], None
+            s, f = self.send_each(payload, addrs[offset:offset + 1])
+            sent += s
+            failed += f
+            offset += 1
+        return sent, failed
+
+    def send_each(self, payload: bytes, addrs: list) -> tuple[int, int]:
+        sent = failed = 0
+        sendto = self.sendto
+        for addr in addrs:
+            try:
+                sendto(payload, addr)
+                sent += 1
+            except OSError:
+                failed += 1
+        return sent, failed
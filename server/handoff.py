@@ -0,0 +1,348 @@
+import json
+import os
+import queue
+import socket
+import struct
+import threading
+import time
+
+from journal import apply_event
+from logger import get_logger
+from snapshot import encode_snapshot, load_snapshot, encode_streams, decode_streams
+
+log = get_logger("handoff")
+
+# Zero-downtime restart.
+#
+# A running server listens on HANDOFF_SOCKET, a Unix socket in its working
+# directory. A second server.py started in the same directory connects to
+# it instead of binding its own ports, and the old process hands over:
+#
+#   1. It stops handling UDP packets; whatever it still reads from here on
+#      is passed to the new process. TCP handshakes go on.
+#   2. It takes a binary snapshot of RoomManager (snapshot.py) and of the
+#      reliable delivery streams, closes its journal, and sends both with
+#      its listening TCP, UDP, gossip and metrics sockets attached
+#      (SCM_RIGHTS). From now on the sessions its handshakes create are
+#      sent to the new process as journal events instead of journaled.
+#   3. The new process loads the snapshot and serves on the same sockets:
+#      datagrams and connections waiting in the kernel are not lost, and
+#      no client has to join again. It says it is ready.
+#   4. The old process stops reading and accepting, answers the requests
+#      it had already accepted for up to DRAIN_TIMEOUT, closing connections
+#      idle between requests, then says it is done and exits. The new
+#      process takes over HANDOFF_SOCKET for the next restart.
+#
+# Until the state frame is sent, a failure (the new process exits, another
+# user connects, a step above raises) undoes steps 1 and 2 and this process
+# goes on serving, waiting for the next successor.
+#
+# Frames on the Unix socket are a kind byte and a u32 length. The sockets
+# travel on a single byte of their own, ahead of the state frame.
+#
+#   H  request, new -> old
+#   S  state: u32 header length, JSON header, snapshot, reliable streams (snapshot.py)
+#   R  ready, new -> old
+#   E  journal event [event, data] (JSON)
+#   P  packet read by the old process: inet_aton(ip)(4B) + port(2B) + raw packet
+#   D  done, old -> new
+
+HANDOFF_SOCKET = "handoff.sock"
+DRAIN_TIMEOUT = 10.0   # seconds for accepted handshakes to finish (the asyncio engine's read timeout)
+MAX_SOCKETS = 8
+REQUEST_TIMEOUT = 5.0  # seconds for a connecting process to ask for the state
+
+REQUEST = b'H'
+STATE = b'S'
+READY = b'R'
+EVENT = b'E'
+PACKET = b'P'
+DONE = b'D'
+
+_FRAME = struct.Struct('!cI')
+_U32 = struct.Struct('!I')
+_PACKET = struct.Struct('!4sH')
+_PEERCRED = struct.Struct('3i')  # pid, uid, gid
+
+def _frame(kind, payload=b""):
+    return _FRAME.pack(kind, len(payload)) + payload
+
+def _recv_exactly(sock, size):
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:])
+        if not n:
+            raise ConnectionError("Handoff connection closed")
+        received += n
+    return buffer
+
+def _read_frame(sock):
+    kind, length = _FRAME.unpack(_recv_exactly(sock, _FRAME.size))
+    return kind, _recv_exactly(sock, length)
+
+def _encode_item(item):
+    if item[0] == EVENT:
+        _, event, data = item
+        return _frame(EVENT, json.dumps([event, data], separators=(',', ':')).encode('utf-8'))
+    _, data, address = item
+    return _frame(PACKET, _PACKET.pack(socket.inet_aton(address[0]), address[1]) + data)
+
+def connect_handoff(path=HANDOFF_SOCKET):
+    # A Handoff from the server running in this directory, None if none is
+    if not os.path.exists(path):
+        return None
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(path)
+    except OSError:
+        # Left behind by a server that did not stop cleanly
+        conn.close()
+        return None
+    return Handoff(conn)
+
+class Handoff:
+    # The new process's end
+    def __init__(self, conn):
+        self.conn = conn
+        self.sockets = {}
+        self.streams = {}
+        self.journal_seq = 0
+        self.state_backend = "journal"
+
+    def receive(self, room_manager):
+        started = time.monotonic()
+        self.conn.sendall(_frame(REQUEST))
+        _, fds, _, _ = socket.recv_fds(self.conn, 1, MAX_SOCKETS)
+        kind, payload = _read_frame(self.conn)
+        if kind != STATE:
+            raise ConnectionError(f"Unexpected handoff frame {kind!r}")
+        header_size = _U32.unpack_from(payload)[0]
+        header = json.loads(payload[_U32.size:_U32.size + header_size])
+        self.sockets = {name: socket.socket(fileno=fd) for name, fd in zip(header["sockets"], fds)}
+        body = memoryview(payload)[_U32.size + header_size:]
+        load_snapshot(room_manager, body[:header["snapshot"]])
+        self.streams = decode_streams(body[header["snapshot"]:])
+        self.journal_seq = header["journal_seq"]
+        self.state_backend = header["state_backend"]
+        log.info("[Handoff] Took over %s sockets, %d rooms, %d sessions (%d bytes, %.3fs)", ", ".join(self.sockets),
+                 len(room_manager.rooms), len(room_manager.tokens), len(payload), time.monotonic() - started)
+
+    def follow(self, room_manager, udp_server):
+        # Runs once this process serves: applies what the old one passes on
+        # until it has drained
+        self.conn.sendall(_frame(READY))
+        events = packets = 0
+        try:
+            while True:
+                kind, payload = _read_frame(self.conn)
+                if kind == EVENT:
+                    event, data = json.loads(payload)
+                    apply_event(room_manager, event, data, announce=True)
+                    events += 1
+                elif kind == PACKET:
+                    ip, port = _PACKET.unpack_from(payload)
+                    udp_server.inject(bytes(payload[_PACKET.size:]), (socket.inet_ntoa(ip), port))
+                    packets += 1
+                elif kind == DONE:
+                    break
+        except (OSError, ValueError) as e:
+            log.warning("[Handoff] Previous server went away while draining: %s", e)
+        finally:
+            self.conn.close()
+        log.info("[Handoff] Previous server finished: %d events and %d packets passed on", events, packets)
+
+class Handoff_Listener:
+    # The running server's end: hands everything to the next server.py
+    # started in the same directory. done is set once it has.
+    def __init__(self, room_manager, journal, tcp_server, udp_server, cluster=None, metrics_server=None,
+                 state_backend="journal", path=HANDOFF_SOCKET):
+        self.room_manager = room_manager
+        self.journal = journal
+        self.tcp_server = tcp_server
+        self.udp_server = udp_server
+        self.cluster = cluster
+        self.metrics_server = metrics_server
+        self.state_backend = state_backend
+        self.path = path
+        self.sock = None
+        self.thread = None
+        self.done = threading.Event()
+
+    def start(self, predecessor=None):
+        self.thread = threading.Thread(target=self._run, args=(predecessor,), name="handoff", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.sock:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.sock.close()
+            self.sock = None
+            if not self.done.is_set():
+                os.unlink(self.path)
+
+    def _run(self, predecessor):
+        if predecessor is not None:
+            predecessor.follow(self.room_manager, self.udp_server)
+        try:
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.bind(self.path)
+            os.chmod(self.path, 0o600)
+            self.sock.listen(1)
+        except OSError as e:
+            log.warning("Handoff socket %s not available (%s); restarts will not be seamless", self.path, e)
+            return
+        log.info("[Handoff] Waiting for a successor on %s", self.path)
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            try:
+                outbox = self._send_state(conn)
+            except Exception as e:
+                # Nothing was handed over: keep serving and wait for the next one
+                log.warning("[Handoff] Successor failed before taking over (%s); still serving", e)
+                conn.close()
+                continue
+            # The new process holds the sockets and the state: this one stops
+            # whatever happens from here on
+            try:
+                self._drain(conn, outbox)
+            except Exception as e:
+                log.error("[Handoff] Failed while draining: %s", e)
+            finally:
+                conn.close()
+                self.done.set()
+            return
+
+    def _sockets(self):
+        sockets = [("tcp", self.tcp_server.socket), ("udp", self.udp_server.udp_sock)]
+        if self.cluster is not None and self.cluster.socket is not None:
+            sockets.append(("gossip", self.cluster.socket))
+        if self.metrics_server is not None and self.metrics_server.httpd is not None:
+            sockets.append(("metrics", self.metrics_server.httpd.socket))
+        return sockets
+
+    def _check_peer(self, conn):
+        # Only a process of the same user gets the sockets and tokens
+        _, uid, _ = _PEERCRED.unpack(conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, _PEERCRED.size))
+        if uid != os.getuid():
+            raise PermissionError(f"Handoff requested by uid {uid}")
+
+    def _send_state(self, conn):
+        # Returns the queue of what the new process must be passed while
+        # this one drains. Until the state frame is out, a failure puts
+        # everything back as it was and raises.
+        self._check_peer(conn)
+        conn.settimeout(REQUEST_TIMEOUT)
+        kind, _ = _read_frame(conn)
+        if kind != REQUEST:
+            raise ConnectionError(f"Unexpected handoff frame {kind!r}")
+        conn.settimeout(None)
+        started = time.monotonic()
+        # (EVENT, event, data) and (PACKET, data, address), framed as they are sent
+        outbox = queue.SimpleQueue()
+
+        def forward_event(event, data):
+            outbox.put((EVENT, event, data))
+
+        def forward_packet(data, address):
+            outbox.put((PACKET, data, address))
+
+        room_manager = self.room_manager
+        udp_paused = self.udp_server.hand_off(forward_packet)
+        try:
+            if not udp_paused:
+                raise RuntimeError("UDP server did not pause")
+            with room_manager.lock:
+                snapshot = encode_snapshot(room_manager)
+                room_manager.remove_listener(self.journal.record)
+                room_manager.add_listener(forward_event)
+            try:
+                streams = encode_streams(self.udp_server.reliable.streams)
+                self.journal.close()
+                sockets = self._sockets()
+                header = json.dumps({"journal_seq": self.journal.seq, "state_backend": self.state_backend,
+                                     "sockets": [name for name, _ in sockets],
+                                     "snapshot": len(snapshot)}).encode('utf-8')
+                socket.send_fds(conn, [b"F"], [sock.fileno() for _, sock in sockets])
+                conn.sendall(_frame(STATE, _U32.pack(len(header)) + header + snapshot + streams))
+            except Exception:
+                self._take_back(forward_event, outbox)
+                raise
+        except Exception:
+            self.udp_server.resume()
+            # Packets read meanwhile are handled here after all
+            self._replay(outbox)
+            raise
+        paused = time.monotonic() - started
+        log.info("[Handoff] Sent %d sessions (%d bytes) in %.3fs", len(room_manager.tokens), len(snapshot), paused)
+        return outbox
+
+    def _take_back(self, forward_event, outbox):
+        # The journal takes RoomManager's events again, starting with those
+        # queued for the new process
+        room_manager = self.room_manager
+        with room_manager.lock:
+            room_manager.remove_listener(forward_event)
+            if self.journal.thread is None:
+                self.journal.attach(room_manager)
+            else:
+                room_manager.add_listener(self.journal.record)
+            packets = []
+            while True:
+                try:
+                    item = outbox.get_nowait()
+                except queue.Empty:
+                    break
+                if item[0] == EVENT:
+                    self.journal.record(item[1], item[2])
+                else:
+                    packets.append(item)
+        for item in packets:
+            outbox.put(item)
+
+    def _replay(self, outbox):
+        while True:
+            try:
+                _, data, address = outbox.get_nowait()
+            except queue.Empty:
+                return
+            self.udp_server.inject(data, address)
+
+    def _drain(self, conn, outbox):
+        started = time.monotonic()
+        kind, _ = _read_frame(conn)
+        if kind != READY:
+            raise ConnectionError(f"Unexpected handoff frame {kind!r}")
+        self.tcp_server.drain()
+        self.udp_server.stop_forwarding()
+        deadline = time.monotonic() + DRAIN_TIMEOUT
+        while self.tcp_server.active_connections and time.monotonic() < deadline:
+            self._send_queued(conn, outbox, 0.05)
+        self._send_queued(conn, outbox, None)
+        conn.sendall(_frame(DONE))
+        log.info("[Handoff] Done in %.2fs (%d connections left unfinished)", time.monotonic() - started,
+                 self.tcp_server.active_connections)
+
+    def _send_queued(self, conn, outbox, timeout):
+        frames = []
+        if timeout is not None:
+            try:
+                frames.append(outbox.get(timeout=timeout))
+            except queue.Empty:
+                return
+        while True:
+            try:
+                frames.append(outbox.get_nowait())
+            except queue.Empty:
+                break
+        if frames:
+            conn.sendall(b"".join(map(_encode_item, frames)))
@@ -0,0 +1,147 @@
+import sys
+from collections import OrderedDict
+
+import metrics
+
+# Recent messages per room, replayed to a client when it registers.
+#
+# Each room with traffic gets a ring of preallocated slots holding the
+# encoded frames exactly as they were relayed (build_udp_message output),
+# so nothing is re-encoded for a catch-up. A ring is bounded both by
+# message count and by bytes; the oldest frames make room for new ones.
+#
+# All rings together are bounded by `total_bytes`, counted as the size of
+# the frame objects plus each ring's slot array. Rings are kept in order
+# of their last message; when the total is over the cap, frames are
+# dropped from the least recently active room first, and a ring that
+# empties is released.
+#
+# Every frame recorded gets a position, increasing per room even across a
+# ring being released and recreated. position() is where a room's history
+# stands now; recent(room, after) leaves out what came up to `after`, so a
+# client whose address changed is replayed only what it may have missed.
+#
+# Fragments of large messages are not recorded: one message can take more
+# than a room's byte budget, and evicting its first fragments would replay
+# the rest as a message no receiver can put back together.
+
+HISTORY_MESSAGES = 50                  # frames kept per room; 0 disables history
+HISTORY_ROOM_BYTES = 32 * 1024         # frame bytes kept per room
+HISTORY_TOTAL_BYTES = 64 * 1024 * 1024 # all rooms together
+
+HISTORY_EVICTED = metrics.counter("chat_udp_history_evicted_total", "History frames dropped to make room", ("reason",))
+EVICTED_ROOM = HISTORY_EVICTED.labels("room_limit")
+EVICTED_TOTAL = HISTORY_EVICTED.labels("total_limit")
+
+_FRAME_OVERHEAD = sys.getsizeof(b"")
+
+class MessageRing:
+    __slots__ = ("slots", "start", "count", "total", "bytes", "max_bytes", "overhead")
+
+    def __init__(self, capacity, max_bytes, total=0):
+        self.slots = [None] * capacity
+        self.start = 0
+        self.count = 0
+        self.total = total   # position of the newest frame; the oldest held is total - count + 1
+        self.bytes = 0
+        self.max_bytes = max_bytes
+        self.overhead = sys.getsizeof(self.slots)
+
+    def append(self, frame, size):
+        # Returns the change in bytes held
+        slots = self.slots
+        start = self.start
+        freed = 0
+        self.total += 1
+        if self.count == len(slots):
+            # Full: the new frame takes the oldest one's slot
+            freed = len(slots[start]) + _FRAME_OVERHEAD
+            slots[start] = frame
+            self.start = (start + 1) % len(slots)
+            EVICTED_ROOM.value += 1
+        else:
+            slots[(start + self.count) % len(slots)] = frame
+            self.count += 1
+        self.bytes += size - freed
+        while self.bytes > self.max_bytes and self.count > 1:
+            freed += self.pop_oldest()
+            EVICTED_ROOM.value += 1
+        return size - freed
+
+    def pop_oldest(self):
+        slots = self.slots
+        frame = slots[self.start]
+        slots[self.start] = None
+        self.start = (self.start + 1) % len(slots)
+        self.count -= 1
+        size = len(frame) + _FRAME_OVERHEAD
+        self.bytes -= size
+        return size
+
+    def frames(self):
+        slots = self.slots
+        end = self.start + self.count
+        if end <= len(slots):
+            return slots[self.start:end]
+        return slots[self.start:] + slots[:end - len(slots)]
+
+class Message_History:
+    def __init__(self, messages=HISTORY_MESSAGES, room_bytes=HISTORY_ROOM_BYTES, total_bytes=HISTORY_TOTAL_BYTES):
+        self.messages = messages
+        self.room_bytes = room_bytes
+        self.total_bytes = total_bytes
+        self.rings = OrderedDict()   # room_name -> MessageRing, least recently active first
+        self.bytes = 0
+        self.seq = 0                 # frames recorded in all rooms; a new ring starts from here
+
+    def record(self, room_name, frame):
+        if not self.messages:
+            return
+        size = len(frame) + _FRAME_OVERHEAD
+        if size > self.room_bytes:
+            return
+        self.seq += 1
+        ring = self.rings.get(room_name)
+        if ring is None:
+            ring = self.rings[room_name] = MessageRing(self.messages, self.room_bytes, self.seq - 1)
+            self.bytes += ring.overhead
+        else:
+            self.rings.move_to_end(room_name)
+        self.bytes += ring.append(frame, size)
+        if self.bytes > self.total_bytes:
+            self._evict()
+
+    def _evict(self):
+        rings = self.rings
+        while self.bytes > self.total_bytes and rings:
+            room_name = next(iter(rings))
+            ring = rings[room_name]
+            self.bytes -= ring.pop_oldest()
+            EVICTED_TOTAL.value += 1
+            if not ring.count:
+                del rings[room_name]
+                self.bytes -= ring.overhead
+
+    def recent(self, room_name, after=None):
+        ring = self.rings.get(room_name)
+        if ring is None:
+            return []
+        frames = ring.frames()
+        if after is not None:
+            skip = after - (ring.total - ring.count)
+            if skip > 0:
+                return frames[skip:]
+        return frames
+
+    def position(self, room_name):
+        ring = self.rings.get(room_name)
+        return ring.total if ring is not None else self.seq
+
+    def drop(self, room_name):
+        ring = self.rings.pop(room_name, None)
+        if ring is not None:
+            self.bytes -= ring.bytes + ring.overhead
+
+    def clear(self):
+        self.rings.clear()
+        self.bytes = 0
@@ -0,0 +1,217 @@
+from datetime import datetime
+import json
+import os
+import queue
+import threading
+import time
+
+from logger import get_logger
+from room_manager import RoomManager
+
+log = get_logger("journal")
+
+# Append-only persistence for RoomManager.
+#
+# Every mutation RoomManager reports to its listeners ("session", "register",
+# "leave") is queued as-is and written by a background thread as one compact
+# JSON line: [seq, event, data]. The caller only pays for a queue put, so the
+# cost of an event does not depend on how many rooms and tokens exist.
+#
+# After COMPACT_EVERY records the writer folds the journal into a snapshot
+# (room_manager.json format plus "journal_seq") by replaying snapshot+journal
+# into a scratch RoomManager on its own thread, then starts a new journal.
+# Replay skips records whose seq is already covered by the snapshot, so a
+# crash at any point of compaction is safe.
+#
+# Writes are fsynced at most every FSYNC_INTERVAL. A batch written inside
+# the interval is fsynced once it runs out, whether or not more events come.
+
+JOURNAL_FILE = "room_manager.journal"
+SNAPSHOT_FILE = "room_manager.json"
+FSYNC_INTERVAL = 0.05   # seconds; 0 = fsync every batch, None = leave it to the OS
+COMPACT_EVERY = 50000   # records
+
+_STOP = object()
+
+def apply_event(room_manager, event, data, announce=False):
+    if event == "session":
+        address = data["address"]
+        room_manager.add_session(
+            data["token"], data["room_name"], data["username"], data["is_host"],
+            tuple(address) if address else None, data["created_at"], data.get("session_id"), announce,
+            data.get("codec"), data.get("extended", False)
+        )
+    elif event == "register":
+        address = data["address"]
+        room_manager.register_address(data["token"], tuple(address) if address else None)
+    elif event == "leave":
+        if data["token"] in room_manager.tokens:
+            room_manager.delete_room_if_host_left(data["room_name"], data["token"])
+
+class Journal:
+    def __init__(self, journal_path=JOURNAL_FILE, snapshot_path=SNAPSHOT_FILE,
+                 fsync_interval=FSYNC_INTERVAL, compact_every=COMPACT_EVERY):
+        self.journal_path = journal_path
+        self.snapshot_path = snapshot_path
+        self.fsync_interval = fsync_interval
+        self.compact_every = compact_every
+        self.seq = 0
+        self.snapshot_seq = 0
+        self.records_since_compact = 0
+        self.queue = queue.SimpleQueue()
+        self.file = None
+        self.thread = None
+
+    def restore(self, room_manager):
+        # Replaces load_from_json at startup: snapshot first, then the journal tail
+        if os.path.exists(self.snapshot_path):
+            room_manager.load_from_json(self.snapshot_path)
+            self.snapshot_seq = self._read_snapshot_seq()
+        self.seq = self.snapshot_seq
+        replayed = 0
+        for seq, event, data in self._read_journal():
+            if seq <= self.snapshot_seq:
+                continue
+            apply_event(room_manager, event, data)
+            self.seq = seq
+            replayed += 1
+        self.records_since_compact = replayed
+        log.info("[Journal] Restored %d rooms, %d tokens (snapshot seq %d, %d journal records replayed)",
+                 len(room_manager.rooms), len(room_manager.tokens), self.snapshot_seq, replayed)
+
+    def resume(self, seq):
+        # Replaces restore() when the previous process handed its state over
+        # (handoff.py): it wrote the journal up to seq, this one goes on from there
+        self.snapshot_seq = self._read_snapshot_seq()
+        self.seq = seq
+        self.records_since_compact = max(0, seq - self.snapshot_seq)
+        log.info("[Journal] Continuing from seq %d after a handoff", seq)
+
+    def attach(self, room_manager):
+        room_manager.add_listener(self.record)
+        self.file = open(self.journal_path, 'ab')
+        self.thread = threading.Thread(target=self._writer, name="journal-writer", daemon=True)
+        self.thread.start()
+
+    def record(self, event, data):
+        self.queue.put((event, data))
+
+    def close(self):
+        if self.thread:
+            self.queue.put(_STOP)
+            self.thread.join()
+            self.thread = None
+
+    def _writer(self):
+        last_fsync = time.monotonic()
+        dirty = False   # written since the last fsync
+        while True:
+            timeout = None
+            if dirty and self.fsync_interval is not None:
+                timeout = max(0.0, last_fsync + self.fsync_interval - time.monotonic())
+            try:
+                batch = [self.queue.get(timeout=timeout)]
+            except queue.Empty:
+                self._fsync()
+                last_fsync = time.monotonic()
+                dirty = False
+                continue
+            # Drain whatever else is already waiting into the same write
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stopping = False
+            lines = []
+            for item in batch:
+                if item is _STOP:
+                    stopping = True
+                    continue
+                self.seq += 1
+                event, data = item
+                lines.append(json.dumps([self.seq, event, data], separators=(',', ':'), ensure_ascii=False))
+            if lines:
+                try:
+                    self.file.write(("\n".join(lines) + "\n").encode('utf-8'))
+                    self.file.flush()
+                except OSError as e:
+                    log.error("[Journal] Write error: %s", e)
+                self.records_since_compact += len(lines)
+                dirty = True
+
+            now = time.monotonic()
+            if stopping or (dirty and self.fsync_interval is not None and now - last_fsync >= self.fsync_interval):
+                self._fsync()
+                last_fsync = now
+                dirty = False
+
+            if self.records_since_compact >= self.compact_every:
+                self._compact()
+                dirty = False
+            if stopping:
+                self.file.close()
+                return
+
+    def _fsync(self):
+        try:
+            os.fsync(self.file.fileno())
+        except OSError as e:
+            log.error("[Journal] fsync error: %s", e)
+
+    def _compact(self):
+        self._fsync()
+        started = time.monotonic()
+        scratch = RoomManager()
+        if os.path.exists(self.snapshot_path):
+            scratch.load_from_json(self.snapshot_path)
+        for seq, event, data in self._read_journal():
+            if seq > self.snapshot_seq:
+                apply_event(scratch, event, data)
+
+        data = {
+            'rooms': scratch.export_rooms(),
+            'tokens': scratch.export_tokens(),
+            'saved_at': datetime.now().isoformat(),
+            'journal_seq': self.seq
+        }
+        tmp_path = self.snapshot_path + ".tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, separators=(',', ':'), ensure_ascii=False)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.snapshot_path)
+        except OSError as e:
+            log.error("[Journal] Compaction failed: %s", e)
+            return
+
+        self.snapshot_seq = self.seq
+        self.records_since_compact = 0
+        self.file.close()
+        self.file = open(self.journal_path, 'wb')
+        log.info("[Journal] Compacted into %s at seq %d (%d tokens, %.2fs)", self.snapshot_path, self.seq,
+                 len(scratch.tokens), time.monotonic() - started)
+
+    def _read_snapshot_seq(self):
+        try:
+            with open(self.snapshot_path, 'r', encoding='utf-8') as f:
+                return json.load(f).get('journal_seq', 0)
+        except (OSError, ValueError):
+            return 0
+
+    def _read_journal(self):
+        try:
+            f = open(self.journal_path, 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            for line in f:
+                try:
+                    seq, event, data = json.loads(line)
+                except ValueError:
+                    # A torn final line from a crash mid-write
+                    log.warning("[Journal] Skipping unreadable journal record")
+                    continue
+                yield seq, event, data
@@ -0,0 +1,207 @@
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+
+# Server logging.
+#
+# Modules log through get_logger(name), e.g.
+#     log.info("[Registered] Address registered", room=room_name, token=token, address=address)
+# Keyword arguments are structured fields appended to the line as key=value;
+# token is shortened to 8 hex digits and address to ip:port.
+#
+# Records are put on a bounded queue and written by one listener thread, so
+# the relay never waits on stdout and the server threads do not take turns
+# on its lock. A full queue drops the record (counted, and reported as
+# "(N dropped)" on the next line written).
+#
+# Per-packet call sites also pass hot="<key>". Those records are sampled
+# (1 in SAMPLE_EVERY) and rate-limited per key (RATE_LIMIT per second)
+# before a LogRecord is built; what was held back is reported as
+# "(N suppressed)". A call below the configured level returns after one
+# cached level check; per-packet DEBUG lines are additionally guarded with
+# `if log.debug_enabled:` (a plain attribute, refreshed by configure()) so
+# that with DEBUG off they do not even build their arguments.
+
+DEBUG = logging.DEBUG
+INFO = logging.INFO
+WARNING = logging.WARNING
+ERROR = logging.ERROR
+
+LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+
+LOG_LEVEL = "info"
+QUEUE_SIZE = 10000   # records waiting for the writer thread
+RATE_LIMIT = 20      # hot records per key per second
+SAMPLE_EVERY = 1     # keep 1 in N hot records before rate limiting
+
+ROOT_LOGGER = "chat"
+
+_lock = threading.Lock()
+_config = None
+_handler = None
+_listener = None
+_hot = None
+_loggers = []
+
+class _HotKeys:
+    def __init__(self, rate_limit, sample_every):
+        self.rate_limit = rate_limit
+        self.sample_every = sample_every
+        self.keys = {}   # key -> [allowance, last_refill, seen, suppressed]
+        self.lock = threading.Lock()
+
+    def admit(self, key):
+        # None to drop the record, else how many were dropped since the last one
+        with self.lock:
+            state = self.keys.get(key)
+            now = time.monotonic()
+            if state is None:
+                state = self.keys[key] = [float(self.rate_limit), now, 0, 0]
+            state[2] += 1
+            if self.sample_every > 1 and state[2] % self.sample_every:
+                state[3] += 1
+                return None
+            state[0] = min(self.rate_limit, state[0] + (now - state[1]) * self.rate_limit)
+            state[1] = now
+            if state[0] < 1:
+                state[3] += 1
+                return None
+            state[0] -= 1
+            suppressed = state[3]
+            state[3] = 0
+            return suppressed
+
+def token_prefix(token):
+    return token[6:14] if token.startswith("token_") else token[:8]
+
+class Logger:
+    __slots__ = ("logger", "debug_enabled")
+
+    def __init__(self, name):
+        self.logger = logging.getLogger(f"{ROOT_LOGGER}.{name}")
+        self.debug_enabled = self.logger.isEnabledFor(DEBUG)
+
+    def debug(self, msg, *args, **fields):
+        if self.logger.isEnabledFor(DEBUG):
+            self._log(DEBUG, msg, args, fields)
+
+    def info(self, msg, *args, **fields):
+        if self.logger.isEnabledFor(INFO):
+            self._log(INFO, msg, args, fields)
+
+    def warning(self, msg, *args, **fields):
+        if self.logger.isEnabledFor(WARNING):
+            self._log(WARNING, msg, args, fields)
+
+    def error(self, msg, *args, **fields):
+        if self.logger.isEnabledFor(ERROR):
+            self._log(ERROR, msg, args, fields)
+
+    def _log(self, level, msg, args, fields):
+        hot = fields.pop("hot", None)
+        suppressed = 0
+        if hot is not None and _hot is not None:
+            suppressed = _hot.admit(hot)
+            if suppressed is None:
+                return
+        token = fields.get("token")
+        if token:
+            fields["token"] = token_prefix(token)
+        address = fields.pop("address", None)
+        if address:
+            fields["addr"] = f"{address[0]}:{address[1]}"
+        extra = {"fields": {key: value for key, value in fields.items() if value is not None},
+                 "suppressed": suppressed}
+        self.logger.log(level, msg, *args, extra=extra)
+
+def get_logger(name):
+    log = Logger(name)
+    _loggers.append(log)
+    return log
+
+class _Formatter(logging.Formatter):
+    def format(self, record):
+        line = (f"{time.strftime('%H:%M:%S', time.localtime(record.created))}.{int(record.msecs):03d} "
+                f"{record.levelname:<7} {record.getMessage()}")
+        fields = getattr(record, "fields", None)
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            line += f" ({suppressed} suppressed)"
+        dropped = getattr(record, "dropped", 0)
+        if dropped:
+            line += f" ({dropped} dropped)"
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Formatting happens on the listener thread, not here
+        return record
+
+    def enqueue(self, record):
+        if self.dropped:
+            record.dropped = self.dropped
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            return
+        self.dropped = 0
+
+def configure(level=LOG_LEVEL, stream=None, rate_limit=RATE_LIMIT, sample_every=SAMPLE_EVERY, queue_size=QUEUE_SIZE):
+    global _config, _handler, _listener, _hot
+    shutdown()
+    with _lock:
+        _config = dict(level=level, stream=stream, rate_limit=rate_limit,
+                       sample_every=sample_every, queue_size=queue_size)
+        output = logging.StreamHandler(stream or sys.stdout)
+        output.setFormatter(_Formatter())
+        log_queue = queue.Queue(queue_size)
+        _handler = _QueueHandler(log_queue)
+        _listener = logging.handlers.QueueListener(log_queue, output)
+        _listener.start()
+        _hot = _HotKeys(rate_limit, sample_every)
+
+        root = logging.getLogger(ROOT_LOGGER)
+        root.handlers[:] = [_handler]
+        root.setLevel(LEVELS[level] if isinstance(level, str) else level)
+        root.propagate = False
+        for log in _loggers:
+            log.debug_enabled = log.logger.isEnabledFor(DEBUG)
+
+def shutdown():
+    # Writes out everything still queued, then stops the writer thread
+    global _handler, _listener
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+        if _handler is not None:
+            if _handler.dropped:
+                print(f"[Log] {_handler.dropped} records dropped (queue full)", file=sys.stderr)
+            logging.getLogger(ROOT_LOGGER).removeHandler(_handler)
+        _handler = None
+
+def _after_fork_in_child():
+    # The listener thread does not survive fork() and the inherited locks
+    # may be held; a forked worker gets its own queue and writer
+    global _lock, _handler, _listener
+    if _config is not None:
+        _lock = threading.Lock()
+        _handler = None
+        _listener = None
+        configure(**_config)
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
@@ -0,0 +1,213 @@
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from logger import get_logger
+
+# In-process metrics, rendered in the Prometheus text exposition format.
+#
+# Counters and histograms are plain attribute updates with no lock: the UDP
+# relay runs on one thread per process, and on the threaded TCP engine a
+# lost increment under contention is an acceptable error for monitoring.
+# Gauges are callbacks read at scrape time, so they cost nothing between
+# scrapes. Counters and histograms are created once at import time by the
+# module that updates them, e.g.
+#     PACKETS_RECEIVED = metrics.counter("chat_udp_packets_received_total", "UDP datagrams received")
+# and registering one again returns the existing object. Gauges read the
+# object that registered them, so a second server or tracker in the same
+# process replaces the first one's gauge rather than being left out.
+#
+# Other processes (the sharded UDP workers) send snapshot() to the parent,
+# which registers them with add_source() so one endpoint shows everything,
+# each sample labelled with where it came from.
+
+METRICS_HOST = "127.0.0.1"   # loopback only: the endpoint has no authentication
+METRICS_PORT = 9100
+
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+SIZE_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+
+log = get_logger("metrics")
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(f'{key}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+                     for key, value in labels.items())
+    return "{" + pairs + "}"
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help = help_text
+        self.label_names = label_names
+        self.value = 0
+        self.children = {}
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def labels(self, *values):
+        # Hot call sites keep the returned child instead of calling this per event
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = Counter(self.name, self.help)
+        return child
+
+    def samples(self):
+        if self.label_names:
+            return [(self.name, dict(zip(self.label_names, values)), child.value)
+                    for values, child in list(self.children.items())]
+        return [(self.name, {}, self.value)]
+
+class Gauge:
+    kind = "gauge"
+
+    def __init__(self, name, help_text, read):
+        self.name = name
+        self.help = help_text
+        self.read = read
+
+    def samples(self):
+        try:
+            return [(self.name, {}, self.read())]
+        except Exception:
+            return []
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)   # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += count
+            samples.append((self.name + "_bucket", {"le": _format_value(float(bound))}, cumulative))
+        samples.append((self.name + "_sum", {}, self.sum))
+        samples.append((self.name + "_count", {}, self.count))
+        return samples
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.sources = []
+
+    def register(self, metric):
+        existing = self.metrics.get(metric.name)
+        if existing is not None and metric.kind != "gauge":
+            return existing
+        self.metrics[metric.name] = metric
+        return metric
+
+    def add_source(self, source):
+        # source() -> [(labels, snapshot)], snapshots taken in other processes
+        self.sources.append(source)
+
+    def remove(self, prefix):
+        # For metrics that another process now reports through a source
+        for name in [name for name in self.metrics if name.startswith(prefix)]:
+            del self.metrics[name]
+
+    def snapshot(self, prefix=""):
+        return {name: {"kind": metric.kind, "help": metric.help, "samples": metric.samples()}
+                for name, metric in self.metrics.items() if name.startswith(prefix)}
+
+    def render(self):
+        families = {name: (metric.kind, metric.help, list(metric.samples())) for name, metric in self.metrics.items()}
+        for source in self.sources:
+            for extra_labels, snapshot in source():
+                for name, family in snapshot.items():
+                    kind, help_text, samples = families.setdefault(name, (family["kind"], family["help"], []))
+                    for sample_name, labels, value in family["samples"]:
+                        samples.append((sample_name, {**extra_labels, **labels}, value))
+
+        lines = []
+        for name, (kind, help_text, samples) in families.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for sample_name, labels, value in samples:
+                lines.append(f"{sample_name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+def counter(name, help_text, label_names=()):
+    return REGISTRY.register(Counter(name, help_text, tuple(label_names)))
+
+def gauge(name, help_text, read):
+    return REGISTRY.register(Gauge(name, help_text, read))
+
+def histogram(name, help_text, buckets=LATENCY_BUCKETS):
+    return REGISTRY.register(Histogram(name, help_text, buckets))
+
+def register_room_manager(room_manager):
+    gauge("chat_rooms", "Rooms currently open", lambda: len(room_manager.rooms))
+    gauge("chat_tokens", "Session tokens currently issued", lambda: len(room_manager.tokens))
+    gauge("chat_registered_addresses", "Sessions with a registered UDP address", lambda: len(room_manager.address_index))
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class Metrics_Server:
+    # GET /metrics on a loopback port, served from its own thread
+    def __init__(self, port=METRICS_PORT, host=METRICS_HOST, registry=REGISTRY):
+        self.host = host
+        self.port = port
+        self.registry = registry
+        self.httpd = None
+        self.thread = None
+
+    def start(self, sock=None):
+        if sock is None:
+            self.httpd = ThreadingHTTPServer((self.host, self.port), _MetricsHandler)
+        else:
+            # A listening socket handed over by the process this one replaces
+            self.httpd = ThreadingHTTPServer(sock.getsockname()[:2], _MetricsHandler, bind_and_activate=False)
+            self.httpd.socket.close()
+            self.httpd.socket = sock
+        self.httpd.daemon_threads = True
+        self.httpd.registry = self.registry
+        self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="metrics", daemon=True)
+        self.thread.start()
+        log.info("[Metrics] Serving http://%s:%s/metrics", self.host, self.port)
+
+    def stop(self):
+        if self.httpd:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
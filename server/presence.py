@@ -0,0 +1,129 @@
+import time
+from collections import deque
+
+from logger import get_logger
+import metrics
+
+log = get_logger("presence")
+
+# Idle session expiry.
+#
+# Every packet a session sends (chat, __REGISTER__, or the __HEARTBEAT__
+# clients send while idle) marks it as seen. Each session also has one
+# entry in a hashed timer wheel, due `timeout` after it was last scheduled.
+# Marking a session as seen only stores a timestamp; the wheel entry is
+# moved when it comes due and the session turns out to have been seen in
+# the meantime. So the per-packet cost is one dict store, and expiring or
+# rescheduling is O(1) per session.
+
+SESSION_TIMEOUT = 60.0   # seconds without a packet before a session is expired
+WHEEL_TICK = 1.0         # timer wheel resolution in seconds
+WHEEL_SLOTS = 256
+
+SESSIONS_EXPIRED = metrics.counter("chat_udp_sessions_expired_total", "Sessions removed after going silent", ("role",))
+EXPIRED_HOSTS = SESSIONS_EXPIRED.labels("host")
+EXPIRED_MEMBERS = SESSIONS_EXPIRED.labels("member")
+
+class TimerWheel:
+    # Deadlines hash into one of `slots` buckets by their tick number.
+    # schedule() and cancel() are O(1); advance() visits one bucket per tick
+    # elapsed (at most one revolution) and leaves entries due in a later
+    # revolution where they are.
+    def __init__(self, tick=WHEEL_TICK, slots=WHEEL_SLOTS, now=None):
+        self.tick = tick
+        self.buckets = [{} for _ in range(slots)]
+        self.slot_of = {}    # key -> bucket index
+        self.current = int((time.monotonic() if now is None else now) / tick)
+
+    def __len__(self):
+        return len(self.slot_of)
+
+    def __contains__(self, key):
+        return key in self.slot_of
+
+    def schedule(self, key, deadline):
+        self.cancel(key)
+        due = max(int(deadline / self.tick), self.current)
+        index = due % len(self.buckets)
+        self.buckets[index][key] = due
+        self.slot_of[key] = index
+
+    def cancel(self, key):
+        index = self.slot_of.pop(key, None)
+        if index is not None:
+            del self.buckets[index][key]
+
+    def advance(self, now):
+        # Keys whose deadline has passed, removed from the wheel
+        target = int(now / self.tick)
+        if target < self.current:
+            return []
+        slots = len(self.buckets)
+        expired = []
+        for due in range(self.current, min(target + 1, self.current + slots)):
+            bucket = self.buckets[due % slots]
+            if not bucket:
+                continue
+            for key in [k for k, d in bucket.items() if d <= target]:
+                del bucket[key]
+                del self.slot_of[key]
+                expired.append(key)
+        self.current = target + 1
+        return expired
+
+    def next_deadline(self):
+        return self.current * self.tick
+
+class Presence_Tracker:
+    # Calls expire(token) for every session silent for `timeout` seconds.
+    # Sessions issued by the TCP server arrive through the RoomManager
+    # listener, possibly on another thread; they are queued and scheduled
+    # on the UDP thread, which owns the wheel.
+    def __init__(self, room_manager, timeout, expire):
+        self.room_manager = room_manager
+        self.timeout = timeout
+        self.expire = expire
+        self.wheel = TimerWheel()
+        self.last_seen = {}
+        self.issued = deque()
+        room_manager.add_listener(self._on_event)
+        metrics.gauge("chat_udp_tracked_sessions", "Sessions with an idle-expiry timer", lambda: len(self.wheel))
+
+    def _on_event(self, event, data):
+        if event == "session":
+            self.issued.append(data["token"])
+
+    def track_all(self, now):
+        # Sessions restored from disk get one timeout to show up
+        for token in list(self.room_manager.tokens):
+            self.touch(token, now)
+
+    def touch(self, token, now):
+        self.last_seen[token] = now
+        if token not in self.wheel:
+            self.wheel.schedule(token, now + self.timeout)
+
+    def run(self, now):
+        while self.issued:
+            self.touch(self.issued.popleft(), now)
+        if now < self.wheel.next_deadline():
+            return
+        tokens = self.room_manager.tokens
+        for token in self.wheel.advance(now):
+            if token not in tokens:
+                # Left or removed with its room; nothing to expire
+                self.last_seen.pop(token, None)
+                continue
+            deadline = self.last_seen.get(token, 0.0) + self.timeout
+            if deadline > now:
+                self.wheel.schedule(token, deadline)
+                continue
+            self.last_seen.pop(token, None)
+            info = tokens[token]
+            (EXPIRED_HOSTS if info.is_host else EXPIRED_MEMBERS).value += 1
+            log.info("[Expired] Session silent for %gs", self.timeout, room=info.room_name, token=token,
+                     address=info.address, hot="expired")
+            self.expire(token)
+
+    def next_timer(self):
+        return self.wheel.next_deadline()
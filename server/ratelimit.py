@@ -0,0 +1,134 @@
+import json
+import os
+import sys
+import zlib
+from collections import OrderedDict
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from protocol.ucrp import UCRP_EXTENDED, KIND_SESSION, SESSION_HEADER_SIZE
+from protocol.reliable import KIND_RELIABLE, KIND_ACK, RELIABLE_HEADER_SIZE
+from protocol.fragment import KIND_FRAGMENT
+from protocol.compress import KIND_COMPRESSED
+from logger import get_logger
+import metrics
+
+log = get_logger("ratelimit")
+
+# Token-bucket rate limiting at UDP ingress, so a flooding client is cut
+# off before its packets are parsed or fanned out to its room.
+#
+# Two buckets apply to every datagram: one per source address, checked
+# before anything else, and one per client, keyed by the raw session id or
+# token bytes, whose rate and burst can be set per room. Nothing is decoded
+# or looked up in RoomManager: a room's limit is found by the crc32 prefix
+# of the session id, or by the room name bytes of a legacy packet. Both
+# tables are LRU-bounded, so a flood of spoofed addresses or tokens evicts
+# old buckets instead of growing memory.
+#
+# rate_limits.json in the working directory, if present, overrides the
+# defaults and sets per-room limits:
+#   {"token": {"rate": 50, "burst": 100}, "address": {"rate": 200, "burst": 400},
+#    "rooms": {"lobby": {"rate": 5, "burst": 10}}}
+# A rate of 0 disables that limit.
+
+TOKEN_RATE = 50.0        # packets per second per token
+MAX_BUCKETS = 65536      # per table
+RATE_LIMITS_FILE = "rate_limits.json"
+
+_RELIABLE_PREFIX = bytes([UCRP_EXTENDED, KIND_RELIABLE])
+_SESSION_PREFIX = bytes([UCRP_EXTENDED, KIND_SESSION])
+_ACK_PREFIX = bytes([UCRP_EXTENDED, KIND_ACK])
+_FRAGMENT_PREFIX = bytes([UCRP_EXTENDED, KIND_FRAGMENT])
+_COMPRESSED_PREFIX = bytes([UCRP_EXTENDED, KIND_COMPRESSED])
+
+def rate_limit_config(token_rate=TOKEN_RATE, filename=RATE_LIMITS_FILE):
+    # Bursts default to 2x the rate; an address may carry several clients
+    # (NAT), so it gets 4x the per-token rate
+    config = {
+        "token": {"rate": token_rate, "burst": token_rate * 2},
+        "address": {"rate": token_rate * 4, "burst": token_rate * 8},
+        "rooms": {},
+    }
+    try:
+        with open(filename, 'r', encoding='utf-8') as f:
+            overrides = json.load(f)
+    except FileNotFoundError:
+        return config
+    except Exception as e:
+        log.warning("Ignoring %s: %s", filename, e)
+        return config
+    for scope in ("token", "address"):
+        config[scope].update(overrides.get(scope, {}))
+    config["rooms"].update(overrides.get("rooms", {}))
+    log.info("Rate limits loaded from %s (%d room overrides)", filename, len(config["rooms"]))
+    return config
+
+class TokenBuckets:
+    # key -> [tokens, last refill], least recently used first
+    def __init__(self, max_entries=MAX_BUCKETS):
+        self.buckets = OrderedDict()
+        self.max_entries = max_entries
+
+    def __len__(self):
+        return len(self.buckets)
+
+    def allow(self, key, rate, burst, now):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= self.max_entries:
+                self.buckets.popitem(last=False)
+            self.buckets[key] = [burst - 1.0, now]
+            return True
+        self.buckets.move_to_end(key)
+        tokens = bucket[0] + (now - bucket[1]) * rate
+        if tokens > burst:
+            tokens = burst
+        bucket[1] = now
+        if tokens < 1.0:
+            bucket[0] = tokens
+            return False
+        bucket[0] = tokens - 1.0
+        return True
+
+class Rate_Limiter:
+    def __init__(self, config, max_entries=MAX_BUCKETS):
+        self.token_limit = (config["token"]["rate"], config["token"]["burst"])
+        self.address_limit = (config["address"]["rate"], config["address"]["burst"])
+        # (rate, burst) by room name bytes and by the session id prefix crc32(room_name)
+        self.room_limits = {}
+        self.session_limits = {}
+        for room_name, limit in config["rooms"].items():
+            self.set_room_limit(room_name, limit["rate"], limit.get("burst", limit["rate"] * 2))
+        self.addresses = TokenBuckets(max_entries)
+        self.clients = TokenBuckets(max_entries)
+        metrics.gauge("chat_udp_rate_limit_buckets", "Token buckets held by the ingress rate limiter",
+                      lambda: len(self.addresses) + len(self.clients))
+
+    def set_room_limit(self, room_name, rate, burst):
+        name = room_name.encode('utf-8')
+        self.room_limits[name] = (rate, burst)
+        self.session_limits[zlib.crc32(name).to_bytes(4, 'big')] = (rate, burst)
+
+    def allow_address(self, address, now):
+        rate, burst = self.address_limit
+        return not rate or self.addresses.allow(address, rate, burst, now)
+
+    def allow_packet(self, data, now):
+        kind = data[:2]
+        if kind == _RELIABLE_PREFIX:
+            data = data[RELIABLE_HEADER_SIZE:]
+            kind = data[:2]
+        if kind == _SESSION_PREFIX or kind == _FRAGMENT_PREFIX or kind == _COMPRESSED_PREFIX:
+            # All carry the session id right after the kind byte
+            key = data[2:SESSION_HEADER_SIZE]
+            limit = self.session_limits.get(data[2:6]) if self.session_limits else None
+        elif kind == _ACK_PREFIX or len(kind) < 2:
+            # ACKs count against the address only
+            return True
+        else:
+            # Legacy packet: [room_len][token_len][room][token][message]
+            start = 2 + data[0]
+            key = data[start:start + data[1]]
+            limit = self.room_limits.get(data[2:start]) if self.room_limits else None
+        rate, burst = limit or self.token_limit
+        return not rate or self.clients.allow(key, rate, burst, now)
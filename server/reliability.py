@@ -0,0 +1,139 @@
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from protocol.reliable import ReliableStream, KIND_ACK, TICK
+from logger import get_logger
+import metrics
+
+log = get_logger("reliable")
+
+SWEEP_INTERVAL = 5.0   # seconds between checks for streams whose session is gone
+
+RETRANSMITS = metrics.counter("chat_udp_reliable_retransmits_total", "Reliable datagrams sent again")
+ACKS_SENT = metrics.counter("chat_udp_reliable_acks_sent_total", "ACKs sent to reliable clients")
+RELIABLE_DROPPED = metrics.counter("chat_udp_reliable_dropped_total",
+                                   "Reliable datagrams given up on", ("reason",))
+DROPPED_BACKLOG = RELIABLE_DROPPED.labels("backlog_full")
+DROPPED_UNACKED = RELIABLE_DROPPED.labels("peer_unresponsive")
+
+class Reliable_Sessions:
+    # Server side of protocol/reliable.py: one ReliableStream per client
+    # address that registered reliably. `active` holds the addresses with
+    # unacknowledged datagrams or an ACK owed, which tick() services.
+    def __init__(self, send, room_manager):
+        self.send = send   # send(datagram, addr)
+        self.room_manager = room_manager
+        self.streams = {}
+        self.active = set()
+        self.next_tick = 0.0
+        self.next_sweep = 0.0
+        metrics.gauge("chat_udp_reliable_streams", "Client addresses using reliable delivery", lambda: len(self.streams))
+
+    def open(self, address):
+        stream = self.streams.get(address)
+        if stream is None:
+            stream = self.streams[address] = ReliableStream()
+            log.info("[Reliable] Stream opened", address=address)
+        return stream
+
+    def adopt(self, streams):
+        # Streams handed over by the process this one replaced; their
+        # timestamps are time.monotonic(), which is the same clock here
+        self.streams.update(streams)
+        self.active.update(address for address, stream in streams.items() if not stream.idle())
+
+    def close(self, address):
+        self.streams.pop(address, None)
+        self.active.discard(address)
+        log.info("[Reliable] Stream closed", address=address)
+
+    def receive(self, stream, seq, address, now):
+        # True if the envelope is new; answers right away when an ACK is due
+        is_new = stream.receive(seq, now)
+        ack = stream.take_ack(now)
+        if ack is not None:
+            self._send(ack, address)
+            ACKS_SENT.value += 1
+        if not stream.idle():
+            self.active.add(address)
+        return is_new
+
+    def on_ack(self, address, ack, sack, now):
+        stream = self.streams.get(address)
+        if stream is None:
+            return
+        before = stream.retransmits
+        for datagram in stream.on_ack(ack, sack, now):
+            self._send(datagram, address)
+        RETRANSMITS.value += stream.retransmits - before
+        if stream.idle():
+            self.active.discard(address)
+
+    def send_many(self, payload, addrs, now):
+        # Sends payload to every reliable address in addrs; returns the
+        # remaining addresses with the (sent, failed) counts so far
+        streams = self.streams
+        plain = []
+        sent = failed = 0
+        for addr in addrs:
+            stream = streams.get(addr)
+            if stream is None:
+                plain.append(addr)
+                continue
+            dropped = stream.dropped
+            datagram = stream.send(payload, now)
+            self.active.add(addr)
+            if datagram is None:
+                if stream.dropped != dropped:
+                    DROPPED_BACKLOG.value += 1
+                    failed += 1
+                continue
+            if self._send(datagram, addr):
+                sent += 1
+            else:
+                failed += 1
+        return plain, sent, failed
+
+    def tick(self, now):
+        if now < self.next_tick:
+            return
+        self.next_tick = now + TICK
+        for address in list(self.active):
+            stream = self.streams.get(address)
+            if stream is None:
+                self.active.discard(address)
+                continue
+            before = stream.retransmits
+            for datagram in stream.poll(now):
+                self._send(datagram, address)
+                if datagram[1] == KIND_ACK:
+                    ACKS_SENT.value += 1
+            RETRANSMITS.value += stream.retransmits - before
+            if stream.failed:
+                DROPPED_UNACKED.value += len(stream.unacked) + len(stream.backlog)
+                log.warning("[Reliable] Peer stopped acknowledging; stream closed", address=address, hot="reliable_failed")
+                del self.streams[address]
+                self.active.discard(address)
+            elif stream.idle():
+                self.active.discard(address)
+        if now >= self.next_sweep:
+            self.next_sweep = now + SWEEP_INTERVAL
+            self.sweep()
+
+    def sweep(self):
+        # Streams outlive their session until everything sent was acknowledged
+        # (e.g. __ROOM_CLOSED__); after that nothing will be sent to them
+        registered = self.room_manager.address_index
+        for address in [a for a, s in self.streams.items() if a not in registered and s.idle()]:
+            del self.streams[address]
+
+    def next_timer(self):
+        return self.next_tick if self.active else None
+
+    def _send(self, datagram, addr):
+        try:
+            self.send(datagram, addr)
+            return True
+        except OSError:
+            return False
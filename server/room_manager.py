@@ -1,110 +1,347 @@
 from datetime import datetime
 import json
 import secrets
+import threading
 import time
+import zlib
+
+from history import Message_History
+from logger import get_logger
+
+log = get_logger("rooms")
+
+# Concurrency contract.
+#
+# Every method that changes state (create_room, join_room, register_address,
+# add_session, delete_room_if_host_left, load_state) holds self.lock, so
+# the TCP handler threads, the UDP thread and the shard supervisor apply one
+# change at a time, and listeners get events in the order the changes were
+# made. A check and the change it guards (the room exists, then the join)
+# happen under the same hold.
+#
+# Readers take no lock. rooms, tokens, session_ids, address_index and
+# Room.users only change through single dict operations, and a Room's
+# members dict is never modified once it is reachable: writers build a
+# changed copy and swap it in. The relay path holds room.members for one
+# message and iterates it while joins and leaves go on, seeing them from its
+# next message; it never waits for a writer. A join or leave therefore
+# copies the member dict, which costs about what one relay's walk over it
+# does.
+
+def _address_key(address):
+    # Addresses read back from JSON are lists; index them as tuples
+    if isinstance(address, list):
+        return tuple(address)
+    return address
+
+class Session:
+    # One per token. __slots__ keeps this at a fraction of a 4-key dict, which
+    # matters at hundreds of thousands of sessions; the token itself is the
+    # key in RoomManager.tokens and is not repeated here. codec is the
+    # compression negotiated in the handshake (protocol/compress.py), None
+    # for a client that only reads plain frames. extended is set for a client
+    # that listed the extended frames (batches, fragments) in its handshake;
+    # other clients are only sent single plain frames. seen is the room's
+    # history position when the UDP server last heard from the session's
+    # address; it is not saved with the rest.
+    __slots__ = ("username", "room_name", "is_host", "address", "session_id", "codec", "extended", "seen")
+
+    def __init__(self, username, room_name, is_host, address, session_id=None, codec=None, extended=False):
+        self.username = username
+        self.room_name = room_name
+        self.is_host = is_host
+        self.address = address
+        self.session_id = session_id
+        self.codec = codec
+        self.extended = extended
+        self.seen = None
+
+    def to_dict(self):
+        return {
+            "username": self.username,
+            "room_name": self.room_name,
+            "is_host": self.is_host,
+            "address": self.address,
+            "session_id": self.session_id,
+            "codec": self.codec,
+            "extended": self.extended
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["username"], data["room_name"], data["is_host"], _address_key(data.get("address")),
+                   data.get("session_id"), data.get("codec"), data.get("extended", False))
+
+class Room:
+    # members is an insertion-ordered dict used as a set (O(1) membership),
+    # replaced rather than modified once the room is published;
+    # users ({username: token}) is an index maintained by RoomManager and not persisted
+    __slots__ = ("host_token", "members", "created_at", "users")
+
+    def __init__(self, host_token, members, created_at):
+        self.host_token = host_token
+        self.members = members
+        self.created_at = created_at
+        self.users = {}
+
+    def to_dict(self):
+        # JSON has no ordered set; members are written as a list
+        return {
+            "host_token": self.host_token,
+            "members": list(self.members),
+            "created_at": self.created_at
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["host_token"], dict.fromkeys(data["members"]), data["created_at"])
 
 class RoomManager:
     def __init__(self):
         # チャットルーム情報
-        # {room_name: {"host_token": token, "members": [tokens], "created_at": timestamp}}
+        # {room_name: Room(host_token, members={token: None}, created_at)}
         self.rooms = {}
         # トークン情報
-        # {token: {"username": name, "room_name": room, "is_host": bool, "address": (ip, port)}}
+        # {token: Session(username, room_name, is_host, address=(ip, port), session_id, codec, extended)}
         self.tokens = {}
+        # Secondary indexes, kept in step with rooms/tokens by every mutation:
+        # Room.users per room, plus {(ip, port): token}
+        self.address_index = {}
+        # {session_id: token}; session ids are the 64-bit handles carried by
+        # compact UCRP packets in place of room name + token
+        self.session_ids = {}
+        # Callbacks invoked as listener(event, data) after each mutation:
+        # "session" (session record), "register" (token, address), "leave" (room_name, token)
+        self.listeners = []
+        # Recent encoded messages per room, replayed to clients as they register
+        self.history = Message_History()
+        # Held by every writer; readers never take it (see the contract above)
+        self.lock = threading.Lock()
         
-        print("RoomManager initialized: Cache cleared")
+        log.info("RoomManager initialized: Cache cleared")
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        # Like add_listener, takes no lock: a caller swapping listeners while
+        # others write holds self.lock around both
+        self.listeners.remove(listener)
+
+    def _emit(self, event, data):
+        for listener in self.listeners:
+            listener(event, data)
 
     def generate_token(self):
         return "token_" + secrets.token_hex(16)
 
+    def generate_session_id(self, room_name):
+        # High 32 bits are crc32(room_name), so a sharded data plane can find
+        # the owning worker without the room name; low 32 bits are random
+        prefix = zlib.crc32(room_name.encode('utf-8')) << 32
+        while True:
+            session_id = prefix | secrets.randbits(32)
+            if session_id not in self.session_ids:
+                return session_id
+
+    def find_token_by_session_id(self, session_id):
+        return self.session_ids.get(session_id)
+
     def room_exists(self, room_name):
         return room_name in self.rooms
     
     def find_user_token_in_room(self, room_name, username):
-        if room_name not in self.rooms:
+        room = self.rooms.get(room_name)
+        if room is None:
             return None
-        
-        for token in self.rooms[room_name]["members"]:
-            if token in self.tokens and self.tokens[token]["username"] == username:
-                return token
-        return None
+        return room.users.get(username)
+
+    def find_token_by_address(self, address):
+        return self.address_index.get(_address_key(address))
+
+    def _index_session(self, token):
+        info = self.tokens[token]
+        self.rooms[info.room_name].users[info.username] = token
+        key = _address_key(info.address)
+        if key is not None:
+            self.address_index[key] = token
+        if info.session_id is None:
+            info.session_id = self.generate_session_id(info.room_name)
+        self.session_ids[info.session_id] = token
+
+    def _unindex_session(self, token, room=None):
+        info = self.tokens[token]
+        room = room or self.rooms.get(info.room_name)
+        if room is not None and room.users.get(info.username) == token:
+            del room.users[info.username]
+        key = _address_key(info.address)
+        if key is not None and self.address_index.get(key) == token:
+            del self.address_index[key]
+        if self.session_ids.get(info.session_id) == token:
+            del self.session_ids[info.session_id]
+
+    def _set_address(self, token, address):
+        info = self.tokens[token]
+        old_key = _address_key(info.address)
+        if old_key is not None and self.address_index.get(old_key) == token:
+            del self.address_index[old_key]
+        info.address = address
+        key = _address_key(address)
+        if key is not None:
+            self.address_index[key] = token
 
     def validate_token_and_address(self, token, room_name):
-        if token not in self.tokens:
+        # Each lookup is read once, so a concurrent leave cannot fail it halfway
+        info = self.tokens.get(token)
+        if info is None:
             return False, "Invalid token"
-        
-        if room_name not in self.rooms:
+
+        room = self.rooms.get(room_name)
+        if room is None:
             return False, "Room does not exist"
         
-        if token not in self.rooms[room_name]["members"]:
+        if token not in room.members:
             return False, "Token is not a member of this room"
         
-        if self.tokens[token]["room_name"] != room_name:
+        if info.room_name != room_name:
             return False, "Token belongs to a different room"
         
         return True, "Valid token"
 
-    def create_room(self, room_name, username, address):
-        if self.room_exists(room_name):
-            return False, None
+    def create_room(self, room_name, username, address, codec=None, extended=False):
+        with self.lock:
+            if self.room_exists(room_name):
+                return False, None
 
-        token = self.generate_token()
-        
-        self.rooms[room_name] = {
-            "host_token": token,
-            "members": [token],
-            "created_at": time.time()
-        }
-        
-        self.tokens[token] = {
-            "username": username,
-            "room_name": room_name,
-            "is_host": True,
-            "address": address
-        }
+            token = self.generate_token()
 
-        return True, token
+            self.tokens[token] = Session(username, room_name, True, address, codec=codec, extended=extended)
+            self.rooms[room_name] = Room(token, {token: None}, time.time())
+            self._index_session(token)
 
-    def join_room(self, room_name, username, address):
-        if not self.room_exists(room_name):
-            return False, None
+            self._emit("session", self.session_record(token))
+            return True, token
 
-        existing_token = self.find_user_token_in_room(room_name, username)
-        if existing_token:
-            self.tokens[existing_token]["address"] = address
-            username = username.strip('"')
-            print(f"Existing user: {repr(username)} (Address updated: {address}, Token: {existing_token})")
-            return True, existing_token
+    def join_room(self, room_name, username, address, codec=None, extended=False):
+        with self.lock:
+            room = self.rooms.get(room_name)
+            if room is None:
+                return False, None
 
-        token = self.generate_token()
-        
-        self.rooms[room_name]["members"].append(token)
-        
-        self.tokens[token] = {
-            "username": username,
-            "room_name": room_name,
-            "is_host": False,
-            "address": address
+            existing_token = room.users.get(username)
+            if existing_token:
+                self._set_address(existing_token, address)
+                self.tokens[existing_token].codec = codec
+                self.tokens[existing_token].extended = extended
+                log.info("Existing user: %r (address updated)", username.strip('"'), room=room_name, token=existing_token, address=address)
+                self._emit("session", self.session_record(existing_token))
+                return True, existing_token
+
+            token = self.generate_token()
+
+            self.tokens[token] = Session(username, room_name, False, address, codec=codec, extended=extended)
+            members = room.members.copy()
+            members[token] = None
+            room.members = members
+            self._index_session(token)
+
+            self._emit("session", self.session_record(token))
+            return True, token
+
+    def register_address(self, token, address):
+        with self.lock:
+            if token not in self.tokens:
+                return False
+            self._set_address(token, address)
+            self._emit("register", {"token": token, "address": address})
+            return True
+
+    def session_record(self, token):
+        info = self.tokens[token]
+        return {
+            "token": token,
+            "room_name": info.room_name,
+            "username": info.username,
+            "is_host": info.is_host,
+            "address": info.address,
+            "created_at": self.rooms[info.room_name].created_at,
+            "session_id": info.session_id,
+            "codec": info.codec,
+            "extended": info.extended,
         }
 
-        return True, token
+    def add_session(self, token, room_name, username, is_host, address, created_at=None, session_id=None,
+                    announce=False, codec=None, extended=False):
+        # Applies a session record produced elsewhere (another process, a
+        # snapshot) without issuing a new token. Listeners only hear of it
+        # with announce, for sessions this process now owns (a handoff).
+        with self.lock:
+            if token in self.tokens:
+                self._unindex_session(token)
+            self.tokens[token] = Session(username, room_name, is_host, address, session_id, codec, extended)
+
+            room = self.rooms.get(room_name)
+            if room is None:
+                room = self.rooms[room_name] = Room(token if is_host else None, {token: None}, created_at or time.time())
+            else:
+                if is_host:
+                    room.host_token = token
+                if token not in room.members:
+                    members = room.members.copy()
+                    members[token] = None
+                    room.members = members
+            self._index_session(token)
+            if announce:
+                self._emit("session", self.session_record(token))
+
+    def record_message(self, room_name, frame):
+        self.history.record(room_name, frame)
+
+    def recent_messages(self, room_name, after=None):
+        return self.history.recent(room_name, after)
+
+    def history_position(self, room_name):
+        return self.history.position(room_name)
+
+    def export_rooms(self):
+        with self.lock:
+            return {room_name: room.to_dict() for room_name, room in self.rooms.items()}
+
+    def export_tokens(self):
+        with self.lock:
+            return {token: info.to_dict() for token, info in self.tokens.items()}
+
+    def load_state(self, rooms, tokens):
+        # Replaces everything, e.g. with a snapshot; indexes are rebuilt
+        with self.lock:
+            self.rooms = rooms
+            self.tokens = tokens
+            self._rebuild_indexes()
+            self.history.clear()
+
+    def _rebuild_indexes(self):
+        # Snapshots written before session ids existed get fresh ones here
+        self.address_index = {}
+        self.session_ids = {}
+        for token in self.tokens:
+            self._index_session(token)
 
     def save_to_json(self, filename="room_manager.json"):
         try:
             data = {
-                'rooms': self.rooms,
-                'tokens': self.tokens,
+                'rooms': self.export_rooms(),
+                'tokens': self.export_tokens(),
                 'saved_at': datetime.now().isoformat()
             }
 
             with open(filename, 'w', encoding='utf-8') as f:
                 json.dump(data, f, indent=2, ensure_ascii=False)
             
-            print(f"Data saved to {filename}")
+            log.info("Data saved to %s", filename)
             return True
 
         except Exception as e:
-            print(f"Save error: {e}")
+            log.error("Save error: %s", e)
             return False
 
     def load_from_json(self, filename="room_manager.json"):
@@ -112,48 +349,55 @@ class RoomManager:
             with open(filename, 'r', encoding='utf-8') as f:
                 data = json.load(f)
 
-            self.rooms = data.get('rooms', {})
-            self.tokens = data.get('tokens', {})
+            self.load_state({name: Room.from_dict(room) for name, room in data.get('rooms', {}).items()},
+                            {token: Session.from_dict(info) for token, info in data.get('tokens', {}).items()})
 
-            print(f"Data manually loaded from {filename}")
+            log.info("Data manually loaded from %s", filename)
             if 'saved_at' in data:
-                print(f"Saved at: {data['saved_at']}")
+                log.info("Saved at: %s", data["saved_at"])
             
-            print(f"Load result: {len(self.rooms)} rooms, {len(self.tokens)} tokens")
+            log.info("Load result: %d rooms, %d tokens", len(self.rooms), len(self.tokens))
             return True
 
         except FileNotFoundError:
-            print(f"File {filename} not found")
+            log.info("File %s not found", filename)
             return False
         except Exception as e:
-            print(f"Load error: {e}")
+            log.error("Load error: %s", e)
             return False
         
     def delete_room_if_host_left(self, room_name, token):
-        tokens = self.tokens
-        rooms = self.rooms
-        token_info = tokens.get(token)
+        with self.lock:
+            tokens = self.tokens
+            rooms = self.rooms
+            token_info = tokens.get(token)
 
-        if not token_info:
-            print(f"Unknown token: {token}")
-            return None
-        room_name = token_info["room_name"]
-
-        if rooms.get(room_name, {}).get("host_token") == token:
-            username = token_info['username'].strip('"')
-            print(f"Deleting room '{room_name}' because host {repr(username)} is leaving")
-            for member_token in rooms[room_name]["members"]:
-                if member_token in tokens:
-                    del tokens[member_token]
-            del rooms[room_name]
-            print(f"All tokens for room '{room_name}' have been deleted")
-            return None
-        else:
-            username = token_info['username'].strip('"')
-            print(f"{repr(username)} is leaving room '{room_name}'")
-            if token in rooms[room_name]["members"]:
-                rooms[room_name]["members"].remove(token)
-            if token in tokens:
+            if not token_info:
+                log.warning("Unknown token", room=room_name, token=token, hot="unknown_token")
+                return None
+            room_name = token_info.room_name
+            self._emit("leave", {"room_name": room_name, "token": token})
+
+            room = rooms.get(room_name)
+            if room is not None and room.host_token == token:
+                username = token_info.username.strip('"')
+                log.info("Deleting room because host %r is leaving", username, room=room_name, token=token)
+                # Unpublish the room first: a join from here on finds no room
+                del rooms[room_name]
+                for member_token in room.members:
+                    if member_token in tokens:
+                        self._unindex_session(member_token, room)
+                        del tokens[member_token]
+                self.history.drop(room_name)
+                log.info("All tokens for room have been deleted", room=room_name)
+                return None
+            else:
+                username = token_info.username.strip('"')
+                if room is not None and token in room.members:
+                    members = room.members.copy()
+                    del members[token]
+                    room.members = members
+                self._unindex_session(token)
                 del tokens[token]
-            print(f"Deleted token and member information for {repr(username)}")
-            return None
\ No newline at end of file
+                log.info("%r left; token and member information deleted", username, room=room_name, token=token)
+                return None
\ No newline at end of file
@@ -1,14 +1,41 @@
+import os
 import threading
-import time
 
+import logger
+import metrics
+from logger import get_logger
 from room_manager import RoomManager
+from journal import Journal
+from sqlite_state import SQLite_State
 from tcp_server import TCP_Create_Join_Server
+from async_tcp_server import Async_TCP_Create_Join_Server
 from udp_server import UDP_Chat_Server
+from async_udp_server import Async_UDP_Chat_Server
+from udp_shard import UDP_Shard_Supervisor
+from presence import SESSION_TIMEOUT
+from ratelimit import TOKEN_RATE, rate_limit_config
+from cluster import Cluster, cluster_config
+from handoff import HANDOFF_SOCKET, Handoff_Listener, connect_handoff
 import socket
 
-def main():
-    room_manager = RoomManager()
+TCP_ENGINES = {
+    "threaded": TCP_Create_Join_Server,
+    "asyncio": Async_TCP_Create_Join_Server,
+}
+
+UDP_ENGINES = {
+    "threaded": UDP_Chat_Server,
+    "asyncio": Async_UDP_Chat_Server,
+}
+
+STATE_BACKENDS = {
+    "journal": Journal,
+    "sqlite": SQLite_State,
+}
 
+log = get_logger("server")
+
+def main():
     host = input("Host name (default: localhost): ").strip() or "localhost"
 
     tcp_port_str = input("TCP port number (default: 9090): ").strip()
@@ -31,52 +58,202 @@ def main():
     else:
         udp_port = 9091
 
+    tcp_engine = input("TCP engine [threaded/asyncio] (default: asyncio): ").strip().lower() or "asyncio"
+    if tcp_engine not in TCP_ENGINES:
+        print(f"Unknown TCP engine '{tcp_engine}'. Please choose 'threaded' or 'asyncio'.")
+        return
+
+    udp_engine = input("UDP engine [threaded/asyncio] (default: threaded): ").strip().lower() or "threaded"
+    if udp_engine not in UDP_ENGINES:
+        print(f"Unknown UDP engine '{udp_engine}'. Please choose 'threaded' or 'asyncio'.")
+        return
+
+    udp_workers_str = input("UDP worker processes (default: 1): ").strip()
+    try:
+        udp_workers = int(udp_workers_str) if udp_workers_str else 1
+    except ValueError:
+        print("Invalid worker count. Please enter a numeric value.")
+        return
+    if udp_workers < 1:
+        print("Worker count must be at least 1.")
+        return
+
+    coalesce_str = input("Outbound coalescing window in ms (default: 0 = off): ").strip()
+    try:
+        coalesce_window = float(coalesce_str) / 1000 if coalesce_str else 0.0
+    except ValueError:
+        print("Invalid window. Please enter a numeric value.")
+        return
+    if coalesce_window < 0:
+        print("Coalescing window cannot be negative.")
+        return
+
+    timeout_str = input(f"Idle session timeout in seconds (default: {SESSION_TIMEOUT:g}, 0 = never): ").strip()
+    try:
+        session_timeout = float(timeout_str) if timeout_str else SESSION_TIMEOUT
+    except ValueError:
+        print("Invalid timeout. Please enter a numeric value.")
+        return
+    if session_timeout < 0:
+        print("Session timeout cannot be negative.")
+        return
+
+    rate_str = input(f"Rate limit per client in packets/s (default: {TOKEN_RATE:g}, 0 = off): ").strip()
+    try:
+        token_rate = float(rate_str) if rate_str else TOKEN_RATE
+    except ValueError:
+        print("Invalid rate. Please enter a numeric value.")
+        return
+    if token_rate < 0:
+        print("Rate limit cannot be negative.")
+        return
+
+    log_level = input("Log level [debug/info/warning/error] (default: info): ").strip().lower() or "info"
+    if log_level not in logger.LEVELS:
+        print(f"Unknown log level '{log_level}'. Please choose debug, info, warning or error.")
+        return
+
+    metrics_port_str = input(f"Metrics port on {metrics.METRICS_HOST} (default: {metrics.METRICS_PORT}, 0 = off): ").strip()
+    try:
+        metrics_port = int(metrics_port_str) if metrics_port_str else metrics.METRICS_PORT
+    except ValueError:
+        print("Invalid port number. Please enter a numeric value.")
+        return
+
+    state_backend = input("State backend [journal/sqlite] (default: journal): ").strip().lower() or "journal"
+    if state_backend not in STATE_BACKENDS:
+        print(f"Unknown state backend '{state_backend}'. Please choose 'journal' or 'sqlite'.")
+        return
+
+    logger.configure(log_level)
+    # A server already running in this directory hands us its sockets and
+    # state. Sharded workers cannot take them, so do not even ask.
+    if udp_workers > 1 and os.path.exists(HANDOFF_SOCKET):
+        # Possibly left behind by a server that did not stop cleanly. If one
+        # is still running, binding its ports below fails with "Address
+        # already in use"
+        log.warning("%s exists; a running server can only hand over to a single UDP worker", HANDOFF_SOCKET)
+    handoff = connect_handoff() if udp_workers == 1 else None
+    # Per-room limits and other overrides come from rate_limits.json, if present
+    rate_limits = rate_limit_config(token_rate) if token_rate else None
+    room_manager = RoomManager()
+    metrics.register_room_manager(room_manager)
+
     # Validate/normalize host
     try:
         socket.getaddrinfo(host, None)
     except Exception:
-        print(f"[Info] Host '{host}' could not be resolved. Using 127.0.0.1 instead.")
+        log.info("Host %r could not be resolved. Using 127.0.0.1 instead.", host)
         host = "127.0.0.1"
 
     # Validate ports range (avoid extremely low/reserved ports or out-of-range)
     def normalize_port(p: int, default_p: int) -> int:
         if 1024 <= p <= 65535:
             return p
-        print(f"[Info] Port {p} is out of recommended range (1024-65535). Using default {default_p}.")
+        log.info("Port %s is out of recommended range (1024-65535). Using default %s.", p, default_p)
         return default_p
 
     tcp_port = normalize_port(tcp_port, 9090)
     udp_port = normalize_port(udp_port, 9091)
 
-    tcp_server = TCP_Create_Join_Server(host, tcp_port, room_manager)
-    udp_server = UDP_Chat_Server(host, udp_port, room_manager)
+    # Restore the previous run's rooms, then journal every change from here on
+    if handoff:
+        handoff.receive(room_manager)
+        # The state on disk is the previous process's: keep writing it the same way
+        if handoff.state_backend != state_backend:
+            log.info("Keeping the previous server's %r state backend", handoff.state_backend)
+            state_backend = handoff.state_backend
+        journal = STATE_BACKENDS[state_backend]()
+        journal.resume(handoff.journal_seq)
+        sockets = handoff.sockets
+    else:
+        journal = STATE_BACKENDS[state_backend]()
+        journal.restore(room_manager)
+        sockets = {}
+    journal.attach(room_manager)
+
+    # Cluster mode when cluster.json is in the working directory
+    config = cluster_config()
+    cluster = Cluster(config, host, tcp_port, udp_port, room_manager) if config is not None else None
+
+    tcp_server = TCP_ENGINES[tcp_engine](host, tcp_port, room_manager, cluster)
+    if udp_workers > 1:
+        # Workers run the threaded engine, one per process, sharded by room
+        udp_engine = f"sharded x{udp_workers}"
+        udp_server = UDP_Shard_Supervisor(host, udp_port, room_manager, udp_workers, coalesce_window, session_timeout,
+                                          rate_limits)
+        tcp_server.wait_published = udp_server.wait_published
+    else:
+        udp_server = UDP_ENGINES[udp_engine](host, udp_port, room_manager, coalesce_window,
+                                              session_timeout=session_timeout, rate_limits=rate_limits)
 
-    tcp_server.bind()
-    udp_server.bind()
+    tcp_server.bind(sockets.get("tcp"))
+    if udp_workers > 1:
+        udp_server.bind()
+    else:
+        udp_server.bind(sockets.get("udp"))
+        if handoff:
+            udp_server.reliable.adopt(handoff.streams)
+    if cluster:
+        cluster.bind(sockets.get("gossip"))
+
+    metrics_server = None
+    if metrics_port:
+        metrics_server = metrics.Metrics_Server(metrics_port)
+        try:
+            metrics_server.start(sockets.get("metrics"))
+        except OSError as e:
+            log.warning("Metrics endpoint not started on port %s (%s).", metrics_port, e)
+            metrics_server = None
 
-    print(f"[Started] TCP server bound to {host}:{tcp_port}")
-    print(f"[Started] UDP server bound to {host}:{udp_port}\n")
-    print("UDP chat server started. Waiting for messages...")
+    log.info("[Started] TCP server bound to %s:%s (engine: %s)", host, tcp_port, tcp_engine)
+    log.info("[Started] UDP server bound to %s:%s (engine: %s)", host, udp_port, udp_engine)
+    if coalesce_window:
+        log.info("[Started] Coalescing relayed messages for up to %g ms", coalesce_window * 1000)
+    if session_timeout:
+        log.info("[Started] Expiring sessions silent for %g s", session_timeout)
+    if rate_limits:
+        log.info("[Started] Rate limiting clients to %g packets/s", rate_limits["token"]["rate"])
+    log.info("UDP chat server started. Waiting for messages...")
 
     tcp_thread = threading.Thread(target=tcp_server.start, daemon=False)
     udp_thread = threading.Thread(target=udp_server.start, daemon=False)
 
     tcp_thread.start()
     udp_thread.start()
+    if cluster:
+        cluster.start()
+    # Sharded workers bind their own sockets, which cannot be handed over
+    listener = None
+    if udp_workers == 1:
+        listener = Handoff_Listener(room_manager, journal, tcp_server, udp_server, cluster, metrics_server,
+                                    state_backend)
+        listener.start(handoff)
 
     print("Press Ctrl+C to stop...")
     print()
 
+    handed_off = listener.done if listener else threading.Event()
     try:
-        while True:
-            time.sleep(1)
+        while not handed_off.wait(1):
+            pass
+        log.info("Handed over to the new server, stopping")
     except KeyboardInterrupt:
         print("\nCtrl+C detected, stopping")
+    finally:
+        if cluster:
+            cluster.stop(announce=not handed_off.is_set())
+        if listener:
+            listener.stop()
         tcp_server.stop()
         udp_server.stop()
         tcp_thread.join()
         udp_thread.join()
-        print("Server stopped successfully")
+        if metrics_server:
+            metrics_server.stop()
+        journal.close()
+        log.info("Server stopped successfully")
+        logger.shutdown()
 
 if __name__ == "__main__":
     main()
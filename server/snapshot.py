@@ -0,0 +1,245 @@
+import os
+import struct
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from protocol.compress import CODEC_ZLIB
+from protocol.reliable import ReliableStream
+from room_manager import Room, Session
+
+# Binary RoomManager snapshot, the state a server hands to the process that
+# replaces it (handoff.py). room_manager.json repeats every key and the room
+# name of every session; here a session is stored once, inside its room, in
+# member order:
+#
+#   "RMS1", u32 rooms
+#   per room:    str name, f64 created_at, u32 members
+#   per member:  str token, str username, u8 flags, u64 session_id,
+#                [str ip, u16 port]   (when FLAG_ADDRESS)
+#   u32 rooms with history
+#   per room:    str name, u16 frames, per frame u32 length + the frame
+#
+# str is a u16 length plus UTF-8; integers are big-endian. History rooms
+# are written least recently active first, so replaying them in order
+# rebuilds the same eviction order.
+#
+# The reliable delivery streams (protocol/reliable.py) follow in a format
+# of their own, so either can change without the other:
+#
+#   "RST1", u32 streams
+#   per stream:  str ip, u16 port, 8B session id, u8 flags,
+#                u32 next_seq, u32 expected, f64 srtt, f64 rttvar, f64 rto,
+#                u32 retransmits, u32 dropped, u32 acks_owed, f64 ack_at,
+#                u32 received, per received seq a u32,
+#                u32 unacked, per unacked datagram u32 seq, f64 first_sent,
+#                f64 last_sent, u32 tries, u32 length + the datagram,
+#                u32 backlog, per packet u32 length + the packet
+#
+# srtt and ack_at are only meaningful with STREAM_RTT and STREAM_ACK_DUE
+# set. Times are time.monotonic(), a clock every process on the host shares.
+
+SNAPSHOT_MAGIC = b"RMS1"
+STREAMS_MAGIC = b"RST1"
+
+FLAG_HOST = 1          # Session.is_host
+FLAG_ROOM_HOST = 2     # the room's host_token
+FLAG_ADDRESS = 4       # has a registered address
+FLAG_COMPRESSION = 8   # negotiated compression (Session.codec, the only codec there is)
+FLAG_EXTENDED = 16     # reads extended frames (Session.extended)
+
+STREAM_FAILED = 1      # ReliableStream.failed
+STREAM_RTT = 2         # srtt is set
+STREAM_ACK_DUE = 4     # ack_at is set
+
+_U16 = struct.Struct('!H')
+_U32 = struct.Struct('!I')
+_ROOM = struct.Struct('!dI')
+_MEMBER = struct.Struct('!BQ')
+_STREAM = struct.Struct('!8sBIIdddIIIdI')
+_UNACKED = struct.Struct('!IddII')
+
+def _str(text):
+    data = text.encode('utf-8')
+    return _U16.pack(len(data)) + data
+
+def encode_snapshot(room_manager):
+    # The caller holds room_manager.lock, so the rooms cannot change underneath
+    parts = [SNAPSHOT_MAGIC, _U32.pack(len(room_manager.rooms))]
+    tokens = room_manager.tokens
+    for room_name, room in room_manager.rooms.items():
+        members = [token for token in room.members if token in tokens]
+        parts.append(_str(room_name))
+        parts.append(_ROOM.pack(room.created_at, len(members)))
+        for token in members:
+            info = tokens[token]
+            flags = (FLAG_HOST if info.is_host else 0) | (FLAG_ROOM_HOST if token == room.host_token else 0)
+            if info.address:
+                flags |= FLAG_ADDRESS
+            if info.codec:
+                flags |= FLAG_COMPRESSION
+            if info.extended:
+                flags |= FLAG_EXTENDED
+            parts.append(_str(token))
+            parts.append(_str(info.username))
+            parts.append(_MEMBER.pack(flags, info.session_id or 0))
+            if info.address:
+                parts.append(_str(info.address[0]))
+                parts.append(_U16.pack(info.address[1]))
+
+    rings = room_manager.history.rings
+    parts.append(_U32.pack(len(rings)))
+    for room_name, ring in rings.items():
+        frames = ring.frames()
+        parts.append(_str(room_name))
+        parts.append(_U16.pack(len(frames)))
+        for frame in frames:
+            parts.append(_U32.pack(len(frame)))
+            parts.append(frame)
+    return b"".join(parts)
+
+def decode_snapshot(data):
+    # (rooms, tokens, [(room_name, [frame, ...]), ...]) as RoomManager holds them.
+    # One flat loop over offsets: this runs while the new process takes over
+    data = bytes(data)
+    if data[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+        raise ValueError("Not a RoomManager snapshot")
+    u16, u32, room_header, member = _U16.unpack_from, _U32.unpack_from, _ROOM.unpack_from, _MEMBER.unpack_from
+    offset = len(SNAPSHOT_MAGIC)
+    rooms = {}
+    tokens = {}
+    try:
+        room_count, = u32(data, offset)
+        offset += 4
+        for _ in range(room_count):
+            size, = u16(data, offset)
+            room_name = data[offset + 2:offset + 2 + size].decode('utf-8')
+            offset += 2 + size
+            created_at, count = room_header(data, offset)
+            offset += _ROOM.size
+            members = {}
+            room = rooms[room_name] = Room(None, members, created_at)
+            for _ in range(count):
+                size, = u16(data, offset)
+                token = data[offset + 2:offset + 2 + size].decode('utf-8')
+                offset += 2 + size
+                size, = u16(data, offset)
+                username = data[offset + 2:offset + 2 + size].decode('utf-8')
+                offset += 2 + size
+                flags, session_id = member(data, offset)
+                offset += _MEMBER.size
+                address = None
+                if flags & FLAG_ADDRESS:
+                    size, = u16(data, offset)
+                    ip = data[offset + 2:offset + 2 + size].decode('utf-8')
+                    offset += 2 + size
+                    address = (ip, u16(data, offset)[0])
+                    offset += 2
+                members[token] = None
+                if flags & FLAG_ROOM_HOST:
+                    room.host_token = token
+                tokens[token] = Session(username, room_name, bool(flags & FLAG_HOST), address, session_id or None,
+                                        CODEC_ZLIB if flags & FLAG_COMPRESSION else None, bool(flags & FLAG_EXTENDED))
+
+        history = []
+        ring_count, = u32(data, offset)
+        offset += 4
+        for _ in range(ring_count):
+            size, = u16(data, offset)
+            room_name = data[offset + 2:offset + 2 + size].decode('utf-8')
+            offset += 2 + size
+            frame_count, = u16(data, offset)
+            offset += 2
+            frames = []
+            for _ in range(frame_count):
+                size, = u32(data, offset)
+                frames.append(data[offset + 4:offset + 4 + size])
+                offset += 4 + size
+            history.append((room_name, frames))
+    except struct.error:
+        raise ValueError("Snapshot is truncated")
+    if offset > len(data):
+        raise ValueError("Snapshot is truncated")
+    return rooms, tokens, history
+
+def load_snapshot(room_manager, data):
+    rooms, tokens, history = decode_snapshot(data)
+    room_manager.load_state(rooms, tokens)
+    for room_name, frames in history:
+        for frame in frames:
+            room_manager.history.record(room_name, frame)
+
+def encode_streams(streams):
+    # {address: ReliableStream} as the UDP server holds them; called while
+    # the server is paused, so they cannot change underneath
+    parts = [STREAMS_MAGIC, _U32.pack(len(streams))]
+    for (ip, port), stream in streams.items():
+        flags = ((STREAM_FAILED if stream.failed else 0) | (STREAM_RTT if stream.srtt is not None else 0)
+                 | (STREAM_ACK_DUE if stream.ack_at is not None else 0))
+        parts.append(_str(ip))
+        parts.append(_U16.pack(port))
+        parts.append(_STREAM.pack(stream.session_id, flags, stream.next_seq, stream.expected, stream.srtt or 0.0,
+                                  stream.rttvar, stream.rto, stream.retransmits, stream.dropped, stream.acks_owed,
+                                  stream.ack_at or 0.0, len(stream.received)))
+        parts.extend(_U32.pack(seq) for seq in sorted(stream.received))
+        parts.append(_U32.pack(len(stream.unacked)))
+        for seq, (datagram, first_sent, last_sent, tries) in stream.unacked.items():
+            parts.append(_UNACKED.pack(seq, first_sent, last_sent, tries, len(datagram)))
+            parts.append(datagram)
+        parts.append(_U32.pack(len(stream.backlog)))
+        for packet in stream.backlog:
+            parts.append(_U32.pack(len(packet)))
+            parts.append(packet)
+    return b"".join(parts)
+
+def decode_streams(data):
+    data = bytes(data)
+    if data[:len(STREAMS_MAGIC)] != STREAMS_MAGIC:
+        raise ValueError("Not a reliable streams snapshot")
+    u16, u32 = _U16.unpack_from, _U32.unpack_from
+    offset = len(STREAMS_MAGIC)
+    streams = {}
+    try:
+        count, = u32(data, offset)
+        offset += 4
+        for _ in range(count):
+            size, = u16(data, offset)
+            ip = data[offset + 2:offset + 2 + size].decode('utf-8')
+            offset += 2 + size
+            port, = u16(data, offset)
+            offset += 2
+            (session_id, flags, next_seq, expected, srtt, rttvar, rto, retransmits, dropped, acks_owed, ack_at,
+             received) = _STREAM.unpack_from(data, offset)
+            offset += _STREAM.size
+            stream = ReliableStream(session_id)
+            stream.next_seq = next_seq
+            stream.expected = expected
+            stream.srtt = srtt if flags & STREAM_RTT else None
+            stream.rttvar = rttvar
+            stream.rto = rto
+            stream.failed = bool(flags & STREAM_FAILED)
+            stream.retransmits = retransmits
+            stream.dropped = dropped
+            stream.acks_owed = acks_owed
+            stream.ack_at = ack_at if flags & STREAM_ACK_DUE else None
+            for _ in range(received):
+                stream.received.add(u32(data, offset)[0])
+                offset += 4
+            unacked, = u32(data, offset)
+            offset += 4
+            for _ in range(unacked):
+                seq, first_sent, last_sent, tries, size = _UNACKED.unpack_from(data, offset)
+                offset += _UNACKED.size
+                stream.unacked[seq] = [data[offset:offset + size], first_sent, last_sent, tries]
+                offset += size
+            backlog, = u32(data, offset)
+            offset += 4
+            for _ in range(backlog):
+                size, = u32(data, offset)
+                stream.backlog.append(data[offset + 4:offset + 4 + size])
+                offset += 4 + size
+            streams[(ip, port)] = stream
+    except struct.error:
+        raise ValueError("Streams snapshot is truncated")
+    if offset > len(data):
+        raise ValueError("Streams snapshot is truncated")
+    return streams
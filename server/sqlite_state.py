@@ -0,0 +1,307 @@
+from collections import OrderedDict
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+from logger import get_logger
+from journal import Journal, JOURNAL_FILE, SNAPSHOT_FILE
+from room_manager import Room, Session
+
+log = get_logger("sqlite")
+
+# RoomManager state in an SQLite database other processes can read.
+#
+# A state backend is what server.py persists RoomManager through: restore()
+# loads it at startup, resume(seq) continues after a handoff, attach() starts
+# taking RoomManager's events through record(), close() flushes, and seq
+# counts the events written. journal.Journal is the default backend; this is
+# the other one.
+#
+# The server keeps serving from RoomManager's dicts, which act as the cache
+# in front of the database: the relay path never runs SQL. record() only
+# queues the event; a writer thread applies whatever is waiting as one
+# transaction with prepared statements (sqlite3 compiles each SQL string
+# once per connection). The database runs in WAL mode, so readers in other
+# processes (SQLite_State_Reader) never block the writer or each other, and
+# synchronous=NORMAL makes a commit durable at the next checkpoint, which
+# is what the journal's batched fsync gives too.
+#
+# Sessions keep their rowid across updates, so ORDER BY rowid is join order
+# and restores Room.members in order. A database that does not exist yet is
+# filled from room_manager.json and the journal, if there are any.
+
+STATE_DB = "room_manager.db"
+READ_CACHE_SIZE = 65536   # lookups SQLite_State_Reader keeps
+REFRESH_INTERVAL = 0.1    # seconds a reader trusts its cache before checking for commits
+
+_STOP = object()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rooms (
+    name TEXT PRIMARY KEY,
+    host_token TEXT,
+    created_at REAL NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS sessions (
+    token TEXT PRIMARY KEY,
+    room_name TEXT NOT NULL,
+    username TEXT NOT NULL,
+    is_host INTEGER NOT NULL,
+    ip TEXT,
+    port INTEGER,
+    address_seq INTEGER,
+    session_id INTEGER,
+    codec TEXT,
+    extended INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS sessions_by_room ON sessions (room_name);
+CREATE INDEX IF NOT EXISTS sessions_by_address ON sessions (ip, port, address_seq) WHERE ip IS NOT NULL;
+CREATE INDEX IF NOT EXISTS sessions_by_session_id ON sessions (session_id);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value
+) WITHOUT ROWID;
+"""
+
+UPSERT_ROOM = ("INSERT INTO rooms (name, host_token, created_at) VALUES (?, ?, ?) "
+               "ON CONFLICT (name) DO UPDATE SET host_token = coalesce(excluded.host_token, host_token)")
+UPSERT_SESSION = ("INSERT INTO sessions (token, room_name, username, is_host, ip, port, address_seq, session_id, codec, "
+                  "extended) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                  "ON CONFLICT (token) DO UPDATE SET room_name = excluded.room_name, username = excluded.username, "
+                  "is_host = excluded.is_host, ip = excluded.ip, port = excluded.port, "
+                  "address_seq = excluded.address_seq, session_id = excluded.session_id, codec = excluded.codec, "
+                  "extended = excluded.extended")
+# Databases written before sessions had these columns
+ADD_COLUMNS = {"codec": "ALTER TABLE sessions ADD COLUMN codec TEXT",
+               "extended": "ALTER TABLE sessions ADD COLUMN extended INTEGER NOT NULL DEFAULT 0"}
+SET_ADDRESS = "UPDATE sessions SET ip = ?, port = ?, address_seq = ? WHERE token = ?"
+# A host leaving closes the room: its members go first, while the room row still names the host
+DELETE_HOSTED = "DELETE FROM sessions WHERE room_name = (SELECT name FROM rooms WHERE name = ? AND host_token = ?)"
+DELETE_ROOM = "DELETE FROM rooms WHERE name = ? AND host_token = ?"
+DELETE_SESSION = "DELETE FROM sessions WHERE token = ?"
+SET_SEQ = "INSERT INTO meta (key, value) VALUES ('seq', ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value"
+GET_SEQ = "SELECT value FROM meta WHERE key = 'seq'"
+SELECT_ROOMS = "SELECT name, host_token, created_at FROM rooms"
+SELECT_SESSIONS = ("SELECT token, room_name, username, is_host, ip, port, session_id, codec, extended "
+                   "FROM sessions ORDER BY rowid")
+
+SELECT_SESSION = ("SELECT room_name, username, is_host, ip, port, session_id, codec, extended FROM sessions "
+                  "WHERE token = ?")
+SELECT_BY_ADDRESS = ("SELECT token FROM sessions WHERE ip = ? AND port = ? "
+                     "ORDER BY address_seq DESC LIMIT 1")
+SELECT_BY_SESSION_ID = "SELECT token FROM sessions WHERE session_id = ?"
+SELECT_MEMBERS = "SELECT token FROM sessions WHERE room_name = ? ORDER BY rowid"
+SELECT_COUNTS = "SELECT (SELECT count(*) FROM rooms), (SELECT count(*) FROM sessions)"
+
+def _connect(path, readonly=False):
+    if readonly:
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+    else:
+        conn = sqlite3.connect(path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+def _create_schema(conn):
+    conn.executescript(SCHEMA)
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(sessions)")}
+    for column, sql in ADD_COLUMNS.items():
+        if column not in columns:
+            conn.execute(sql)
+
+def _to_signed(session_id):
+    # Session ids are unsigned 64-bit; SQLite integers are signed
+    if session_id is not None and session_id >= 1 << 63:
+        return session_id - (1 << 64)
+    return session_id
+
+def _to_unsigned(session_id):
+    if session_id is not None and session_id < 0:
+        return session_id + (1 << 64)
+    return session_id
+
+def _session_row(record, seq):
+    address = record["address"]
+    ip, port = address if address else (None, None)
+    return (record["token"], record["room_name"], record["username"], int(record["is_host"]), ip, port,
+            seq if address else None, _to_signed(record.get("session_id")), record.get("codec"),
+            int(record.get("extended", False)))
+
+class SQLite_State:
+    def __init__(self, path=STATE_DB):
+        self.path = path
+        self.seq = 0
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+
+    def restore(self, room_manager):
+        conn = _connect(self.path)
+        try:
+            _create_schema(conn)
+            row = conn.execute(GET_SEQ).fetchone()
+            if row is None and (os.path.exists(SNAPSHOT_FILE) or os.path.exists(JOURNAL_FILE)):
+                self._import_journal(conn, room_manager)
+                return
+            self.seq = row[0] if row else 0
+            rooms = {name: Room(host_token, {}, created_at) for name, host_token, created_at in conn.execute(SELECT_ROOMS)}
+            tokens = {}
+            for token, room_name, username, is_host, ip, port, session_id, codec, extended in conn.execute(SELECT_SESSIONS):
+                room = rooms.get(room_name)
+                if room is None:
+                    continue
+                room.members[token] = None
+                tokens[token] = Session(username, room_name, bool(is_host), (ip, port) if ip is not None else None,
+                                        _to_unsigned(session_id), codec, bool(extended))
+        finally:
+            conn.close()
+        room_manager.load_state(rooms, tokens)
+        log.info("[SQLite] Restored %d rooms, %d tokens from %s (seq %d)", len(rooms), len(tokens), self.path, self.seq)
+
+    def _import_journal(self, conn, room_manager):
+        # First start on this backend: take over what the journal backend kept
+        Journal().restore(room_manager)
+        with room_manager.lock:
+            records = [room_manager.session_record(token) for token in room_manager.tokens]
+        with conn:
+            for record in records:
+                conn.execute(UPSERT_ROOM, (record["room_name"], record["token"] if record["is_host"] else None,
+                                           record["created_at"]))
+                conn.execute(UPSERT_SESSION, _session_row(record, 0))
+            conn.execute(SET_SEQ, (0,))
+        log.info("[SQLite] Imported %d sessions from %s and %s into %s", len(records), SNAPSHOT_FILE, JOURNAL_FILE, self.path)
+
+    def resume(self, seq):
+        # After a handoff (handoff.py): the previous process has written up to seq
+        self.seq = seq
+        log.info("[SQLite] Continuing from seq %d after a handoff", seq)
+
+    def attach(self, room_manager):
+        room_manager.add_listener(self.record)
+        self.thread = threading.Thread(target=self._writer, name="sqlite-writer", daemon=True)
+        self.thread.start()
+
+    def record(self, event, data):
+        self.queue.put((event, data))
+
+    def close(self):
+        if self.thread:
+            self.queue.put(_STOP)
+            self.thread.join()
+            self.thread = None
+
+    def _writer(self):
+        # sqlite3 connections belong to the thread that opened them
+        conn = _connect(self.path)
+        _create_schema(conn)
+        while True:
+            batch = [self.queue.get()]
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stopping = False
+            try:
+                # One transaction per batch
+                with conn:
+                    for item in batch:
+                        if item is _STOP:
+                            stopping = True
+                            continue
+                        self.seq += 1
+                        self._apply(conn, *item)
+                    conn.execute(SET_SEQ, (self.seq,))
+            except sqlite3.Error as e:
+                log.error("[SQLite] Write error: %s", e)
+            if stopping:
+                conn.close()
+                return
+
+    def _apply(self, conn, event, data):
+        if event == "session":
+            conn.execute(UPSERT_ROOM, (data["room_name"], data["token"] if data["is_host"] else None,
+                                       data["created_at"]))
+            conn.execute(UPSERT_SESSION, _session_row(data, self.seq))
+        elif event == "register":
+            address = data["address"]
+            ip, port = address if address else (None, None)
+            conn.execute(SET_ADDRESS, (ip, port, self.seq if address else None, data["token"]))
+        elif event == "leave":
+            room_name, token = data["room_name"], data["token"]
+            conn.execute(DELETE_HOSTED, (room_name, token))
+            conn.execute(DELETE_ROOM, (room_name, token))
+            conn.execute(DELETE_SESSION, (token,))
+
+class SQLite_State_Reader:
+    # Another process's read-only view of a server's database: a worker, an
+    # admin tool. Answers come from an LRU of recent lookups; every
+    # REFRESH_INTERVAL the database's data_version is checked and the LRU
+    # dropped if the server has committed since. A hot token costs a dict
+    # lookup, and an answer is at most REFRESH_INTERVAL out of date.
+    def __init__(self, path=STATE_DB, cache_size=READ_CACHE_SIZE, refresh_interval=REFRESH_INTERVAL):
+        self.conn = _connect(path, readonly=True)
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.refresh_interval = refresh_interval
+        self.data_version = None
+        self.checked_at = 0.0
+        self.lock = threading.Lock()
+
+    def close(self):
+        self.conn.close()
+
+    def session(self, token):
+        return self._lookup(("token", token), self._load_session, token)
+
+    def token_by_address(self, address):
+        return self._lookup(("address", tuple(address)), self._load_one, SELECT_BY_ADDRESS, tuple(address))
+
+    def token_by_session_id(self, session_id):
+        return self._lookup(("session_id", session_id), self._load_one, SELECT_BY_SESSION_ID,
+                            (_to_signed(session_id),))
+
+    def room_members(self, room_name):
+        return self._lookup(("members", room_name), self._load_members, room_name)
+
+    def counts(self):
+        # (rooms, sessions); always read from the database
+        with self.lock:
+            return self.conn.execute(SELECT_COUNTS).fetchone()
+
+    def _lookup(self, key, load, *args):
+        now = time.monotonic()
+        with self.lock:
+            if now - self.checked_at >= self.refresh_interval:
+                self.checked_at = now
+                data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+                if data_version != self.data_version:
+                    self.data_version = data_version
+                    self.cache.clear()
+            cache = self.cache
+            if key in cache:
+                cache.move_to_end(key)
+                return cache[key]
+            value = load(*args)
+            if self.cache_size:
+                cache[key] = value
+                if len(cache) > self.cache_size:
+                    cache.popitem(last=False)
+            return value
+
+    def _load_session(self, token):
+        row = self.conn.execute(SELECT_SESSION, (token,)).fetchone()
+        if row is None:
+            return None
+        room_name, username, is_host, ip, port, session_id, codec, extended = row
+        return Session(username, room_name, bool(is_host), (ip, port) if ip is not None else None,
+                       _to_unsigned(session_id), codec, bool(extended))
+
+    def _load_one(self, sql, params):
+        row = self.conn.execute(sql, params).fetchone()
+        return row[0] if row else None
+
+    def _load_members(self, room_name):
+        return [token for token, in self.conn.execute(SELECT_MEMBERS, (room_name,))]
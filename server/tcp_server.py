@@ -2,85 +2,246 @@ import os
 import socket
 import sys
 import threading
+import time
 
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
-from protocol.tcrp import TCRProtocol, OP_CREATE_ROOM, OP_JOIN_ROOM, STATE_REQUEST
+from protocol.tcrp import TCRProtocol, TCRPDecoder, OP_CREATE_ROOM, OP_JOIN_ROOM, STATE_REQUEST
+from protocol.compress import CODEC_ZLIB
+from dictionaries import Room_Dictionaries
+from logger import get_logger
+import metrics
+
+log = get_logger("tcp")
+
+REQUESTS = metrics.counter("chat_tcp_requests_total", "TCRP requests answered", ("op", "result"))
+HANDSHAKE_SECONDS = metrics.histogram("chat_tcp_handshake_seconds", "Time from accepting a connection to its first response")
+REJECTED_CONNECTIONS = metrics.counter("chat_tcp_rejected_connections_total", "Connections closed at the connection limit")
+TIMED_OUT_CONNECTIONS = metrics.counter("chat_tcp_timed_out_connections_total", "Connections closed before a complete first request")
+
+_OP_NAMES = {OP_CREATE_ROOM: "create", OP_JOIN_ROOM: "join"}
+
+ACCEPT_POLL = 0.5      # seconds; how soon accept() notices a drain
+IDLE_TIMEOUT = 300.0   # seconds a persistent connection may sit between requests
+
+def _offered_codec(compression):
+    # The codec a join/create request negotiates, None for plain frames
+    if compression is None:
+        return None
+    codecs = compression.get("codecs")
+    if not isinstance(codecs, list) or CODEC_ZLIB not in codecs:
+        return None
+    return CODEC_ZLIB
 
 class TCP_Create_Join_Server:
-    def __init__(self, host, tcp_port, room_manager):
+    def __init__(self, host, tcp_port, room_manager, cluster=None, idle_timeout=IDLE_TIMEOUT):
         self.host = host
         self.tcp_port = tcp_port
+        self.idle_timeout = idle_timeout
         self.socket = None
         self.running = False
         self.room_manager = room_manager
+        self.active_connections = 0
+        self.connections_lock = threading.Lock()
+        # After a handoff (handoff.py) the listening socket belongs to the
+        # new process: stop accepting and close connections idle between requests
+        self.draining = False
+        self.idle = set()
+        # Preset dictionaries for clients that negotiate compression
+        self.dictionaries = Room_Dictionaries()
+        # Set in cluster mode; requests for rooms placed elsewhere are redirected
+        self.cluster = cluster
+        # Set in sharded mode (UDP_Shard_Supervisor.wait_published): blocks
+        # until the session just issued has reached its UDP worker
+        self.wait_published = None
+        metrics.gauge("chat_tcp_connections_open", "TCP connections currently open", lambda: self.active_connections)
         
-        print(f"TCP server initialized: {host}:{tcp_port}")
+        log.info("TCP server initialized: %s:%s", host, tcp_port)
 
-    def bind(self):
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        try:
-            self.socket.bind((self.host, self.tcp_port))
-        except Exception as e:
-            # Fallback for invalid/unknown hostnames
-            fallback_host = '127.0.0.1' if self.host.lower() == 'localhost' or self.host.strip() == '' else '127.0.0.1'
-            print(f"[Warn] Failed to bind to {self.host}:{self.tcp_port} ({e}). Falling back to {fallback_host}:{self.tcp_port}.")
-            self.host = fallback_host
-            self.socket.bind((self.host, self.tcp_port))
+    def bind(self, sock=None):
+        # sock: an already listening socket, handed over by the process this one replaces
+        if sock is not None:
+            self.socket = sock
+            self.host, self.tcp_port = sock.getsockname()[:2]
+        else:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            try:
+                self.socket.bind((self.host, self.tcp_port))
+            except Exception as e:
+                # Fallback for invalid/unknown hostnames
+                fallback_host = '127.0.0.1' if self.host.lower() == 'localhost' or self.host.strip() == '' else '127.0.0.1'
+                log.warning("Failed to bind to %s:%s (%s). Falling back to %s:%s.", self.host, self.tcp_port, e,
+                            fallback_host, self.tcp_port)
+                self.host = fallback_host
+                self.socket.bind((self.host, self.tcp_port))
         self.socket.listen()
+        self.socket.settimeout(ACCEPT_POLL)
         self.running = True
 
     def start(self):
-        while self.running:
+        while self.running and not self.draining:
             try:
                 client_socket, address = self.socket.accept()
-                print(f"[TCP] Connected: {address}")
-                thread = threading.Thread(target=self._handle_client, args=(client_socket, address), daemon=True)
+                accepted_at = time.perf_counter()
+                # Pipelined answers are small writes; without NODELAY the
+                # second one waits on the client's delayed ACK (~40ms)
+                client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                if log.debug_enabled:
+                    log.debug("[TCP] Connected", address=address, hot="connected")
+                with self.connections_lock:
+                    self.active_connections += 1
+                thread = threading.Thread(target=self._handle_client, args=(client_socket, address, accepted_at), daemon=True)
                 thread.start()
+            except socket.timeout:
+                continue
             except OSError:
                 break
             except Exception as e:
-                print(f"Connection processing error: {e}")
+                log.warning("Connection processing error: %s", e, hot="accept_error")
+        if self.draining and self.socket:
+            # Our copy only; the new process keeps listening on its own
+            self.socket.close()
+            self.socket = None
 
-    def _handle_client(self, client_socket, address):
+    def _handle_client(self, client_socket, address, accepted_at):
+        # A request without request_id is a legacy one-shot: answer and close.
+        # Requests with one keep the connection open for the next request.
+        decoder = TCRPDecoder()
+        served = 0
         try:
-            op, state, room_name, payload = TCRProtocol.receive_tcrp_message(client_socket)
-
-            if state != STATE_REQUEST:
-                print(f"Invalid state code: {state}")
-                return
-
-            if op == OP_CREATE_ROOM:
-                success, token = self.room_manager.create_room(room_name, payload, address)
-                payload = payload.strip('"')
-                print(f"{'Creation successful' if success else 'Already exists'}: Room '{room_name}' (User: {repr(payload)}, Address: {address})")
-                if success:
-                    print(f"  → Issued token: {token}")
-                    self.room_manager.save_to_json()
-            elif op == OP_JOIN_ROOM:
-                success, token = self.room_manager.join_room(room_name, payload, address)
-                payload = payload.strip('"')
-                print(f"{'Join successful' if success else 'Join failed'}: {repr(payload)} entering room '{room_name}' (Address: {address})")
-                if success:
-                    print(f"  → Issued token: {token}")
-                    self.room_manager.save_to_json()
-            else:
-                print(f"Cannot use that operation code (Code: {op})")
-                return
-
-            compliance = TCRProtocol.build_response_compliance(room_name, op, int(success))
-            complete = TCRProtocol.build_response_complete(room_name, op, token if success else "")
-            client_socket.sendall(compliance + complete)
+            while self.running:
+                frame = decoder.next_frame()
+                if frame is None:
+                    waiting = served and not decoder.buffered()
+                    if waiting:
+                        # Between requests; drain() may close us here
+                        with self.connections_lock:
+                            self.idle.add(client_socket)
+                        if self.draining:
+                            break
+                        client_socket.settimeout(self.idle_timeout)
+                    try:
+                        received = decoder.recv_from(client_socket)
+                    except socket.timeout:
+                        log.info("[TCP] Idle for %ss after %d requests", self.idle_timeout, served,
+                                 address=address, hot="idle")
+                        break
+                    finally:
+                        if waiting:
+                            with self.connections_lock:
+                                self.idle.discard(client_socket)
+                            client_socket.settimeout(None)
+                    if received:
+                        continue
+                    if served and not decoder.buffered():
+                        break
+                    raise ConnectionError("Connection lost (during reception)")
+                op, state, room_name, payload = frame
+                served += 1
+                username, request_id, compression, extended = TCRProtocol.parse_request_payload(payload)
+                response = self.handle_request(op, state, room_name, username, address, request_id, compression,
+                                               extended)
+                if response:
+                    client_socket.sendall(response)
+                    if served == 1:
+                        HANDSHAKE_SECONDS.observe(time.perf_counter() - accepted_at)
+                if request_id is None:
+                    break
 
         except Exception as e:
-            print(f"Client processing error: {e}")
+            log.warning("Client processing error: %s", e, address=address, hot="client_error")
         finally:
             client_socket.close()
-            print(f"[TCP] Disconnected: {address}")
+            with self.connections_lock:
+                self.idle.discard(client_socket)
+                self.active_connections -= 1
+            if log.debug_enabled:
+                log.debug("[TCP] Disconnected after %d requests", served, address=address, hot="disconnected")
+
+    def handle_request(self, op, state, room_name, payload, address, request_id=None, compression=None,
+                       extended=False):
+        # Shared by every TCRP server engine: applies one request and returns
+        # the COMPLIANCE + COMPLETE response bytes, or None to send nothing.
+        # Pipelined requests always get an answer so the client can match it.
+        if state != STATE_REQUEST:
+            REQUESTS.labels(_OP_NAMES.get(op, "unknown"), "invalid").inc()
+            log.warning("Invalid state code: %s", state, room=room_name, address=address, hot="client_error")
+            return None if request_id is None else self._build_response(room_name, op, False, None, request_id)
+
+        if self.cluster is not None and op in _OP_NAMES:
+            target = self.cluster.locate(room_name)
+            if target is not None:
+                REQUESTS.labels(_OP_NAMES[op], "redirected").inc()
+                log.info("Redirected to node %s", target["node"], room=room_name, address=address)
+                return self._build_response(room_name, op, False, None, request_id, redirect=target)
+
+        codec = _offered_codec(compression)
+        if op == OP_CREATE_ROOM:
+            success, token = self.room_manager.create_room(room_name, payload, address, codec, extended)
+            log.info("%s: user %r", 'Creation successful' if success else 'Already exists', payload.strip('"'),
+                     room=room_name, token=token, address=address)
+        elif op == OP_JOIN_ROOM:
+            success, token = self.room_manager.join_room(room_name, payload, address, codec, extended)
+            log.info("%s: user %r", 'Join successful' if success else 'Join failed', payload.strip('"'),
+                     room=room_name, token=token, address=address)
+        else:
+            REQUESTS.labels("unknown", "invalid").inc()
+            log.warning("Cannot use that operation code (Code: %s)", op, room=room_name, address=address, hot="client_error")
+            return None if request_id is None else self._build_response(room_name, op, False, None, request_id)
+        if success and self.wait_published is not None:
+            self.wait_published()
+
+        # Read without the lock: the session may already be gone again (its
+        # host left), and then the client is told the request failed
+        info = self.room_manager.tokens.get(token) if success else None
+        if success and info is None:
+            success = False
+            log.info("Session left before the answer was sent", room=room_name, token=token, address=address)
+        REQUESTS.labels(_OP_NAMES[op], "ok" if success else "failed").inc()
+        return self._build_response(room_name, op, success, token, request_id, compression if codec else None,
+                                    session_id=info.session_id if success else None)
+
+    def _build_response(self, room_name, op, success, token, request_id, compression=None, redirect=None,
+                        session_id=None):
+        negotiated = self._negotiate(room_name, compression) if success and compression else None
+        compliance = TCRProtocol.build_response_compliance(room_name, op, int(success), request_id)
+        complete = TCRProtocol.build_response_complete(room_name, op, token if success else "", request_id, session_id,
+                                                       negotiated, redirect)
+        return compliance + complete
+
+    def _negotiate(self, room_name, compression):
+        # Compression is only used by clients, which need the session id to
+        # send compressed packets. The session keeps the codec, so members
+        # that did not negotiate it are sent those messages inflated.
+        checksum, dictionary = self.dictionaries.get(room_name)
+        known = compression.get("dictionaries")
+        if isinstance(known, list) and checksum in known:
+            dictionary = None
+        return CODEC_ZLIB, checksum, dictionary
+
+    def drain(self):
+        # A new process accepts on the listening socket now. Requests already
+        # received are answered; connections idle between requests are closed
+        self.draining = True
+        with self.connections_lock:
+            idle = list(self.idle)
+        for client_socket in idle:
+            try:
+                client_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        log.info("[TCP] Draining: %d connections open, %d idle closed", self.active_connections, len(idle))
 
     def stop(self):
         self.running = False
         if self.socket:
+            # shutdown() wakes the accept() blocked in start(); close() alone does not.
+            # Not once draining: the new process listens on the same socket
+            if not self.draining:
+                try:
+                    self.socket.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
             self.socket.close()
             self.socket = None
-            print("[Stopped] TCP server stopped")
+            log.info("[Stopped] TCP server stopped")
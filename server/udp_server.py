@@ -1,156 +1,712 @@
+from collections import deque
 import os
 import socket
 import sys
+import threading
+import time
 
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
-from protocol.ucrp import build_udp_message, parse_udp_payload
+from protocol.ucrp import (build_udp_message, parse_udp_payload, is_session_payload, parse_session_payload,
+                           SESSION_HEADER_SIZE)
+from protocol.reliable import is_reliable_payload, parse_reliable_payload, is_ack_payload, parse_ack_payload, TICK
+from protocol.fragment import (Reassembler, is_fragment_payload, parse_fragment_header, build_relayed_header,
+                               FRAGMENT_HEADER_SIZE)
+from protocol.compress import is_compressed_payload, build_compressed_message, is_compressed_message, Message_Codec
+from fanout import Fanout
+from coalesce import Coalescer, COALESCE_BYTES
+from reliability import Reliable_Sessions
+from presence import Presence_Tracker, SESSION_TIMEOUT, WHEEL_TICK
+from ratelimit import Rate_Limiter
+from catchup import Catch_Up_Queue, CATCH_UP_INTERVAL
+from dictionaries import Room_Dictionaries
+from logger import get_logger
+import metrics
+
+log = get_logger("udp")
 
 MAX_MESSAGE_SIZE = 4096
+FORWARD_POLL = 0.02      # seconds between checks for the end of forwarding after a handoff
+PAUSE_TIMEOUT = 5.0      # seconds hand_off() waits for the packet in progress
+
+PACKETS_RECEIVED = metrics.counter("chat_udp_packets_received_total", "UDP datagrams received from clients")
+BYTES_RECEIVED = metrics.counter("chat_udp_bytes_received_total", "UDP payload bytes received from clients")
+PACKETS_SENT = metrics.counter("chat_udp_packets_sent_total", "UDP datagrams sent to room members")
+BYTES_SENT = metrics.counter("chat_udp_bytes_sent_total", "UDP payload bytes sent to room members")
+SEND_FAILURES = metrics.counter("chat_udp_send_failures_total", "UDP datagrams the kernel refused to send")
+REJECTED = metrics.counter("chat_udp_rejected_total", "UDP packets dropped before relaying", ("reason",))
+FANOUT_SIZE = metrics.histogram("chat_udp_fanout_recipients", "Recipients per relayed message", metrics.SIZE_BUCKETS)
+RELAY_SECONDS = metrics.histogram("chat_udp_relay_seconds", "Time from parsing a chat message to its fanout being sent")
+
+_REJECT_REASONS = {
+    "Invalid token": "invalid_token",
+    "Room does not exist": "unknown_room",
+    "Token is not a member of this room": "not_a_member",
+    "Token belongs to a different room": "wrong_room",
+}
+REJECTED_MALFORMED = REJECTED.labels("malformed")
+REJECTED_UNKNOWN_SESSION = REJECTED.labels("unknown_session")
+REJECTED_ADDRESS_MISMATCH = REJECTED.labels("address_mismatch")
+REJECTED_UNKNOWN_TOKEN = REJECTED.labels("unknown_token")
+REJECTED_NO_STREAM = REJECTED.labels("no_reliable_stream")
+REJECTED_RATE_ADDRESS = REJECTED.labels("rate_limited_address")
+REJECTED_RATE_TOKEN = REJECTED.labels("rate_limited_token")
+REJECTED_OVERSIZED = REJECTED.labels("oversized")
+REJECTED_FRAGMENT = REJECTED.labels("fragment_limit")
+FRAGMENTS_RELAYED = metrics.counter("chat_udp_fragments_relayed_total", "Fragments of large messages relayed without reassembly")
+INFLATED = metrics.counter("chat_udp_inflated_total", "Compressed messages inflated for members without compression")
+FRAGMENTS_WITHHELD = metrics.counter("chat_udp_fragments_withheld_total",
+                                     "Fragment deliveries skipped: the member's client does not read fragments")
+NOT_INFLATED = metrics.counter("chat_udp_not_inflated_total",
+                               "Compressed messages members without compression did not get: over the size limit or not inflating")
 
 class UDP_Chat_Server:
-    def __init__(self, host: str, udp_port: int, room_manager):
+    def __init__(self, host: str, udp_port: int, room_manager, coalesce_window=0.0, coalesce_bytes=COALESCE_BYTES,
+                 session_timeout=SESSION_TIMEOUT, rate_limits=None):
         self.host = host
         self.udp_port = udp_port
         self.room_manager = room_manager
         self.udp_sock = None
+        self.fanout = None
         self.running = False
+        self.received_at = None
+        # Seconds to hold relayed messages for coalescing; 0 sends each at once
+        self.coalesce_window = coalesce_window
+        self.coalesce_bytes = min(coalesce_bytes, MAX_MESSAGE_SIZE)
+        self.coalescer = None
+        # Clients opt in to reliable delivery when they register
+        self.reliable = Reliable_Sessions(self.send, room_manager)
+        self.enveloped = False   # handling the packet inside a reliable envelope
+        # Sessions that stop sending (crashed clients never send __LEAVE__)
+        # are expired after session_timeout seconds; 0 keeps them forever
+        self.presence = Presence_Tracker(room_manager, session_timeout, self.expire_session) if session_timeout > 0 else None
+        # Token buckets per source address and per token (ratelimit.rate_limit_config); None = unlimited
+        self.limiter = Rate_Limiter(rate_limits) if rate_limits else None
+        # Room history replayed to each newly registered address, paced
+        self.catch_up = Catch_Up_Queue(self.broadcast, self.coalesce_bytes, batches=self.reads_extended)
+        metrics.gauge("chat_udp_history_bytes", "Memory held by per-room message history",
+                      lambda: self.room_manager.history.bytes)
+        # Fragments are relayed as they arrive; this only tracks partial
+        # messages so senders are held to the caps receivers apply
+        self.fragments = Reassembler(keep=False)
+        # Members that did not negotiate compression are sent compressed
+        # messages inflated; the room dictionaries are read on first use
+        self.dictionaries = None
+        self.codecs = {}   # {dictionary: Message_Codec}
+        metrics.gauge("chat_udp_reassembly_bytes", "Bytes of incomplete fragmented messages relayed to receivers",
+                      lambda: self.fragments.bytes)
+        # Zero-downtime restart (handoff.py): once the socket is handed over,
+        # packets this process still reads go to forward(data, address);
+        # the new process takes them in through inject()
+        self.forward = None
+        self.paused = threading.Event()
+        self.forwarding_done = threading.Event()
+        self.injected = deque()
 
-    def bind(self):
-        self.udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        try:
-            self.udp_sock.bind((self.host, self.udp_port))
-        except Exception as e:
-            fallback_host = '127.0.0.1' if self.host.lower() == 'localhost' or self.host.strip() == '' else '127.0.0.1'
-            print(f"[Warn] Failed to bind UDP to {self.host}:{self.udp_port} ({e}). Falling back to {fallback_host}:{self.udp_port}.")
-            self.host = fallback_host
-            self.udp_sock.bind((self.host, self.udp_port))
+    def create_socket(self):
+        return socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def bind(self, sock=None):
+        # sock: an already bound socket, handed over by the process this one replaces
+        if sock is not None:
+            self.udp_sock = sock
+            self.host, self.udp_port = sock.getsockname()[:2]
+        else:
+            self.udp_sock = self.create_socket()
+            try:
+                self.udp_sock.bind((self.host, self.udp_port))
+            except Exception as e:
+                fallback_host = '127.0.0.1' if self.host.lower() == 'localhost' or self.host.strip() == '' else '127.0.0.1'
+                log.warning("Failed to bind UDP to %s:%s (%s). Falling back to %s:%s.", self.host, self.udp_port, e,
+                            fallback_host, self.udp_port)
+                self.host = fallback_host
+                self.udp_sock.bind((self.host, self.udp_port))
+        self.fanout = Fanout(self.udp_sock)
+        if self.coalesce_window > 0:
+            self.coalescer = Coalescer(self.broadcast, self.coalesce_window, self.coalesce_bytes,
+                                       batches=self.reads_extended)
+        if self.presence:
+            self.presence.track_all(time.monotonic())
         self.running = True
 
     def start(self):
+        timeout = None
         while self.running:
+            if self.forward is not None:
+                self.forward_packets()
+                if self.forward is not None:
+                    return
+                # The handoff failed before the new process took over (resume())
+                timeout = FORWARD_POLL
+                continue
+            # Wake periodically for coalescing, reliable clients and expiry
+            interval = self.wake_interval()
+            if interval != timeout:
+                self.udp_sock.settimeout(interval)
+                timeout = interval
             try:
-                data, address = self.udp_sock.recvfrom(MAX_MESSAGE_SIZE)
-                if not data:
-                    continue
-                print(f"[Received] UDP packet: {address} size={len(data)}")
-                self.handle_packet(data, address)
+                data, address = self.udp_sock.recvfrom(MAX_MESSAGE_SIZE + 1)
+                if data:
+                    self.on_datagram(data, address)
+            except socket.timeout:
+                pass
             except Exception as e:
                 if self.running:
-                    print(f"[Receive error] {e}")
+                    log.warning("[Receive error] %s", e, hot="receive_error")
+            if self.injected:
+                self.run_injected()
+            if timeout is not None:
+                self.run_timers(time.monotonic())
+
+    def hand_off(self, forward):
+        # Called on another thread once a new process holds this socket:
+        # returns when no packet is being handled here any more (True), and
+        # passes every datagram this process still reads to forward()
+        self.forward = forward
+        # Wakes the recvfrom() in start(); the new process is not reading yet
+        self.wake()
+        return self.paused.wait(PAUSE_TIMEOUT)
+
+    def forward_packets(self):
+        if self.coalescer:
+            self.coalescer.flush_all()
+        self.paused.set()
+        self.udp_sock.settimeout(FORWARD_POLL)
+        while self.running:
+            try:
+                data, address = self.udp_sock.recvfrom(MAX_MESSAGE_SIZE + 1)
+            except socket.timeout:
+                data = None
+            except OSError:
+                break
+            forward = self.forward
+            if forward is None:
+                self.paused.clear()
+                if data:
+                    self.on_datagram(data, address)
+                return
+            if data:
+                forward(data, address)
+        self.forwarding_done.set()
+
+    def resume(self):
+        # Undoes hand_off() when the new process failed before taking over:
+        # packets are handled here again
+        self.paused.clear()
+        self.forward = None
+        self.wake()
+
+    def stop_forwarding(self):
+        # The new process is reading: stop competing with it for datagrams
+        self.running = False
+        self.forwarding_done.wait(PAUSE_TIMEOUT)
+
+    def inject(self, data, address):
+        # A datagram the previous process read after the handoff
+        self.injected.append((data, address))
+        self.wake()
+
+    def run_injected(self):
+        while self.injected:
+            data, address = self.injected.popleft()
+            try:
+                self.on_datagram(data, address)
+            except Exception as e:
+                log.warning("[Receive error] %s", e, address=address, hot="receive_error")
+
+    def wake(self):
+        # An empty datagram to our own port ends a blocking recvfrom(); the
+        # receive loop ignores it
+        host, port = self.udp_sock.getsockname()[:2]
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.sendto(b"", ('127.0.0.1' if host in ('0.0.0.0', '') else host, port))
+
+    def wake_interval(self):
+        interval = WHEEL_TICK if self.presence else None
+        if self.coalescer:
+            interval = self.coalescer.window if interval is None else min(interval, self.coalescer.window)
+        if self.reliable.streams:
+            interval = TICK if interval is None else min(interval, TICK)
+        if self.catch_up.pending:
+            interval = CATCH_UP_INTERVAL if interval is None else min(interval, CATCH_UP_INTERVAL)
+        return interval
+
+    def next_timer(self):
+        # Monotonic time at which run_timers() has work, None if nothing waits
+        deadline = self.presence.next_timer() if self.presence else None
+        for timer in (self.coalescer.next_deadline() if self.coalescer else None, self.reliable.next_timer(),
+                      self.catch_up.next_deadline()):
+            if timer is not None:
+                deadline = timer if deadline is None else min(deadline, timer)
+        return deadline
+
+    def run_timers(self, now):
+        if self.coalescer and self.coalescer.pending:
+            self.coalescer.flush_due(now)
+        if self.reliable.active:
+            self.reliable.tick(now)
+        if self.catch_up.pending:
+            self.catch_up.run(now)
+        if self.presence:
+            self.presence.run(now)
+
+    def on_datagram(self, data: bytes, address: tuple):
+        PACKETS_RECEIVED.value += 1
+        BYTES_RECEIVED.value += len(data)
+        if log.debug_enabled:
+            log.debug("[Received] UDP packet", address=address, size=len(data), hot="received")
+        if self.limiter and not self.limiter.allow_address(address, time.monotonic()):
+            REJECTED_RATE_ADDRESS.value += 1
+            log.warning("[Rate limited] Source address over its limit", address=address, hot="rate_limited")
+            return
+        if len(data) > MAX_MESSAGE_SIZE:
+            # Truncated by recvfrom (or too big for any client to receive);
+            # larger messages are sent as fragments
+            REJECTED_OVERSIZED.value += 1
+            log.warning("[Processing error] Datagram over %d bytes", MAX_MESSAGE_SIZE, address=address, hot="packet_error")
+            return
+        self.handle_packet(data, address)
 
     def handle_packet(self, data: bytes, address: tuple):
+        self.received_at = time.perf_counter()
+        if self.limiter and not self.enveloped and not self.limiter.allow_packet(data, time.monotonic()):
+            REJECTED_RATE_TOKEN.value += 1
+            log.warning("[Rate limited] Token over its room's limit", address=address, hot="rate_limited")
+            return
+        if is_session_payload(data):
+            self.handle_session_packet(data, address)
+            return
+        if is_compressed_payload(data):
+            self.handle_compressed_packet(data, address)
+            return
+        if is_fragment_payload(data):
+            self.handle_fragment_packet(data, address)
+            return
+        if is_reliable_payload(data):
+            self.handle_reliable_packet(data, address)
+            return
+        if is_ack_payload(data):
+            _, ack, sack = parse_ack_payload(data)
+            self.reliable.on_ack(address, ack, sack, time.monotonic())
+            return
         try:
             room_name, token, message = parse_udp_payload(data)
-            print(f"[Processing received] Room: {room_name}, Token: {token[:8]}..., Message: {message}")
+            if log.debug_enabled:
+                log.debug("[Processing received] %r", message, room=room_name, token=token, address=address, hot="processing")
             self.process_message(room_name, token, message, address)
         except Exception as e:
-            print(f"[Processing error] {e}")
+            REJECTED_MALFORMED.value += 1
+            log.warning("[Processing error] %s", e, address=address, hot="packet_error")
+
+    def handle_session_packet(self, data: bytes, address: tuple):
+        # Compact packet: one integer-keyed lookup resolves token and room.
+        # The session id is a routing handle, not a credential, so it is only
+        # honoured from the address the session registered with its token.
+        try:
+            session_id, message = parse_session_payload(data)
+        except Exception as e:
+            REJECTED_MALFORMED.value += 1
+            log.warning("[Processing error] %s", e, address=address, hot="packet_error")
+            return
+        token = self.session_token(session_id, address)
+        if token is None:
+            return
+        info = self.room_manager.tokens[token]
+        if log.debug_enabled:
+            log.debug("[Processing received] session %016x: %r", session_id, message,
+                      room=info.room_name, token=token, address=address, hot="processing")
+        self.process_message(info.room_name, token, message, address)
+
+    def session_token(self, session_id: int, address: tuple):
+        # The token behind a session id, or None if it may not be used from address
+        token = self.room_manager.session_ids.get(session_id)
+        if token is None:
+            REJECTED_UNKNOWN_SESSION.value += 1
+            log.warning("[Validation failed] Unknown session id %016x", session_id,
+                        address=address, hot="validation")
+            return None
+        info = self.room_manager.tokens[token]
+        if info.address != address:
+            REJECTED_ADDRESS_MISMATCH.value += 1
+            log.warning("[Validation failed] Session %016x used from unregistered address", session_id,
+                        room=info.room_name, token=token, address=address, hot="validation")
+            return None
+        return token
+
+    def handle_compressed_packet(self, data: bytes, address: tuple):
+        # A compressed chat message: relayed like any other, still compressed,
+        # except to members that did not negotiate compression
+        session_id = int.from_bytes(data[2:SESSION_HEADER_SIZE], 'big')
+        token = self.session_token(session_id, address)
+        if token is None:
+            return
+        info = self.room_manager.tokens[token]
+        if self.presence:
+            self.presence.touch(token, time.monotonic())
+        info.seen = self.room_manager.history_position(info.room_name)
+        if log.debug_enabled:
+            log.debug("[Processing received] session %016x: %d compressed bytes", session_id, len(data),
+                      room=info.room_name, token=token, address=address, hot="processing")
+        frame = build_compressed_message(info.username.encode('utf-8'), data)
+        addrs, plain_addrs = self.member_addresses_by_codec(info.room_name, token)
+        others = 0
+        if plain_addrs:
+            plain = self.inflate_message(info.room_name, frame)
+            if plain is None:
+                # Members with compression still get it; they read it themselves
+                NOT_INFLATED.value += 1
+                log.warning("[Relay] Compressed message not sent to %d members without compression: "
+                            "it does not inflate within %d bytes", len(plain_addrs), MAX_MESSAGE_SIZE,
+                            room=info.room_name, token=token, address=address, hot="not_inflated")
+            else:
+                self.relay(plain, plain_addrs)
+                others = len(plain_addrs)
+        self.relay_message(info.room_name, token, info.username, frame, addrs, others)
+
+    def inflate_message(self, room_name, frame):
+        # A relayed compressed frame as the plain frame it stands for, None
+        # if it does not inflate with the room's dictionary
+        if self.dictionaries is None:
+            self.dictionaries = Room_Dictionaries()
+        _, dictionary = self.dictionaries.get(room_name)
+        codec = self.codecs.get(dictionary)
+        if codec is None:
+            codec = self.codecs[dictionary] = Message_Codec(dictionary)
+        try:
+            sender, message = codec.parse_message(frame, MAX_MESSAGE_SIZE)
+        except Exception:
+            return None
+        INFLATED.value += 1
+        return build_udp_message(sender, message)
+
+    def plain_history(self, room_name, frames):
+        # History for a member without compression: compressed frames
+        # inflated, any that do not inflate left out
+        if not any(is_compressed_message(frame) for frame in frames):
+            return frames
+        plain = []
+        for frame in frames:
+            if is_compressed_message(frame):
+                frame = self.inflate_message(room_name, frame)
+                if frame is None:
+                    continue
+            plain.append(frame)
+        return plain
+
+    def handle_fragment_packet(self, data: bytes, address: tuple):
+        # One fragment of a large message: relayed on arrival with the
+        # session id swapped for the sender, the chunk sent from `data` in
+        # place. Fragments are not kept in the room history (history.py).
+        session_id, message_id, index, count = parse_fragment_header(data)
+        token = self.session_token(session_id, address)
+        if token is None:
+            return
+        info = self.room_manager.tokens[token]
+        now = time.monotonic()
+        if self.presence:
+            self.presence.touch(token, now)
+        info.seen = self.room_manager.history_position(info.room_name)
+        if self.fragments.add(token, message_id, index, count, memoryview(data)[FRAGMENT_HEADER_SIZE:], now) is False:
+            REJECTED_FRAGMENT.value += 1
+            log.warning("[Validation failed] Fragment %d/%d over the reassembly limits", index, count,
+                        room=info.room_name, token=token, address=address, hot="validation")
+            return
+        # Members whose client does not read fragments cannot be sent the
+        # message at all: it does not fit one plain datagram
+        addrs, plain_addrs = self.member_addresses_by_frames(info.room_name, token)
+        if plain_addrs:
+            FRAGMENTS_WITHHELD.value += len(plain_addrs)
+            if index == 0:
+                log.warning("[Relay] Large message not sent to %d members that do not read fragments",
+                            len(plain_addrs), room=info.room_name, token=token, address=address, hot="withheld")
+        head = build_relayed_header(info.username.encode('utf-8'), message_id, index, count)
+        sent, failed = self.relay_parts(head, data, FRAGMENT_HEADER_SIZE, addrs)
+        FRAGMENTS_RELAYED.value += 1
+        if failed:
+            log.warning("[Relay] %d of %d fragment sends failed", failed, sent + failed,
+                        room=info.room_name, token=token, hot="relay_failed")
+
+    def handle_reliable_packet(self, data: bytes, address: tuple):
+        # A reliable envelope is acknowledged and de-duplicated here, then
+        # its packet is handled like any other. Only a __REGISTER__ with a
+        # valid token (always seq 0) opens a stream for an address.
+        seq, packet = parse_reliable_payload(data)
+        if is_reliable_payload(packet) or is_ack_payload(packet):
+            REJECTED_MALFORMED.value += 1
+            return
+        stream = self.reliable.streams.get(address)
+        if stream is None:
+            try:
+                room_name, token, message = parse_udp_payload(packet)
+            except Exception:
+                room_name = token = message = None
+            if seq != 0 or message != "__REGISTER__" or token not in self.room_manager.tokens:
+                REJECTED_NO_STREAM.value += 1
+                log.warning("[Validation failed] Reliable packet without a reliable registration",
+                            address=address, hot="validation")
+                return
+            stream = self.reliable.open(address)
+        if self.reliable.receive(stream, seq, address, time.monotonic()):
+            self.enveloped = True
+            try:
+                self.handle_packet(packet, address)
+            finally:
+                self.enveloped = False
 
     def process_message(self, room_name: str, token: str, message: str, address: tuple):
         rooms = self.room_manager.rooms
         tokens = self.room_manager.tokens
 
+        if self.presence and token in tokens:
+            self.presence.touch(token, time.monotonic())
+
         if message == "__REGISTER__":
-            if token in tokens:
-                tokens[token]["address"] = address
-                self.room_manager.save_to_json()
-                print(f"[Registered] Address {address} registered to token {token[:8]}...\n")
+            info = tokens.get(token)
+            previous = info.address if info is not None else None
+            if self.room_manager.register_address(token, address):
+                if not self.enveloped and address in self.reliable.streams:
+                    # A plain REGISTER from this address: the client there no longer speaks reliable
+                    self.reliable.close(address)
+                log.info("[Registered] Address registered to token", room=room_name, token=token, address=address, hot="register")
+                info = tokens[token]
+                if address != previous:
+                    # A new client gets the room's history. After a NAT rebind
+                    # the client already has what was relayed while its old
+                    # address was still heard from, so only the rest is
+                    # replayed. A repeated REGISTER gets nothing.
+                    after = info.seen if previous is not None else None
+                    frames = self.room_manager.recent_messages(info.room_name, after)
+                    if info.codec is None:
+                        frames = self.plain_history(info.room_name, frames)
+                    self.catch_up.add(frames, address, time.monotonic())
+                info.seen = self.room_manager.history_position(info.room_name)
             else:
-                print(f"[Registration rejected] Unknown token {token[:8]}...")
+                REJECTED_UNKNOWN_TOKEN.value += 1
+                log.warning("[Registration rejected] Unknown token", room=room_name, token=token, address=address, hot="validation")
             return
 
-        if message == "__LEAVE__":
-            if token in tokens and room_name in rooms:
-                is_host = (rooms[room_name].get("host_token") == token)
-                if is_host:
-                    username = tokens[token]['username'].strip('"')
-                    print(f"[Host leaving] {repr(username)} is leaving room '{room_name}'")
-                    self.notify_room_closed(room_name, excluded_tokens=[token])
+        info = tokens.get(token)
+        if info is not None and info.address == address:
+            info.seen = self.room_manager.history_position(info.room_name)
+
+        if message == "__HEARTBEAT__":
+            # Keeps an idle session alive; nothing to relay
+            return
 
-            self.room_manager.delete_room_if_host_left(room_name, token)
-            self.room_manager.save_to_json()
-            print(f"[Leave processing] {token[:8]}...")
-            print()
+        if message == "__LEAVE__":
+            self.leave(room_name, token, address)
+            log.info("[Leave processing]", room=room_name, token=token, address=address)
             return
 
         is_valid, reason = self.room_manager.validate_token_and_address(token, room_name)
         if not is_valid:
-            print(f"[Validation failed] {reason}")
+            REJECTED.labels(_REJECT_REASONS.get(reason, "invalid")).value += 1
+            log.warning("[Validation failed] %s", reason, room=room_name, token=token, address=address, hot="validation")
             return
 
         if room_name not in rooms or token not in tokens:
-            print("[Relay failed] Room or token does not exist")
+            REJECTED.labels("unknown_room").value += 1
+            log.warning("[Relay failed] Room or token does not exist", room=room_name, token=token, address=address, hot="validation")
             return
 
-        sender = tokens[token]["username"]
-        members = rooms[room_name]["members"]
+        sender = tokens[token].username
+        # Encode once; every recipient receives the identical frame
+        return self.relay_message(room_name, token, sender, build_udp_message(sender, message))
+
+    def relay_message(self, room_name, token, sender, payload, addrs=None, others=0):
+        # others: recipients already sent the message in another form
+        if addrs is None:
+            addrs = self.member_addresses(room_name, excluded_tokens=(token,))
+        self.room_manager.record_message(room_name, payload)
+        sent, failed = self.relay(payload, addrs)
+        FANOUT_SIZE.observe(len(addrs) + others)
+        if self.received_at is not None:
+            RELAY_SECONDS.observe(time.perf_counter() - self.received_at)
+        if failed:
+            log.warning("[Relay] %d of %d sends failed", failed, sent + failed, room=room_name, token=token, hot="relay_failed")
+        if log.debug_enabled:
+            log.debug("[Sent] %r: %d sent, %d failed", sender.strip('"'), sent, failed, room=room_name, token=token, hot="relay")
+        return sent, failed
+
+    def leave(self, room_name, token, address):
+        rooms = self.room_manager.rooms
+        tokens = self.room_manager.tokens
+        if token in tokens and room_name in rooms:
+            is_host = (rooms[room_name].host_token == token)
+            if is_host:
+                username = tokens[token].username.strip('"')
+                log.info("[Host leaving] %r is leaving", username, room=room_name, token=token, address=address)
+                self.notify_room_closed(room_name, excluded_tokens=[token])
+
+        if self.catch_up.pending:
+            self.catch_up.discard([address])
+        if self.fragments.pending:
+            self.fragments.forget(token)
+        self.room_manager.delete_room_if_host_left(room_name, token)
+
+    def expire_session(self, token):
+        # A silent session leaves as if it had sent __LEAVE__; an expired
+        # host closes the room for everyone else
+        info = self.room_manager.tokens[token]
+        address = info.address
+        self.leave(info.room_name, token, address)
+        if address in self.reliable.streams:
+            self.reliable.close(address)
+
+    def member_addresses(self, room_name, excluded_tokens=()):
+        tokens = self.room_manager.tokens
+        room = self.room_manager.rooms.get(room_name)
+        if room is None:
+            return []
+        addrs = []
+        # room.members is never modified in place, so joins on the TCP threads
+        # cannot break this loop; they show up from the next message
+        for member_token in room.members:
+            if member_token in excluded_tokens:
+                continue
+            info = tokens.get(member_token)
+            if not info:
+                continue
+            addr = info.address
+            if not addr:
+                continue
+            addrs.append(tuple(addr) if isinstance(addr, list) else addr)
+        return addrs
 
-        for member_token in members:
+    def member_addresses_by_codec(self, room_name, token):
+        # (addresses of the members other than token that negotiated
+        # compression, addresses of those that did not)
+        tokens = self.room_manager.tokens
+        room = self.room_manager.rooms.get(room_name)
+        if room is None:
+            return [], []
+        compressed = []
+        plain = []
+        for member_token in room.members:
             if member_token == token:
                 continue
+            info = tokens.get(member_token)
+            if not info or not info.address:
+                continue
+            addr = info.address
+            (compressed if info.codec else plain).append(tuple(addr) if isinstance(addr, list) else addr)
+        return compressed, plain
 
-            addr = tokens[member_token].get("address")
-            if not addr:
+    def member_addresses_by_frames(self, room_name, token):
+        # (addresses of the members other than token whose client reads
+        # extended frames, addresses of those whose client does not)
+        tokens = self.room_manager.tokens
+        room = self.room_manager.rooms.get(room_name)
+        if room is None:
+            return [], []
+        extended = []
+        plain = []
+        for member_token in room.members:
+            if member_token == token:
+                continue
+            info = tokens.get(member_token)
+            if not info or not info.address:
                 continue
+            addr = info.address
+            (extended if info.extended else plain).append(tuple(addr) if isinstance(addr, list) else addr)
+        return extended, plain
 
-            if isinstance(addr, list):
-                addr = tuple(addr)
+    def reads_extended(self, addr):
+        # Whether the session registered at addr said in its handshake that
+        # it reads batches and fragments
+        token = self.room_manager.find_token_by_address(addr)
+        info = self.room_manager.tokens.get(token) if token is not None else None
+        return info is not None and info.extended
 
-            try:
-                payload = build_udp_message(sender, message)
-                self.udp_sock.sendto(payload, addr)
-                username = tokens[token]['username'].strip('"')
-                print(f"[Sent] To {repr(username)}: {message}")
-            except Exception as e:
-                username = tokens[token]['username'].strip('"')
-                print(f"[Send error] {repr(username)}: {e}")
+    def relay(self, payload: bytes, addrs: list) -> tuple[int, int]:
+        # Chat messages go through the coalescer when it is on; what it
+        # returns is only what had to be sent right away
+        if self.catch_up.pending:
+            addrs = self.catch_up.hold(payload, addrs)
+        if self.coalescer is None:
+            return self.broadcast(payload, addrs)
+        return self.coalescer.add(payload, addrs, time.monotonic())
+
+    def relay_parts(self, head: bytes, data: bytes, offset: int, addrs: list) -> tuple[int, int]:
+        # Relays head + data[offset:] without building it where the fanout
+        # allows. Reliable recipients and addresses still catching up need
+        # the datagram as one object, so only they get a copy. Fragments
+        # skip the coalescer: a batch frame cannot hold one.
+        sent = failed = 0
+        if self.reliable.streams or self.catch_up.pending:
+            whole = head + data[offset:]
+            if self.catch_up.pending:
+                addrs = self.catch_up.hold(whole, addrs)
+            if self.reliable.streams:
+                addrs, sent, failed = self.reliable.send_many(whole, addrs, time.monotonic())
+        s, f = self.send_parts(head, data, offset, addrs)
+        sent += s
+        failed += f
+        PACKETS_SENT.value += sent
+        BYTES_SENT.value += sent * (len(head) + len(data) - offset)
+        if failed:
+            SEND_FAILURES.value += failed
+        return sent, failed
+
+    def broadcast(self, payload: bytes, addrs: list) -> tuple[int, int]:
+        sent = failed = 0
+        if self.reliable.streams:
+            addrs, sent, failed = self.reliable.send_many(payload, addrs, time.monotonic())
+        s, f = self.send_batch(payload, addrs)
+        sent += s
+        failed += f
+        PACKETS_SENT.value += sent
+        BYTES_SENT.value += sent * len(payload)
+        if failed:
+            SEND_FAILURES.value += failed
+        return sent, failed
+
+    def send_batch(self, payload: bytes, addrs: list) -> tuple[int, int]:
+        return self.fanout.send(payload, addrs)
+
+    def send_parts(self, head: bytes, data: bytes, offset: int, addrs: list) -> tuple[int, int]:
+        return self.fanout.send_parts(head, data, offset, addrs)
 
     def notify_room_closed(self, room_name, excluded_tokens=None):
         if excluded_tokens is None:
             excluded_tokens = []
 
         rooms = self.room_manager.rooms
-        tokens = self.room_manager.tokens
 
         if room_name not in rooms:
-            print(f"[Notification error] Room '{room_name}' does not exist")
+            log.warning("[Notification error] Room does not exist", room=room_name)
             return
 
-        members = rooms[room_name]["members"]
-        print(f"[Room closed notification] Sending notification to {len(members)} members of room '{room_name}'")
-
-        notification_count = 0
-        for member_token in members:
-            if member_token in excluded_tokens:
-                continue
+        members = rooms[room_name].members
+        log.info("[Room closed notification] Sending notification to %d members", len(members), room=room_name)
 
-            if member_token not in tokens:
-                print(f"[Warning] Token {member_token[:8]}... not found")
-                continue
+        addrs = self.member_addresses(room_name, excluded_tokens=excluded_tokens)
+        skipped = sum(1 for t in members if t not in excluded_tokens) - len(addrs)
+        if skipped:
+            log.warning("[Warning] %d members have no registered address", skipped, room=room_name)
 
-            addr = tokens[member_token].get("address")
-            if not addr:
-                username = tokens[member_token]['username'].strip('"')
-                print(f"[Warning] Address not registered for {repr(username)}")
-                continue
-
-            if isinstance(addr, list):
-                addr = tuple(addr)
-
-            try:
-                system_message = "__ROOM_CLOSED__"
-                self.udp_sock.sendto(system_message.encode('utf-8'), addr)
-                notification_count += 1
-                username = tokens[member_token]['username'].strip('"')
-                print(f"[Notification] Sent closing notification to {repr(username)}({addr})")
-            except Exception as e:
-                username = tokens[member_token]['username'].strip('"')
-                print(f"[Notification error] {repr(username)} ({addr}): {e}")
+        if self.coalescer:
+            # Queued messages must arrive before the room closes
+            self.coalescer.flush(addrs)
+        if self.catch_up.pending:
+            self.catch_up.discard(addrs)
+        sent, failed = self.broadcast("__ROOM_CLOSED__".encode('utf-8'), addrs)
+        if failed:
+            log.warning("[Notification error] %d closing notifications could not be sent", failed, room=room_name)
+        log.info("[Notification complete] Sent to %d members", sent, room=room_name)
+        return sent, failed
 
-        print(f"[Notification complete] Sent to {notification_count} members\n")
+    def send(self, payload: bytes, addr: tuple):
+        self.udp_sock.sendto(payload, addr)
 
     def stop(self):
         self.running = False
         if self.udp_sock:
+            # Wakes the recvfrom() blocked in start() (Linux raises ENOTCONN but still wakes it).
+            # A handed-over socket is shared with the new process and must stay open for it
+            if self.forward is None:
+                try:
+                    self.udp_sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
             self.udp_sock.close()
-            print("[Stopped] UDP server stopped")
+            log.info("[Stopped] UDP server stopped")
@@ -0,0 +1,361 @@
+import json
+import multiprocessing
+import os
+import queue
+import select
+import socket
+import struct
+import threading
+import time
+import zlib
+
+from room_manager import RoomManager
+from udp_server import UDP_Chat_Server, MAX_MESSAGE_SIZE
+from presence import SESSION_TIMEOUT
+from protocol.ucrp import is_session_payload
+from protocol.fragment import is_fragment_payload
+from protocol.compress import is_compressed_payload
+from protocol.reliable import is_reliable_payload, is_ack_payload, RELIABLE_HEADER_SIZE
+import logger
+import metrics
+from logger import get_logger
+
+log = get_logger("shard")
+
+# Sharded UDP data plane.
+#
+# N worker processes bind the same UDP port with SO_REUSEPORT, so the kernel
+# spreads incoming datagrams across them by source address. Each room is owned
+# by exactly one worker (crc32(room_name) % N); a worker that receives a
+# packet for a room it does not own forwards it, with the client address, to
+# the owner over a local AF_UNIX socketpair. The owner relays from its own
+# socket, which shares the port, so clients see no difference.
+#
+# The supervisor (in the server.py process) keeps the authoritative
+# RoomManager, which the TCP server mutates. Sessions issued there are pushed
+# to the owning worker's replica; REGISTER/LEAVE applied by a worker are sent
+# back so the supervisor's state (and its journal) stays in step.
+#
+# Session records reach the supervisor as RoomManager events, under its lock.
+# They are queued there and sent by a thread of their own: a send that blocks
+# on a worker's full socket must not hold the lock, which the supervisor
+# needs to apply that worker's events and so let it read again. The TCP
+# handshake that caused the record waits, outside the lock, until it has
+# been written (wait_published), so the owner has the session before the
+# client can learn its token and REGISTER.
+#
+# Every IPC datagram starts with a one-byte kind:
+#   F  forwarded client packet: inet_aton(ip)(4B) + port(2B) + raw packet
+#   S  session upsert (JSON session record), supervisor -> worker
+#   E  replica event (JSON {"event", "data"}), worker -> supervisor
+#   M  metrics snapshot (JSON), worker -> supervisor, every METRICS_INTERVAL
+#   Q  shut down
+
+IPC_FORWARD = b'F'
+IPC_SESSION = b'S'
+IPC_EVENT = b'E'
+IPC_METRICS = b'M'
+IPC_QUIT = b'Q'
+
+IPC_BUFFER_SIZE = 4 * 1024 * 1024
+METRICS_INTERVAL = 1.0
+PUBLISH_TIMEOUT = 1.0   # seconds a handshake waits for its session record to reach the worker
+
+FORWARDED = metrics.counter("chat_udp_forwarded_total", "Packets handed to the shard that owns their room")
+FORWARD_DROPS = metrics.counter("chat_udp_forward_drops_total", "Forwarded packets dropped because the owner's queue was full")
+
+_FORWARD_HEADER = struct.Struct('!4sH')
+_STOP = object()
+
+def shard_of(room_name, shards: int) -> int:
+    # hash() is salted per process, so it cannot be used to agree on owners
+    if isinstance(room_name, str):
+        room_name = room_name.encode('utf-8')
+    return zlib.crc32(room_name) % shards
+
+def _ipc_pair():
+    # Connected pairs are limited by socket buffers only, not by the small
+    # net.unix.max_dgram_qlen that applies to unconnected datagram sockets
+    pair = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    for sock in pair:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, IPC_BUFFER_SIZE)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, IPC_BUFFER_SIZE)
+    return pair
+
+class UDP_Shard_Worker(UDP_Chat_Server):
+    def __init__(self, host, udp_port, index, shards, control_sock, peer_socks, coalesce_window=0.0,
+                 session_timeout=SESSION_TIMEOUT, rate_limits=None):
+        super().__init__(host, udp_port, RoomManager(), coalesce_window, session_timeout=session_timeout,
+                         rate_limits=rate_limits)
+        self.index = index
+        self.shards = shards
+        self.control_sock = control_sock
+        self.peer_socks = peer_socks
+        self.room_manager.add_listener(self._on_replica_event)
+        metrics.gauge("chat_udp_replica_sessions", "Sessions in this shard's replica", lambda: len(self.room_manager.tokens))
+
+    def create_socket(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        return sock
+
+    def start(self):
+        peers = list(self.peer_socks.values())
+        readable = [self.control_sock, self.udp_sock] + peers
+        report_at = time.monotonic()
+        while self.running:
+            try:
+                now = time.monotonic()
+                if now >= report_at:
+                    self._report_metrics()
+                    report_at = now + METRICS_INTERVAL
+                self.run_timers(now)
+                wake_at = min(report_at, self.next_timer() or report_at)
+                ready, _, _ = select.select(readable, [], [], max(0.0, wake_at - now))
+                # Control first: a session upsert must be applied before the
+                # client's REGISTER, which can only have been sent after it,
+                # since the handshake answers once the upsert is written
+                if self.control_sock in ready:
+                    self._drain(self.control_sock, 65536)
+                for peer in peers:
+                    if peer in ready and self.running:
+                        self._drain(peer, MAX_MESSAGE_SIZE + 64)
+                if self.udp_sock in ready and self.running:
+                    data, address = self.udp_sock.recvfrom(MAX_MESSAGE_SIZE + 1)
+                    if data:
+                        self.on_datagram(data, address)
+            except Exception as e:
+                if self.running:
+                    log.warning("[Shard %d] [Receive error] %s", self.index, e, hot="receive_error")
+
+    def _report_metrics(self):
+        snapshot = metrics.REGISTRY.snapshot("chat_udp_")
+        try:
+            self.control_sock.send(IPC_METRICS + json.dumps(snapshot).encode('utf-8'), socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            pass
+
+    def _drain(self, sock, bufsize):
+        while self.running:
+            try:
+                message = sock.recv(bufsize, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                return
+            self._handle_ipc(message)
+
+    def handle_packet(self, data: bytes, address: tuple):
+        # A reliable envelope goes to the owner of the packet inside it; the
+        # owner keeps the stream, so it acknowledges and de-duplicates
+        packet = data[RELIABLE_HEADER_SIZE:] if is_reliable_payload(data) else data
+        if (is_session_payload(packet) or is_compressed_payload(packet) or is_fragment_payload(packet)
+                or is_ack_payload(packet)):
+            # The session id's high 32 bits are crc32(room_name)
+            owner = int.from_bytes(packet[2:6], 'big') % self.shards
+            if owner != self.index:
+                self._forward(owner, data, address)
+                return
+        elif len(packet) >= 2:
+            owner = shard_of(packet[2:2 + packet[0]], self.shards)
+            if owner != self.index:
+                self._forward(owner, data, address)
+                return
+        super().handle_packet(data, address)
+
+    def _forward(self, owner, data, address):
+        header = IPC_FORWARD + _FORWARD_HEADER.pack(socket.inet_aton(address[0]), address[1])
+        try:
+            # Never block on a peer: two workers forwarding to each other with
+            # full buffers would deadlock. A drop here is just UDP loss.
+            self.peer_socks[owner].send(header + data, socket.MSG_DONTWAIT)
+            FORWARDED.value += 1
+        except BlockingIOError:
+            FORWARD_DROPS.value += 1
+        except OSError as e:
+            log.warning("[Shard %d] [Forward error] shard %d: %s", self.index, owner, e, hot="forward_error")
+
+    def _handle_ipc(self, message):
+        kind, body = message[:1], message[1:]
+        if kind == IPC_FORWARD:
+            ip, port = _FORWARD_HEADER.unpack_from(body)
+            address = (socket.inet_ntoa(ip), port)
+            UDP_Chat_Server.handle_packet(self, body[_FORWARD_HEADER.size:], address)
+        elif kind == IPC_SESSION:
+            record = json.loads(body)
+            address = record["address"]
+            self.room_manager.add_session(
+                record["token"], record["room_name"], record["username"], record["is_host"],
+                tuple(address) if address else None, record["created_at"], record.get("session_id"),
+                codec=record.get("codec"), extended=record.get("extended", False)
+            )
+            if self.presence:
+                # Replica sessions are applied without listener events
+                self.presence.touch(record["token"], time.monotonic())
+        elif kind == IPC_QUIT:
+            self.running = False
+
+    def _on_replica_event(self, event, data):
+        if event not in ("register", "leave"):
+            return
+        self.control_sock.send(IPC_EVENT + json.dumps({"event": event, "data": data}).encode('utf-8'))
+
+    def stop(self):
+        self.running = False
+        for sock in [self.udp_sock, self.control_sock] + list(self.peer_socks.values()):
+            if sock:
+                sock.close()
+
+def _run_worker(host, udp_port, index, shards, control_sock, peer_socks, coalesce_window, session_timeout, rate_limits):
+    worker = UDP_Shard_Worker(host, udp_port, index, shards, control_sock, peer_socks, coalesce_window, session_timeout,
+                              rate_limits)
+    worker.bind()
+    log.info("[Shard %d] UDP worker %d bound to %s:%s", index, os.getpid(), worker.host, udp_port)
+    try:
+        worker.start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        worker.stop()
+        # The process exits right after this; write out what is queued
+        logger.shutdown()
+
+class UDP_Shard_Supervisor:
+    # Drop-in for UDP_Chat_Server in server.py: bind() spawns the workers,
+    # start() applies their REGISTER/LEAVE events, stop() shuts them down.
+    def __init__(self, host: str, udp_port: int, room_manager, workers: int, coalesce_window=0.0,
+                 session_timeout=SESSION_TIMEOUT, rate_limits=None):
+        self.host = host
+        self.udp_port = udp_port
+        self.room_manager = room_manager
+        self.shards = workers
+        self.coalesce_window = coalesce_window
+        self.session_timeout = session_timeout
+        self.rate_limits = rate_limits
+        self.control_socks = []
+        self.processes = []
+        self.snapshots = {}
+        self.wakeup = None
+        self.running = False
+        # (session record, Event set once it is written) for the publisher thread
+        self.outbox = queue.SimpleQueue()
+        self.publisher = None
+        self.handshake = threading.local()   # .sent: the Event of this thread's last record
+        room_manager.add_listener(self._on_session_event)
+
+    def bind(self):
+        controls = [_ipc_pair() for _ in range(self.shards)]
+        peers = {}
+        for i in range(self.shards):
+            for j in range(i + 1, self.shards):
+                peers[i, j], peers[j, i] = _ipc_pair()
+
+        for index in range(self.shards):
+            peer_socks = {j: peers[index, j] for j in range(self.shards) if j != index}
+            process = multiprocessing.Process(
+                target=_run_worker,
+                args=(self.host, self.udp_port, index, self.shards, controls[index][1], peer_socks,
+                      self.coalesce_window, self.session_timeout, self.rate_limits),
+                daemon=True
+            )
+            process.start()
+            self.processes.append(process)
+
+        # Workers hold their own copies now
+        for supervisor_end, worker_end in controls:
+            worker_end.close()
+            self.control_socks.append(supervisor_end)
+        for sock in peers.values():
+            sock.close()
+        self.wakeup = socket.socketpair()
+
+        # The relay counters live in the workers now; report theirs instead
+        metrics.REGISTRY.remove("chat_udp_")
+        metrics.REGISTRY.add_source(self._shard_metrics)
+
+        # Seed replicas with whatever the supervisor already knows
+        with self.room_manager.lock:
+            for token in self.room_manager.tokens:
+                self.outbox.put((self.room_manager.session_record(token), None))
+        self.publisher = threading.Thread(target=self._publisher, name="shard-publisher", daemon=True)
+        self.publisher.start()
+        self.running = True
+
+    def _publisher(self):
+        while True:
+            item = self.outbox.get()
+            if item is _STOP:
+                return
+            record, sent = item
+            self._publish(record)
+            if sent is not None:
+                sent.set()
+
+    def _publish(self, record):
+        owner = shard_of(record["room_name"], self.shards)
+        try:
+            self.control_socks[owner].send(IPC_SESSION + json.dumps(record).encode('utf-8'))
+        except OSError as e:
+            log.warning("[Shard supervisor] [Publish error] shard %d: %s", owner, e, hot="publish_error")
+
+    def _on_session_event(self, event, data):
+        if event == "session" and self.control_socks:
+            sent = threading.Event()
+            self.handshake.sent = sent
+            self.outbox.put((data, sent))
+
+    def wait_published(self, timeout=PUBLISH_TIMEOUT):
+        # Called by a TCP handshake after create_room/join_room, without the
+        # lock: returns once the session it issued is on its way to the owner
+        sent = getattr(self.handshake, "sent", None)
+        if sent is None:
+            return
+        self.handshake.sent = None
+        if not sent.wait(timeout):
+            log.warning("[Shard supervisor] Session record not published within %ss", timeout, hot="publish_error")
+
+    def _shard_metrics(self):
+        return [({"shard": str(index)}, snapshot) for index, snapshot in sorted(self.snapshots.items())]
+
+    def start(self):
+        readable = [self.wakeup[0]] + self.control_socks
+        shard_index = {sock: index for index, sock in enumerate(self.control_socks)}
+        while self.running:
+            ready, _, _ = select.select(readable, [], [])
+            if self.wakeup[0] in ready:
+                break
+            for sock in ready:
+                message = sock.recv(65536)
+                if message[:1] == IPC_METRICS:
+                    self.snapshots[shard_index[sock]] = json.loads(message[1:])
+                    continue
+                if message[:1] != IPC_EVENT:
+                    continue
+                try:
+                    self._apply(json.loads(message[1:]))
+                except Exception as e:
+                    log.warning("[Shard supervisor] [Apply error] %s", e, hot="apply_error")
+
+    def _apply(self, event):
+        data = event["data"]
+        if event["event"] == "register":
+            address = data["address"]
+            self.room_manager.register_address(data["token"], tuple(address) if address else None)
+        elif event["event"] == "leave":
+            self.room_manager.delete_room_if_host_left(data["room_name"], data["token"])
+
+    def stop(self):
+        self.running = False
+        if self.publisher:
+            self.outbox.put(_STOP)
+            self.publisher.join(timeout=2)
+        for sock in self.control_socks:
+            try:
+                sock.send(IPC_QUIT)
+            except OSError:
+                pass
+        if self.wakeup:
+            self.wakeup[1].send(b'\0')
+        for process in self.processes:
+            process.join(timeout=2)
+            if process.is_alive():
+                process.terminate()
+        log.info("[Stopped] UDP shard workers stopped")